@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+"""
+Benchmarks the deploy pipeline of ``fusionbox.fabric.django.new``.
+
+The real ``push`` runs against a fake project directory on this machine (see
+``local_remote``), with a synthetic git repository of configurable size.  The
+virtualenv is fake: pip does nothing and manage.py only pretends to migrate and
+collect the static files, so the numbers measure the pipeline itself.
+
+Each scenario reports the time, the number of remote commands and the number
+of bytes transferred of each phase::
+
+    python benchmarks/deploy_pipeline.py --files 5000 --history 200 --src-dirs 20
+"""
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from fabric.api import env, hide
+
+from fusionbox.fabric.django import new
+from fusionbox.fabric.timing import Timer
+
+from local_remote import local_remote
+
+
+PROJECT_NAME = 'benchmark'
+FILES_PER_APP = 50
+
+MANAGE_PY = """\
+import os
+import shutil
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+static_root = os.path.join(here, 'collected_static')
+
+if sys.argv[1] == 'diffsettings':
+    print('STATIC_ROOT = %r' % static_root)
+elif sys.argv[1] == 'collectstatic':
+    for dirpath, _, filenames in os.walk(here):
+        if os.path.basename(dirpath) != 'static':
+            continue
+        for name in filenames:
+            dst = os.path.join(static_root, name)
+            if not os.path.isdir(static_root):
+                os.makedirs(static_root)
+            if os.path.exists(dst):
+                os.unlink(dst)
+            shutil.copy2(os.path.join(dirpath, name), dst)
+"""
+
+
+def sh(command, cwd=None):
+    subprocess.check_call(command, shell=True, cwd=cwd)
+
+
+def write(path, content):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def filler(size, seed):
+    line = '# {0} {1}\n'.format(seed, 'x' * 60)
+    return (line * (size // len(line) + 1))[:size]
+
+
+def make_repo(path, files, file_size, migrations, static_files, history):
+    """
+    Creates a django-like git repository with ``history`` commits.
+    """
+    sh('git init -q && git config user.email bench@example.com && '
+       'git config user.name bench', path)
+    write(os.path.join(path, 'manage.py'), MANAGE_PY)
+    write(os.path.join(path, 'requirements.txt'), 'Django\n')
+    write(os.path.join(path, 'project', 'settings.py'), 'DEBUG = False\n')
+    for i in range(files):
+        app = 'app{0}'.format(i // FILES_PER_APP)
+        write(os.path.join(path, app, 'module{0}.py'.format(i)), filler(file_size, i))
+    for i in range(migrations):
+        app = 'app{0}'.format(i % max(1, files // FILES_PER_APP))
+        write(os.path.join(path, app, 'migrations', '{0:04d}_auto.py'.format(i)), '#\n')
+    for i in range(static_files):
+        write(os.path.join(path, 'static', 'file{0}.css'.format(i)), filler(file_size, i))
+    sh('git add -A && git commit -q -m initial', path)
+
+    history_file = os.path.join(path, 'project', 'history.py')
+    for i in range(history - 1):
+        write(history_file, 'REVISION = {0}\n'.format(i))
+        sh('git add -A && git commit -q -m revision', path)
+
+
+def make_project(projects_path):
+    """
+    Creates the project directory that the deploys go to, with a fake
+    virtualenv.
+    """
+    project = os.path.join(projects_path, PROJECT_NAME)
+    bin_dir = os.path.join(project, new.VIRTUALENV, 'bin')
+    write(os.path.join(project, 'environment'), 'DJANGO_SETTINGS_MODULE=project.settings\n')
+    write(os.path.join(bin_dir, 'activate'), 'export PATH={0}:$PATH\n'.format(bin_dir))
+    for name, body in [('pip', 'exit 0'), ('django-admin', 'echo 1.11.0')]:
+        write(os.path.join(bin_dir, name), '#!/bin/sh\n{0}\n'.format(body))
+        os.chmod(os.path.join(bin_dir, name), 0755)
+    vassal = os.path.join(projects_path, 'vassals', '{name}.ini')
+    write(vassal.format(name=PROJECT_NAME), '')
+    return project, vassal
+
+
+def read_timings(project, offset):
+    path = os.path.join(project, new.DEPLOY_TIMINGS)
+    with open(path) as f:
+        f.seek(offset)
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def timings_offset(project):
+    path = os.path.join(project, new.DEPLOY_TIMINGS)
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+@contextlib.contextmanager
+def silenced():
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        with hide('everything'):
+            yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def push_scenario(name, repo, project, change=None, qad=True):
+    """
+    Commits ``change`` (a dict of path to content) and pushes it.
+    """
+    if change:
+        for path, content in change.items():
+            write(os.path.join(repo, path), content)
+        sh('git add -A && git commit -q -m {0}'.format(name), repo)
+    offset = timings_offset(project)
+    with silenced():
+        new.push(new.get_git_ref('HEAD'), qad, backupdb=False)
+    return read_timings(project, offset)
+
+
+def history_scenario(project, src_dirs):
+    """
+    Fills the history with ``src_dirs`` more src directories, then lists and
+    cleans it up.
+    """
+    latest = os.path.basename(os.path.realpath(os.path.join(project, new.SRC_DIR)))
+    number = int(new.SRC_DIRNAMES_RE.match(latest).group(1))
+    for i in range(1, src_dirs + 1):
+        sh('cp -al {0} {1}.{2:05d}'.format(latest, new.SRC_DIR, number + i), project)
+    sh('ln -sfn {0}.{1:05d} {0}'.format(new.SRC_DIR, number + src_dirs), project)
+
+    with silenced():
+        with Timer() as timer:
+            new.forget_remote_state()
+            new.get_remote_state().load()
+            with new.cd_project():
+                new.cleanup_history(new.DEFAULT_HISTORY_SIZE)
+    return timer.report()
+
+
+def run_benchmarks(args, workdir):
+    repo = os.path.join(workdir, 'repo')
+    os.makedirs(repo)
+    make_repo(repo, args.files, args.file_size, args.migrations, args.static_files,
+              args.history)
+    project, vassal = make_project(os.path.join(workdir, 'www'))
+
+    new.PROJECTS_PATH = os.path.join(workdir, 'www')
+    new.VASSAL_TEMPLATES = [vassal]
+    env.project_name = PROJECT_NAME
+    env.vassal_name = PROJECT_NAME
+    env.force = False
+    os.environ['XDG_CACHE_HOME'] = os.path.join(workdir, 'cache')
+    os.chdir(repo)
+
+    scenarios = [
+        ('initial', lambda: push_scenario('initial', repo, project, qad=False)),
+        ('unchanged', lambda: push_scenario('unchanged', repo, project)),
+        ('code', lambda: push_scenario('code', repo, project, {
+            'app0/module0.py': filler(args.file_size, 'code')})),
+        ('migration', lambda: push_scenario('migration', repo, project, {
+            'app0/migrations/9999_auto.py': '#\n'})),
+        ('static', lambda: push_scenario('static', repo, project, {
+            'static/new.css': filler(args.file_size, 'static')})),
+        ('requirements', lambda: push_scenario('requirements', repo, project, {
+            'requirements.txt': 'Django\nsix\n'})),
+        ('history', lambda: history_scenario(project, args.src_dirs)),
+    ]
+    results = []
+    with local_remote():
+        for name, scenario in scenarios:
+            if args.scenario and name not in args.scenario:
+                continue
+            for line in scenario():
+                line['scenario'] = name
+                results.append(line)
+    return results
+
+
+def print_results(results):
+    scenario = None
+    for line in results:
+        if line['scenario'] != scenario:
+            scenario = line['scenario']
+            print('\n{0}'.format(scenario))
+        print('  {phase:<20} {seconds:>8.3f}s {commands:>5} commands {bytes:>12} bytes'.format(**line))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--files', type=int, default=1000,
+                        help='number of python files in the repository')
+    parser.add_argument('--file-size', type=int, default=2048,
+                        help='size of each file in bytes')
+    parser.add_argument('--migrations', type=int, default=50)
+    parser.add_argument('--static-files', type=int, default=100)
+    parser.add_argument('--history', type=int, default=20,
+                        help='number of commits in the repository')
+    parser.add_argument('--src-dirs', type=int, default=10,
+                        help='src directories to add before the history scenario')
+    parser.add_argument('--scenario', action='append',
+                        help='only run this scenario (can be repeated)')
+    parser.add_argument('--json', help='also write the results as JSON lines to this file')
+    parser.add_argument('--keep', action='store_true',
+                        help="don't remove the working directory")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='fabric-benchmark-')
+    try:
+        results = run_benchmarks(args, workdir)
+    finally:
+        if args.keep:
+            print('Working directory: {0}'.format(workdir))
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    parameters = dict((key, value) for key, value in vars(args).items()
+                      if key not in ('json', 'keep', 'scenario'))
+    for line in results:
+        line.update(parameters)
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            for line in results:
+                f.write(json.dumps(line, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+    main()
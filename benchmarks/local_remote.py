@@ -0,0 +1,152 @@
+"""
+A local stand-in for the remote host.
+
+``local_remote()`` replaces the ssh channel of fabric by a local shell, so that
+``run`` and ``sudo`` keep going through fabric (``cd``, ``prefix``,
+``warn_only``, the command counter of ``fusionbox.fabric.timing``) but execute
+on this machine.  ``get``, ``put`` and ``rsync_project`` are replaced by local
+file operations in the modules that imported them.
+"""
+import contextlib
+import os
+import re
+import shutil
+import subprocess
+import sys
+
+from fabric.api import env, settings
+from mock import patch
+
+
+# Modules that imported the operations by name
+PATCHED_MODULES = [
+    'fusionbox.fabric.django.new',
+    'fusionbox.fabric.update',
+]
+
+
+def execute(channel, command, pty=True, combine_stderr=None, invoke_shell=False,
+            stdout=None, stderr=None, timeout=None, capture_buffer_size=None):
+    """
+    Replacement for ``fabric.operations._execute``.
+    """
+    if combine_stderr is None:
+        combine_stderr = env.combine_stderr
+    process = subprocess.Popen(
+        command, shell=True, cwd='/',
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT if combine_stderr else subprocess.PIPE,
+    )
+    out, err = process.communicate()
+    if pty:
+        out = out.replace('\n', '\r\n')
+    return out.strip(), (err or '').strip(), process.returncode
+
+
+def remote_path(path):
+    return os.path.join(env.get('cwd') or '/', path)
+
+
+def get(remote, local_path=None, use_sudo=False, **kwargs):
+    with open(remote_path(remote), 'rb') as f:
+        content = f.read()
+    if hasattr(local_path, 'write'):
+        local_path.write(content)
+    else:
+        with open(local_path, 'wb') as f:
+            f.write(content)
+    return [local_path]
+
+
+def put(local_path=None, remote=None, use_sudo=False, mode=None, **kwargs):
+    if hasattr(local_path, 'getvalue'):
+        content = local_path.getvalue()
+    else:
+        with open(local_path, 'rb') as f:
+            content = f.read()
+    path = remote_path(remote)
+    with open(path, 'wb') as f:
+        f.write(content)
+    if mode is not None:
+        os.chmod(path, mode)
+    return [path]
+
+
+def has_rsync():
+    return any(os.access(os.path.join(path, 'rsync'), os.X_OK)
+               for path in os.environ.get('PATH', '').split(os.pathsep))
+
+
+def copy_files(local_dir, remote_dir, files):
+    transferred = 0
+    for name in files:
+        src = os.path.join(local_dir, name)
+        dst = os.path.join(remote_dir, name)
+        if os.path.isdir(src) and not os.path.islink(src):
+            continue
+        if not os.path.isdir(os.path.dirname(dst)):
+            os.makedirs(os.path.dirname(dst))
+        if os.path.lexists(dst):
+            os.unlink(dst)
+        if os.path.islink(src):
+            os.symlink(os.readlink(src), dst)
+        else:
+            shutil.copy2(src, dst)
+            transferred += os.path.getsize(dst)
+    return transferred
+
+
+def rsync_project(remote_dir, local_dir=None, exclude=(), delete=False,
+                  extra_opts='', ssh_opts='', capture=False, upload=True,
+                  default_opts='-pthrvz'):
+    """
+    Replacement for ``rsync_project``, with a local rsync if there's one, or
+    with plain copies.
+    """
+    # The benchmark user may not be in the group
+    extra_opts = re.sub(r'--chown=\S+', '', extra_opts)
+    if has_rsync():
+        command = 'rsync {opts} {delete} {extra} {local} {remote}'.format(
+            opts=default_opts, delete='--delete' if delete else '',
+            extra=extra_opts, local=local_dir, remote=remote_dir)
+        return subprocess.check_output(command, shell=True)
+
+    files_from = re.search(r'--files-from=(\S+)', extra_opts)
+    if files_from:
+        separator = '\0' if '--from0' in extra_opts else '\n'
+        with open(files_from.group(1)) as f:
+            files = [name for name in f.read().split(separator) if name]
+    else:
+        if delete and os.path.isdir(remote_dir):
+            shutil.rmtree(remote_dir)
+        files = []
+        for dirpath, dirnames, filenames in os.walk(local_dir):
+            for name in dirnames + filenames:
+                files.append(os.path.relpath(os.path.join(dirpath, name), local_dir))
+    if not os.path.isdir(remote_dir):
+        os.makedirs(remote_dir)
+    transferred = copy_files(local_dir, remote_dir, files)
+    return 'Total bytes sent: {0}\nTotal bytes received: 0'.format(transferred)
+
+
+@contextlib.contextmanager
+def local_remote():
+    """
+    Run the deploy operations against this machine.
+    """
+    patches = [
+        patch('fabric.operations._execute', execute),
+        patch('fabric.operations.default_channel', lambda: None),
+    ]
+    operations = {'get': get, 'put': put, 'rsync_project': rsync_project}
+    for name in PATCHED_MODULES:
+        __import__(name)
+        module = sys.modules[name]
+        for attr, replacement in operations.items():
+            if hasattr(module, attr):
+                patches.append(patch.object(module, attr, replacement))
+
+    with contextlib.nested(*patches):
+        # Runs as the current user, without a password nor the login profile
+        with settings(sudo_prefix='', shell='/bin/bash -c', host_string='localhost'):
+            yield
@@ -0,0 +1,156 @@
+"""
+Parallel, incremental compilation of python files to bytecode.
+
+This module is uploaded and run by the python of the remote virtualenv, so it
+only uses the standard library::
+
+    python bytecode.py [--jobs N] DIRECTORY[:PREVIOUS]...
+
+The files of ``DIRECTORY`` whose bytecode is up to date are skipped.  When a
+file is the same inode as in ``PREVIOUS`` (hard linked by the upload), its
+bytecode is hard linked from there instead of being compiled.  The rest is
+compiled by ``N`` processes (one per core by default).
+"""
+import multiprocessing
+import optparse
+import os
+import py_compile
+import struct
+import sys
+
+try:
+    from importlib.util import MAGIC_NUMBER, cache_from_source
+except ImportError:
+    import imp
+    MAGIC_NUMBER = imp.get_magic()
+
+    def cache_from_source(path):
+        return path + ('c' if __debug__ else 'o')
+
+
+# Python 3.7 added a flags field before the timestamp
+MTIME_OFFSET = 8 if sys.version_info >= (3, 7) else 4
+CHUNK_SIZE = 64
+
+
+def is_up_to_date(source, bytecode):
+    """
+    Returns whether the bytecode file was compiled from this version of the
+    source file.
+    """
+    try:
+        with open(bytecode, 'rb') as f:
+            header = f.read(MTIME_OFFSET + 4)
+        mtime = os.stat(source).st_mtime
+    except (IOError, OSError):
+        return False
+    if len(header) < MTIME_OFFSET + 4 or header[:4] != MAGIC_NUMBER:
+        return False
+    return struct.unpack('<I', header[MTIME_OFFSET:])[0] == int(mtime) & 0xFFFFFFFF
+
+
+def find_sources(directory):
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [d for d in dirs if d != '__pycache__' and not d.startswith('.')]
+        for name in files:
+            if name.endswith('.py'):
+                yield os.path.join(root, name)
+
+
+def link_bytecode(source, bytecode, directory, previous):
+    """
+    Hard links the bytecode of source from the previous directory, if source
+    is the same file there.  Returns whether it was linked.
+    """
+    previous_source = os.path.join(previous, os.path.relpath(source, directory))
+    try:
+        if not os.path.samefile(source, previous_source):
+            return False
+    except OSError:
+        return False
+    previous_bytecode = cache_from_source(previous_source)
+    if not is_up_to_date(previous_source, previous_bytecode):
+        return False
+    try:
+        if os.path.lexists(bytecode):
+            os.unlink(bytecode)
+        elif not os.path.isdir(os.path.dirname(bytecode)):
+            os.makedirs(os.path.dirname(bytecode))
+        os.link(previous_bytecode, bytecode)
+    except OSError:
+        return False
+    return True
+
+
+def plan(directories):
+    """
+    Returns the source files to compile and the counts of the files that were
+    up to date or linked.  ``directories`` is a list of ``(directory,
+    previous)``, ``previous`` can be None.
+    """
+    to_compile = []
+    up_to_date = linked = 0
+    for directory, previous in directories:
+        for source in find_sources(directory):
+            bytecode = cache_from_source(source)
+            if is_up_to_date(source, bytecode):
+                up_to_date += 1
+            elif previous and link_bytecode(source, bytecode, directory, previous):
+                linked += 1
+            else:
+                to_compile.append(source)
+    return to_compile, up_to_date, linked
+
+
+def compile_files(sources):
+    """
+    Compiles the source files, returns the error messages.
+    """
+    errors = []
+    for source in sources:
+        bytecode = cache_from_source(source)
+        try:
+            # The bytecode might be hard linked to a previous directory
+            if os.path.lexists(bytecode):
+                os.unlink(bytecode)
+            py_compile.compile(source, bytecode, doraise=True)
+        except (py_compile.PyCompileError, IOError, OSError) as e:
+            errors.append(str(e))
+    return errors
+
+
+def compile_parallel(sources, jobs=None):
+    chunks = [sources[i:i + CHUNK_SIZE] for i in range(0, len(sources), CHUNK_SIZE)]
+    if len(chunks) <= 1 or jobs == 1:
+        return compile_files(sources)
+    pool = multiprocessing.Pool(jobs or None)
+    try:
+        return sum(pool.map(compile_files, chunks), [])
+    finally:
+        pool.close()
+        pool.join()
+
+
+def parse_directory(argument):
+    directory, _, previous = argument.partition(':')
+    return directory, previous or None
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [--jobs N] DIRECTORY[:PREVIOUS]...')
+    parser.add_option('-j', '--jobs', type='int', default=0,
+                      help='Number of processes, one per core by default')
+    options, arguments = parser.parse_args(argv)
+    directories = [d for d in map(parse_directory, arguments) if os.path.isdir(d[0])]
+
+    to_compile, up_to_date, linked = plan(directories)
+    errors = compile_parallel(to_compile, options.jobs)
+    for error in errors:
+        sys.stderr.write(error + '\n')
+    print('{0} compiled, {1} linked, {2} up to date, {3} failed'.format(
+        len(to_compile) - len(errors), linked, up_to_date, len(errors)))
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
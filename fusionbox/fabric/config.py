@@ -1,14 +1,111 @@
+import threading
 from string import Formatter
 
 
+class CircularReferenceError(RuntimeError):
+    """
+    Raised when default values reference each other.
+    """
+    def __init__(self, names):
+        self.names = names
+        super(CircularReferenceError, self).__init__(
+            'Circular reference in default values: {0}'.format(' -> '.join(names)))
+
+
+def field_root(field_name):
+    """
+    Returns the name of the value a format field looks up, 'a' for 'a.b[0]'.
+    """
+    for i, c in enumerate(field_name):
+        if c in '.[':
+            return field_name[:i]
+    return field_name
+
+
+class Snapshot(object):
+    """
+    Immutable copy of the values of an ``Env``.  Snapshots don't build anything
+    when they are read, they can be shared between threads and pickled to other
+    processes.
+
+    ``errors`` maps the names of the values that couldn't be built to the
+    message of the ``AttributeError`` raised when they are read.
+    """
+    __slots__ = ('_values', '_errors')
+
+    def __init__(self, values, errors=None):
+        object.__setattr__(self, '_values', dict(values))
+        object.__setattr__(self, '_errors', dict(errors or {}))
+
+    def __getattr__(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            if name in self._errors:
+                raise AttributeError(self._errors[name])
+            raise AttributeError("'{0}' object has no attribute '{1}'".format(
+                type(self).__name__,
+                name,
+            ))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("'{0}' object is immutable".format(type(self).__name__))
+
+    __delattr__ = __setattr__
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __iter__(self):
+        return iter(sorted(self._values))
+
+    def __eq__(self, other):
+        return (type(self) is type(other) and self._values == other._values and
+                self._errors == other._errors)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __reduce__(self):
+        return (type(self), (self._values, self._errors))
+
+    def __repr__(self):
+        return '{0}({1!r})'.format(type(self).__name__, self._values)
+
+    def as_dict(self):
+        return dict(self._values)
+
+    def role(self, role, name=None):
+        """
+        Like ``Env.role``.  Without ``name``, returns the snapshot of all the
+        values of ``role``, without their prefix.
+        """
+        if name is not None:
+            return getattr(self, role + '_' + name)
+        prefix = role + '_'
+
+        def without_prefix(items):
+            return ((key[len(prefix):], value) for key, value in items
+                    if key.startswith(prefix))
+        return Snapshot(without_prefix(self._values.items()),
+                        without_prefix(self._errors.items()))
+
+
 class Env(object):
     """
     Stores config settings for fusionbox fabric helper routines.  Dynamically
     builds the value of certain properties unless their value was manually set.
 
-    NOTE:
-    Be careful not to define properties that reference each other...will cause
-    a stack overflow.
+    The ``DEFAULTS`` of a class are compiled once into a dependency graph.  Built
+    values are cached until one of the values they depend on is set or deleted.
+    Default values that reference each other raise a
+    ``CircularReferenceError``.
+
+    ``snapshot()`` resolves all the values at once for code that reads them
+    from several threads or processes.
     """
     DEFAULTS = {
         # Global defaults
@@ -22,6 +119,7 @@ class Env(object):
 
         'virtualenv': '{project_name}',
         'vassal': '{project_name}',
+        'db_name': '{project_name}',
 
         # Dev defaults
         'dev_project_name': '{project_name}',
@@ -38,6 +136,7 @@ class Env(object):
         'dev_backups_dir': '{backups_dir}',
         'dev_media_dir': '{media_dir}',
         'dev_media_path': '{dev_project_path}/{dev_media_dir}',
+        'dev_db_name': '{db_name}',
 
         # Live defaults
         'live_project_name': '{project_name}',
@@ -54,28 +153,94 @@ class Env(object):
         'live_backups_dir': '{backups_dir}',
         'live_media_dir': '{media_dir}',
         'live_media_path': '{live_project_path}/{live_media_dir}',
+        'live_db_name': '{db_name}',
 
         # Local defaults
         'local_backups_dir': '{backups_dir}',
         'local_media_dir': '{media_dir}',
+        'local_db_name': '{db_name}',
     }
 
     def __init__(self):
         self._formatter = Formatter()
+        self._cache = {}
+        self._resolving = []
+        self._lock = threading.RLock()
+
+    @classmethod
+    def compile(cls):
+        """
+        Returns the dependency graph of ``DEFAULTS`` as a dict of each name to
+        the set of the default values built from it.
+        """
+        if '_dependents' not in cls.__dict__:
+            formatter = Formatter()
+            dependents = {}
+            for name, f in cls.DEFAULTS.items():
+                for _, field_name, _, _ in formatter.parse(f):
+                    if field_name:
+                        dependents.setdefault(field_root(field_name), set()).add(name)
+            cls._dependents = dependents
+        return cls._dependents
 
     def __getattr__(self, name):
-        if name in self.DEFAULTS:
-            # If there is a default value format, build the default value
-            return self._format(self.DEFAULTS[name])
-        else:
+        if name.startswith('_') or name not in self.DEFAULTS:
             raise AttributeError("'{0}' object has no attribute '{1}'".format(
                 type(self).__name__,
                 name,
             ))
+        try:
+            return self._cache[name]
+        except KeyError:
+            return self._resolve(name)
+
+    def __setattr__(self, name, value):
+        if name.startswith('_'):
+            super(Env, self).__setattr__(name, value)
+            return
+        with self._lock:
+            super(Env, self).__setattr__(name, value)
+            self._invalidate(name)
+
+    def __delattr__(self, name):
+        with self._lock:
+            super(Env, self).__delattr__(name)
+            self._invalidate(name)
 
     def __getitem__(self, key):
         return getattr(self, key)
 
+    def _resolve(self, name):
+        with self._lock:
+            if name in self._cache:
+                return self._cache[name]
+            if name in self._resolving:
+                raise CircularReferenceError(
+                    self._resolving[self._resolving.index(name):] + [name])
+            self._resolving.append(name)
+            try:
+                # If there is a default value format, build the default value
+                value = self._format(self.DEFAULTS[name])
+            finally:
+                self._resolving.pop()
+            self._cache[name] = value
+            return value
+
+    def _invalidate(self, name):
+        """
+        Forgets the cached values built from ``name``.
+        """
+        dependents = self.compile()
+        stack = [name]
+        seen = set(stack)
+        while stack:
+            name = stack.pop()
+            self._cache.pop(name, None)
+            for dependent in dependents.get(name, ()):
+                if dependent not in seen:
+                    seen.add(dependent)
+                    stack.append(dependent)
+
     def _format(self, f):
         # Use a string formatter instance so we can use any object that defines
         # __getitem__
@@ -83,3 +248,28 @@ class Env(object):
 
     def role(self, role, name):
         return getattr(self, role + '_' + name)
+
+    def snapshot(self, role=None):
+        """
+        Returns a ``Snapshot`` of all the values, or of the values of ``role``
+        without their prefix (``snapshot('live').project_path``).  Values that
+        can't be built, because they depend on a value that isn't set, raise an
+        ``AttributeError`` naming the setting and the reason when they are
+        read from the snapshot.
+        """
+        errors = {}
+        with self._lock:
+            values = dict((name, value) for name, value in vars(self).items()
+                          if not name.startswith('_'))
+            for name in self.DEFAULTS:
+                if name not in values:
+                    try:
+                        values[name] = getattr(self, name)
+                    except (AttributeError, KeyError) as e:
+                        # Kept as text, so the snapshot can still be pickled
+                        errors[name] = "Setting '{0}' couldn't be built: {1}: {2}".format(
+                            name, type(e).__name__, e)
+        snapshot = Snapshot(values, errors)
+        if role is not None:
+            return snapshot.role(role)
+        return snapshot
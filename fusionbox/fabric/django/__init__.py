@@ -1,19 +1,20 @@
+import pipes
+
 from termcolor import colored
-from contextlib import contextmanager
-import os
-import subprocess
 
 from fabric.api import run, cd, puts, local, get, env, task
 
 from fusionbox.fabric import fb_env
 from fusionbox.fabric.git import get_git_branch
+from fusionbox.fabric.process import run_subprocesses, multiplex_output, Program, Supervisor
 from fusionbox.fabric.update import get_update_function
-from fusionbox.fabric.utils import virtualenv, files_changed
-from fusionbox.fabric.django.new import get_django_version
+from fusionbox.fabric.utils import virtualenv, files_changed, split_host_string
+from fusionbox.fabric.django.new import get_django_version, is_true
+from fusionbox.fabric.django import dbsync, mediasync
 
 
 @task
-def stage(pip=False, migrate=False, syncdb=False, branch=None, post_update=None, role='dev'):
+def stage(pip=False, migrate=False, syncdb=False, static=False, branch=None, post_update=None, role='dev'):
     """
     Updates the remote site files to your local branch head, collects static
     files, migrates, and installs pip requirements if necessary.
@@ -21,12 +22,9 @@ def stage(pip=False, migrate=False, syncdb=False, branch=None, post_update=None,
     update_function = get_update_function()
     branch = branch or get_git_branch()
 
-    project_name = fb_env.role(role, 'project_name')
-    project_path = fb_env.role(role, 'project_path')
-    virtualenv_path = fb_env.role(role, 'virtualenv_path')
-    restart_cmd = fb_env.role(role, 'restart_cmd')
+    config = fb_env.snapshot(role)
 
-    with cd(project_path):
+    with cd(config.project_path):
         previous_head = update_function(branch)
         puts('Previous remote HEAD: {0}'.format(previous_head))
 
@@ -35,10 +33,11 @@ def stage(pip=False, migrate=False, syncdb=False, branch=None, post_update=None,
             post_update()
 
         update_pip = pip or files_changed(previous_head, 'requirements.txt')
-        migrate = migrate or files_changed(previous_head, '*/migrations/* {project_name}/settings.py requirements.txt'.format(project_name=project_name))
+        migrate = migrate or files_changed(previous_head, '*/migrations/* {project_name}/settings.py requirements.txt'.format(project_name=config.project_name))
         syncdb = syncdb or files_changed(previous_head, '*/settings.py')
+        static = static or files_changed(previous_head, '*/static/* static/* */settings.py requirements.txt')
 
-        with virtualenv(virtualenv_path):
+        with virtualenv(config.virtualenv_path):
             if update_pip:
                 run('pip install -r ./requirements.txt')
 
@@ -55,9 +54,10 @@ def stage(pip=False, migrate=False, syncdb=False, branch=None, post_update=None,
                 if syncdb or migrate:
                     run('python manage.py migrate')
 
-            run('python manage.py collectstatic --noinput')
+            if static:
+                run('python manage.py collectstatic --noinput')
 
-        run(restart_cmd)
+        run(config.restart_cmd)
 
 
 @task
@@ -66,40 +66,58 @@ def deploy(post_update=None):
     Same as stage, but always uses the live branch and live config settings,
     migrates, and pip installs.
     """
-    stage(pip=True, migrate=True, syncdb=True, branch='live', post_update=post_update, role='live')
+    stage(pip=True, migrate=True, syncdb=True, static=True, branch='live', post_update=post_update, role='live')
 
 
 def shell():
     """
     Fires up a shell on the live server.
     """
-    with cd(fb_env.live_project_path):
-        with virtualenv(fb_env.live_virtualenv_path):
+    config = fb_env.snapshot('live')
+    with cd(config.project_path):
+        with virtualenv(config.virtualenv_path):
             run('bash -')
 
 
-def sync_db(role):
+def sync_db(role, mode='backupdb', jobs=dbsync.DEFAULT_JOBS, resume=True):
     """
     Downloads the latest remote (live or dev) database backup and loads it on your local
     machine.
+
+    The default ``backupdb`` mode goes through a backup file with
+    django-backupdb.  For Postgres, the ``stream`` mode pipes the dump over ssh
+    straight into pg_restore and the ``directory`` mode dumps, transfers and
+    restores in parallel with ``jobs`` workers, resuming an interrupted
+    transfer.  Both use the ``<role>_db_name`` and ``local_db_name`` settings
+    and take the local backup while the remote dump runs.
     """
-    remote_project_path = fb_env.role(role, 'project_path')
-    remote_virtualenv_path = fb_env.role(role, 'virtualenv_path')
-    remote_backups_dir = fb_env.role(role, 'backups_dir')
+    remote = fb_env.snapshot(role)
+    local_backups_dir = fb_env.local_backups_dir
+
+    if mode == 'stream':
+        dbsync.stream_db(env.host_string or env.roledefs[role][0],
+                         remote.db_name, fb_env.local_db_name)
+        return
+    elif mode == 'directory':
+        dbsync.sync_db_directory(env.host_string or env.roledefs[role][0],
+                                 remote.project_path, remote.backups_dir, remote.db_name,
+                                 local_backups_dir, fb_env.local_db_name,
+                                 jobs=int(jobs), resume=is_true(resume))
+        return
 
     local('python manage.py backupdb')
 
-    with cd(remote_project_path):
-        with virtualenv(remote_virtualenv_path):
+    with cd(remote.project_path):
+        with virtualenv(remote.virtualenv_path):
             run('python manage.py backupdb --backup-name=sync --pg-dump-options="--no-owner --no-privileges"')
 
             # Download
             get(
                 '{remote_backups_dir}/*-sync.*.gz'.format(
-                    remote_backups_dir=remote_backups_dir,
+                    remote_backups_dir=remote.backups_dir,
                 ),
                 './{local_backups_dir}/'.format(
-                    local_backups_dir=fb_env.local_backups_dir,
+                    local_backups_dir=local_backups_dir,
                 ),
             )
 
@@ -110,19 +128,40 @@ sync_with_live_db = lambda: sync_db('live')
 sync_with_dev_db = lambda: sync_db('dev')
 
 
-def sync_media(role):
+def sync_media(role, incremental=False, jobs=mediasync.DEFAULT_JOBS, full=False,
+               max_size=None, include=None, exclude=None, sample=None):
     """
     Synchronizes the latest remote (live or dev) media directory with your
     local media directory.
+
+    With ``incremental``, only the files changed since the last incremental
+    sync are listed and pulled, with ``jobs`` rsync processes.  Partial pulls
+    can be filtered by ``max_size`` in bytes, ``include`` and ``exclude`` globs
+    separated by ``;`` and ``sample``, a fraction of the files.  ``full``
+    lists all the files again.
     """
     remote = env.roledefs[role][0]
-    remote_media_path = fb_env.role(role, 'media_path') + '/'
+    remote_media_path = fb_env.snapshot(role).media_path + '/'
 
     # Rsync has weird syntax for the target directory
     local_media_dir = './' + fb_env.local_media_dir
 
-    local('rsync -avz --progress {remote}:{remote_media_path} {local_media_dir}'.format(
-        remote=remote,
+    if is_true(incremental):
+        mediasync.sync_media_incremental(
+            remote, remote_media_path.rstrip('/'), local_media_dir,
+            jobs=int(jobs),
+            full=is_true(full),
+            max_size=int(max_size) if max_size else None,
+            include=include.split(';') if include else None,
+            exclude=exclude.split(';') if exclude else None,
+            sample=float(sample) if sample else None,
+        )
+        return
+
+    destination, port = split_host_string(remote)
+    local('rsync -avz --progress -e {ssh} {remote}:{remote_media_path} {local_media_dir}'.format(
+        ssh=pipes.quote('ssh -p {0}'.format(port)),
+        remote=destination,
         remote_media_path=remote_media_path,
         local_media_dir=local_media_dir,
     ))
@@ -132,36 +171,7 @@ sync_with_live_media = lambda: sync_media('live')
 sync_with_dev_media = lambda: sync_media('dev')
 
 
-@contextmanager
-def run_subprocesses(cmds):
-    """
-    Returns a list of tuples of command, Popen object.  During __close__, the
-    list of processes is polled for unfinished processes and attempts to close
-    them.
-    """
-    processes = []
-    cwd = os.getcwd()
-    try:
-        for dir, cmd in cmds:
-            p = subprocess.Popen(cmd, shell=True,
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE,
-                                 cwd=os.path.join(cwd, dir))
-            processes.append((cmd, p))
-        yield processes
-    finally:
-        # We clean up any subprocesses that haven't finished with a SIGTERM
-        procs_to_term = filter(lambda p: p[1].poll() is None, processes)
-        try:
-            [p.terminate() for _, p in procs_to_term]
-            [p.wait() for _, p in procs_to_term]
-        except KeyboardInterrupt:
-            # User issued an interrupt, send SIGKILL to end immediately
-            [p.kill() for _, p in procs_to_term if p.poll() is None]
-            [p.wait() for _, p in procs_to_term]
-
-
-def runserver():
+def runserver(supervise=False):
     """
     Runs the local django server, starting up celery workers and/or the solr
     server if needed.
@@ -173,41 +183,74 @@ def runserver():
     - ``runserver_cmd``: ``('.', './manage.py runserver')``
     - ``celery_cmd``: ``('.', './manage.py celery worker -c 2 --autoreload')``
     - ``solr_cmd``: ``('solr', 'java -jar start.jar')``
+
+    ``extra_cmds`` can be a list of more 2-tuples.  The output of all the
+    commands is shown line by line as it comes.
+
+    With ``supervise``, the commands are restarted when they exit, see
+    ``get_programs``.
     """
-    commands = filter(bool, (
+    message_prefix = colored('[{command}]', 'blue', attrs=['bold'])
+    error_prefix = colored('[{command}]', 'white', 'on_red', attrs=['bold'])
+    supervisor_prefix = colored('[{command}]', 'yellow', attrs=['bold'])
+    output = u'{prefix} {message}'
+
+    def write(cmd, stream, line):
+        prefix = {
+            'stdout': message_prefix,
+            'stderr': error_prefix,
+        }.get(stream, supervisor_prefix)
+        print (output.format(
+            prefix=prefix.format(command=cmd),
+            message=line.decode('utf-8', 'replace')))
+
+    if supervise:
+        programs = get_programs()
+        if not programs:
+            print "No commands found.  Please check that you have set the necessary environment variables"
+        Supervisor(programs, write).run()
+        return
+
+    commands = filter(bool, [
         getattr(fb_env, 'runserver_cmd', None),
         getattr(fb_env, 'celery_cmd', None),
         getattr(fb_env, 'solr_cmd', None),
-    ))
+    ] + list(getattr(fb_env, 'extra_cmds', None) or []))
     if not commands:
         print "No commands found.  Please check that you have set the necessary environment variables"
 
-    def read_message(fd):
-        ret = ''
-        while True:
-            out = fd.read(1)
-            ret += out
-            if out == '':
-                break
-        return ret
+    with run_subprocesses(commands) as processes:
+        for cmd, stream, line in multiplex_output(processes):
+            write(cmd, stream, line)
 
-    message_prefix = colored('[{command}]', 'blue', attrs=['bold'])
-    error_prefix = colored('[{command}]', 'white', 'on_red', attrs=['bold'])
-    output = u'{prefix} {message}'
 
-    with run_subprocesses(commands) as processes:
-        for cmd, p in processes:
-            while p.poll() is None:
-                message = read_message(p.stdout)
-                error = read_message(p.stderr)
-                if message:
-                    print (output.format(
-                        prefix=message_prefix.format(command=cmd),
-                        message=message))
-                if error:
-                    print (output.format(
-                        prefix=error_prefix.format(command=cmd),
-                        message=error))
+def get_programs():
+    """
+    Returns the programs of runserver for the supervisor.  They are named
+    ``runserver``, ``celery``, ``solr`` and the command of the ``extra_cmds``.
+
+    - ``health_checks``: dict of program name to url for ``check_health``, like
+      ``{'solr': 'tcp://localhost:8983', 'runserver': 'http://localhost:8000/'}``
+    - ``start_after``: dict of program name to the programs it needs, by default
+      runserver and celery start after solr.
+    """
+    health_checks = getattr(fb_env, 'health_checks', None) or {}
+    start_after = getattr(fb_env, 'start_after', None) or {
+        'runserver': ['solr'],
+        'celery': ['solr'],
+    }
+    commands = [(name, getattr(fb_env, name + '_cmd', None))
+                for name in ('solr', 'runserver', 'celery')]
+    commands = [(name, command) for name, command in commands if command]
+    commands += [(cmd, (dir, cmd)) for dir, cmd in getattr(fb_env, 'extra_cmds', None) or []]
+
+    names = set(name for name, _ in commands)
+    programs = []
+    for name, (dir, cmd) in commands:
+        after = [n for n in start_after.get(name, []) if n in names]
+        programs.append(Program(name, cmd, dir, after=after,
+                                health_check=health_checks.get(name)))
+    return programs
 
 
 def obfuscate():
@@ -227,12 +270,11 @@ def obfuscate_decorator(role):
         def new_fn(*args, **kwargs):
             retval = old_fn(*args, **kwargs)
 
-            project_path = fb_env.role(role, 'project_path')
-            virtualenv_path = fb_env.role(role, 'virtualenv_path')
+            config = fb_env.snapshot(role)
 
-            with cd(project_path):
+            with cd(config.project_path):
                 # Use the venv so we have the right python version
-                with virtualenv(virtualenv_path):
+                with virtualenv(config.virtualenv_path):
                     obfuscate()
 
             return retval
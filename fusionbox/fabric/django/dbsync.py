@@ -0,0 +1,221 @@
+"""
+Fast database syncs from a remote server, for Postgres.
+
+``stream_db`` pipes ``pg_dump`` over ssh straight into ``pg_restore``.
+``sync_db_directory`` makes a parallel directory-format dump on the remote,
+transfers it with a resumable rsync and restores it in parallel.  Both take
+the local safety backup while the remote dump runs.
+
+The remote user must be able to run ``pg_dump`` without a password (peer
+authentication or ``~/.pgpass``).
+"""
+import os
+import pipes
+import subprocess
+import sys
+import tempfile
+import time
+from distutils.spawn import find_executable
+
+from fabric.api import run, cd, local, abort, settings
+from fabric.colors import red
+
+from fusionbox.fabric.process import CHUNK_SIZE
+from fusionbox.fabric.utils import split_host_string
+
+
+# (remote compress, local decompress) by preference
+COMPRESSORS = [
+    ('zstd', 'zstd -q -T0 -3 -c', 'zstd -q -d -c'),
+    ('pigz', 'pigz -1 -c', 'gzip -d -c'),
+]
+RESTORE_OPTIONS = '--clean --if-exists --no-owner --no-privileges'
+DUMP_DIRECTORY = 'sync-dir'
+DEFAULT_JOBS = 4
+
+
+class Progress(object):
+    """
+    Shows the amount of data transferred and the rate on one line of stderr.
+    """
+    def __init__(self, label, interval=1):
+        self.label = label
+        self.interval = interval
+        self.bytes = 0
+        self.started_at = self.shown_at = time.time()
+
+    def update(self, n):
+        self.bytes += n
+        now = time.time()
+        if now - self.shown_at >= self.interval:
+            self.shown_at = now
+            self.show(now)
+
+    def show(self, now=None):
+        elapsed = max((now or time.time()) - self.started_at, 1e-6)
+        sys.stderr.write('\r{0}: {1:.1f} MB, {2:.1f} MB/s   '.format(
+            self.label, self.bytes / 1024.0 ** 2, self.bytes / 1024.0 ** 2 / elapsed))
+        sys.stderr.flush()
+
+    def done(self):
+        self.show()
+        sys.stderr.write('\n')
+
+
+def start_local_backup():
+    return subprocess.Popen('python manage.py backupdb', shell=True)
+
+
+def wait_local_backup(backup):
+    if backup.wait() != 0:
+        abort(red("The local backup failed, the local database wasn't touched.", bold=True))
+
+
+def get_compressor():
+    """
+    Returns the commands to compress on the remote and decompress locally, or
+    None when pg_dump should compress by itself.
+    """
+    available = run('command -v {0}'.format(' '.join(c[0] for c in COMPRESSORS)),
+                    quiet=True)
+    remote_programs = set(os.path.basename(path) for path in available.split())
+    for name, compress, decompress in COMPRESSORS:
+        if name in remote_programs and find_executable(decompress.split()[0]):
+            return compress, decompress
+    return None
+
+
+def spool_until(source, is_ready, open_sink, progress=None, chunk_size=CHUNK_SIZE):
+    """
+    Copies the file descriptor ``source`` to the file returned by
+    ``open_sink()``, which is only called once ``is_ready()``.  What arrives
+    before is kept in a temporary file.  Returns the sink.
+    """
+    spool = tempfile.TemporaryFile()
+    sink = None
+    while True:
+        data = os.read(source, chunk_size)
+        if progress is not None:
+            progress.update(len(data))
+        if sink is None and (is_ready() or not data):
+            sink = open_sink()
+            spool.seek(0)
+            while True:
+                spooled = spool.read(chunk_size)
+                if not spooled:
+                    break
+                sink.write(spooled)
+            spool.close()
+        if not data:
+            return sink
+        if sink is None:
+            spool.write(data)
+        else:
+            sink.write(data)
+
+
+def stream_db(remote, db_name, local_db_name):
+    """
+    Restores the remote database in the local one through a pipe, without
+    temporary dump file.  The stream can't be restored in parallel nor
+    resumed, see ``sync_db_directory`` for that.
+    """
+    destination, port = split_host_string(remote)
+    compressor = get_compressor()
+    dump = 'pg_dump -Fc {0}'.format(pipes.quote(db_name))
+    if compressor:
+        dump = 'pg_dump -Fc -Z0 {0} | {1}'.format(pipes.quote(db_name), compressor[0])
+    commands = [['ssh', '-p', port, destination, dump]]
+    if compressor:
+        commands.append(compressor[1].split())
+
+    backup = start_local_backup()
+    processes = []
+    stdin = None
+    for command in commands:
+        process = subprocess.Popen(command, stdin=stdin, stdout=subprocess.PIPE)
+        if stdin is not None:
+            # Only the next process reads it
+            stdin.close()
+        stdin = process.stdout
+        processes.append(process)
+
+    def open_restore():
+        wait_local_backup(backup)
+        restore = subprocess.Popen(
+            'pg_restore {0} -d {1}'.format(RESTORE_OPTIONS, pipes.quote(local_db_name)),
+            shell=True, stdin=subprocess.PIPE)
+        processes.append(restore)
+        return restore.stdin
+
+    progress = Progress('Streaming {0}'.format(db_name))
+    try:
+        sink = spool_until(stdin.fileno(), lambda: backup.poll() is not None,
+                           open_restore, progress)
+        sink.close()
+        progress.done()
+    except:
+        # Don't leave the dump running
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+        raise
+    finally:
+        returncodes = [process.wait() for process in processes]
+        backup.wait()
+
+    names = [command[0] for command in commands] + ['pg_restore']
+    for name, returncode in zip(names, returncodes)[:-1]:
+        if returncode:
+            abort(red('The database sync failed, {0} exited with {1}'.format(name, returncode),
+                      bold=True))
+    if returncodes[-1]:
+        print red('pg_restore reported errors, see above.')
+
+
+def sync_db_directory(remote, remote_project_path, remote_backups_dir, db_name,
+                      local_backups_dir, local_db_name, jobs=DEFAULT_JOBS, resume=True):
+    """
+    Dumps the remote database in directory format with ``jobs`` workers,
+    transfers it with rsync and restores it with ``jobs`` workers.
+
+    An interrupted transfer is resumed by running it again: a complete dump
+    left on the remote is reused and rsync keeps the partial files.
+    """
+    destination, port = split_host_string(remote)
+    remote_dir = os.path.join(remote_backups_dir, DUMP_DIRECTORY)
+    local_dir = os.path.join(local_backups_dir, DUMP_DIRECTORY)
+    complete = os.path.join(remote_dir, '.complete')
+
+    backup = start_local_backup()
+    try:
+        with cd(remote_project_path):
+            if resume and run('test -e {0}'.format(complete), quiet=True).succeeded:
+                dumped_at = run('date -r {0}'.format(complete), quiet=True)
+                print 'Resuming the transfer of the dump from {0}'.format(dumped_at)
+            else:
+                tmp_dir = remote_dir + '.tmp'
+                run('rm -rf {tmp} {dir} && pg_dump -Fd -j {jobs} -f {tmp} {db} && '
+                    'touch {tmp}/.complete && mv {tmp} {dir}'.format(
+                        tmp=tmp_dir, dir=remote_dir, jobs=int(jobs), db=pipes.quote(db_name)))
+
+        if not os.path.isdir(local_dir):
+            os.makedirs(local_dir)
+        local('rsync -a --delete --progress --partial-dir=.rsync-partial -e {ssh} '
+              '{remote}:{remote_dir}/ {local_dir}/'.format(
+                  ssh=pipes.quote('ssh -p {0}'.format(port)),
+                  remote=destination,
+                  remote_dir=os.path.join(remote_project_path, remote_dir),
+                  local_dir=local_dir))
+    finally:
+        wait_local_backup(backup)
+
+    with settings(warn_only=True):
+        restore = local('pg_restore {options} -j {jobs} -d {db} {dir}'.format(
+            options=RESTORE_OPTIONS, jobs=int(jobs), db=pipes.quote(local_db_name), dir=local_dir))
+    if restore.failed:
+        print red('pg_restore reported errors, see above.')
+
+    with cd(remote_project_path):
+        run('rm -rf {0}'.format(remote_dir))
+    local('rm -rf {0}'.format(local_dir))
@@ -0,0 +1,181 @@
+"""
+Incremental media syncs from a remote server.
+
+A manifest of the ``(size, mtime)`` of the files pulled by the last sync is
+kept locally, next to the time of the remote listing.  The next sync only asks
+the remote for the files changed since then (``find -newerct``), and pulls
+them with several rsync processes in parallel.
+"""
+import fnmatch
+import hashlib
+import json
+import os
+import pipes
+import subprocess
+import tempfile
+
+from fabric.api import abort
+from fabric.colors import red
+
+from fusionbox.fabric.utils import cache_path, split_host_string
+
+
+DEFAULT_JOBS = 4
+# Files changed while the remote was listed are listed again next time
+LISTING_MARGIN = 2
+
+
+def get_manifest_path(remote, remote_path, local_dir):
+    key = '{0}:{1} {2}'.format(remote, remote_path, os.path.abspath(local_dir))
+    return cache_path('media', hashlib.sha1(key).hexdigest() + '.json')
+
+
+def read_manifest(path):
+    """
+    Returns the time of the last listing and the dict of path to ``(size,
+    mtime)`` of the synced files.  Returns ``(None, {})`` without manifest.
+    """
+    try:
+        with open(path) as f:
+            manifest = json.load(f)
+    except IOError:
+        return None, {}
+    return manifest['listed_at'], dict((p, tuple(v)) for p, v in manifest['files'].items())
+
+
+def write_manifest(path, listed_at, files):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'listed_at': listed_at, 'files': files}, f)
+    os.rename(tmp_path, path)
+
+
+def parse_listing(listing):
+    """
+    Parses the output of ``list_remote_command`` into the time of the listing
+    and a dict of path to ``(size, mtime)``.
+    """
+    fields = listing.split('\0')
+    listed_at = int(fields[0])
+    files = {}
+    for path, size, mtime in zip(fields[1::3], fields[2::3], fields[3::3]):
+        files[path] = (int(size), int(float(mtime)))
+    return listed_at, files
+
+
+def list_remote_command(remote_path, since=None):
+    newer = ''
+    if since is not None:
+        newer = '-newerct @{0}'.format(int(since) - LISTING_MARGIN)
+    return ("cd {path} && printf '%s\\0' \"$(date +%s)\" && "
+            "find . -type f {newer} -printf '%P\\0%s\\0%T@\\0'").format(
+                path=pipes.quote(remote_path), newer=newer)
+
+
+def list_remote(remote, remote_path, since=None):
+    """
+    Lists the files of ``remote_path`` changed since the timestamp ``since``,
+    or all of them.
+    """
+    destination, port = split_host_string(remote)
+    listing = subprocess.check_output(['ssh', '-p', port, destination,
+                                       list_remote_command(remote_path, since)])
+    return parse_listing(listing)
+
+
+def sampled(path, sample):
+    """
+    Picks a stable ``sample`` fraction of the paths.
+    """
+    return int(hashlib.md5(path).hexdigest()[:8], 16) < sample * 0x100000000
+
+
+def select_files(files, synced, max_size=None, include=None, exclude=None, sample=None):
+    """
+    Returns the paths of ``files`` that changed since they were ``synced``,
+    filtered by size, by globs and sampled.
+    """
+    selected = []
+    for path, (size, mtime) in files.items():
+        if synced.get(path) == (size, mtime):
+            continue
+        if max_size is not None and size > max_size:
+            continue
+        if include and not any(fnmatch.fnmatch(path, pattern) for pattern in include):
+            continue
+        if exclude and any(fnmatch.fnmatch(path, pattern) for pattern in exclude):
+            continue
+        if sample is not None and not sampled(path, sample):
+            continue
+        selected.append(path)
+    return selected
+
+
+def shard(paths, files, jobs):
+    """
+    Splits the paths in ``jobs`` lists of about the same total size.
+    """
+    shards = [[] for _ in range(jobs)]
+    sizes = [0] * jobs
+    for path in sorted(paths, key=lambda path: files[path][0], reverse=True):
+        i = sizes.index(min(sizes))
+        shards[i].append(path)
+        sizes[i] += files[path][0]
+    return [s for s in shards if s]
+
+
+def transfer(remote, remote_path, local_dir, shards):
+    """
+    Pulls each shard of paths with its own rsync process.  Returns the paths
+    that were transferred.
+    """
+    destination, port = split_host_string(remote)
+    processes = []
+    try:
+        for paths in shards:
+            files_from = tempfile.NamedTemporaryFile()
+            files_from.write('\0'.join(paths))
+            files_from.flush()
+            process = subprocess.Popen([
+                'rsync', '-a', '--from0', '--files-from=' + files_from.name,
+                '-e', 'ssh -p {0}'.format(port),
+                '{0}:{1}/'.format(destination, remote_path), local_dir + '/',
+            ])
+            processes.append((paths, files_from, process))
+    finally:
+        transferred = []
+        for paths, files_from, process in processes:
+            if process.wait() == 0:
+                transferred.extend(paths)
+            files_from.close()
+    if len(processes) < len(shards) or len(transferred) < sum(len(paths) for paths in shards):
+        abort(red("Some of the media files couldn't be transferred, run the sync again.",
+                  bold=True))
+    return transferred
+
+
+def sync_media_incremental(remote, remote_path, local_dir, jobs=DEFAULT_JOBS, full=False,
+                           max_size=None, include=None, exclude=None, sample=None):
+    """
+    Pulls the media files changed since the last sync.  ``full`` lists all the
+    remote files again, to pick up the files left out by filters before.
+    """
+    manifest_path = get_manifest_path(remote, remote_path, local_dir)
+    last_listed_at, synced = read_manifest(manifest_path)
+    if full:
+        last_listed_at = None
+
+    listed_at, files = list_remote(remote, remote_path, since=last_listed_at)
+    paths = select_files(files, synced, max_size, include, exclude, sample)
+    print '{0} changed files out of {1} listed, {2:.1f} MB'.format(
+        len(paths), len(files), sum(files[p][0] for p in paths) / 1024.0 ** 2)
+
+    if paths:
+        if not os.path.isdir(local_dir):
+            os.makedirs(local_dir)
+        transfer(remote, remote_path, local_dir, shard(paths, files, jobs))
+    synced.update((path, files[path]) for path in paths)
+    write_manifest(manifest_path, listed_at, synced)
@@ -1,42 +1,120 @@
 import os
 import re
+import ast
 import contextlib
+import fnmatch
 import tempfile
 import shutil
 import getpass
 import sys
-import atexit
+import time
+import functools
+import hashlib
+import pipes
+import pkgutil
 from datetime import timedelta
 from StringIO import StringIO
 from collections import namedtuple
 
-from fabric.api import task, run, env, local, sudo, settings, get
-from fabric.context_managers import cd, prefix, hide, lcd
-from fabric.decorators import roles
+from fabric.api import task, env, local, settings, get, put, execute
+from fabric.context_managers import cd, prefix, hide
+from fabric.decorators import roles, parallel, runs_once
 from fabric.contrib.project import rsync_project
-from fabric.contrib.files import append, exists
 from fabric.contrib.console import confirm
-from fabric.sftp import SFTP
 from fabric.colors import red, blue
 from fabric.utils import abort
+from fabric.state import output
 
-__all__ = ['stage', 'deploy', 'fetch_dbdump', 'cleanup', 'reload_last_push',
-           'rollback', 'django']
+from fusionbox.fabric import dumpcache
+from fusionbox.fabric.extract import extract_tree, DEFAULT_MAX_SIZE as EXTRACT_CACHE_SIZE
+from fusionbox.fabric.git import get_tree_hash, has_tree, get_tree_listing, parse_tree_listing
+from fusionbox.fabric.timing import Timer, timed, phase, count_bytes, run, sudo
+from fusionbox.fabric.utils import run_batch
+
+__all__ = ['stage', 'deploy', 'prepare', 'activate', 'fetch_dbdump', 'cleanup',
+           'reload_last_push', 'rollback', 'django', 'history']
 
 
 PROJECTS_PATH = '/var/www/'
 DEFAULT_HISTORY_SIZE = 3
+DEFAULT_POOL_SIZE = 5
 DEPLOYMENT_LOCK = 'deployment.lock'
 DEPLOY_LOG = 'deploy.log'
+DEPLOY_TIMINGS = 'deploy-timings.log'
+TRASH_DIR = '.trash'
 SRC_DIR = 'src'
 REQUIREMENT_FILE = 'requirements.txt'
 SRC_DIRNAMES_RE = re.compile(r'^%s\.(\d{5})$' % re.escape(SRC_DIR))
 VIRTUALENV = 'virtualenv'
+VIRTUALENVS = 'virtualenvs'
+DEFAULT_VIRTUALENV_MODE = 'shared'
+# Link from each src directory to its virtualenv snapshot
+SRC_VIRTUALENV = '.virtualenv'
+# Copy of the requirements a snapshot was built from, written once it's complete
+SNAPSHOT_REQUIREMENTS = '.requirements'
+REQUIREMENT_COMMENT_RE = re.compile(r'(^|\s)#.*$')
+REQUIREMENT_NAME_RE = re.compile(r'^([A-Za-z0-9][A-Za-z0-9._-]*)')
+REQUIREMENT_EGG_RE = re.compile(r'#egg=([A-Za-z0-9][A-Za-z0-9._-]*)')
+# Includes and paths, relative to the requirements file in the tree
+REQUIREMENT_LOCAL_RE = re.compile(
+    r'^(?:-r|-c|--requirement\b|--constraint\b)|^(?:(?:-e|--editable)[=\s]*)?(?:[.~/]|file:)')
+VASSAL_TEMPLATES = [
+    '/etc/vassals/{name}.ini',
+    '/etc/uwsgi-emperor/vassals/{name}.ini',
+]
+DEFAULT_UWSGI_FIFO = '/run/uwsgi/{name}.fifo'
+READY_TIMEOUT = 60
+READY_INTERVAL = 0.5
+READY_REQUEST_TIMEOUT = 10
+DEFAULT_WARMUP_REQUESTS = 4
+# Response header of the warmup urls naming the src directory of the code,
+# when env.release_header asks to check it
+DEFAULT_RELEASE_HEADER = 'X-Release'
+FIFO_TIMEOUT = 10
+DEPLOY_LOG_TZ = 'America/Denver'
+DEFAULT_UPLOAD_METHOD = 'manifest'
+MANIFEST_FILE = '.deploy-manifest'
+# Bare repository env.upload_method = 'git' pushes to
+GIT_MIRROR = 'mirror.git'
+GIT_MIRROR_REF = 'refs/heads/deployed'
+REGULAR_FILE_MODES = ('100644', '100755')
+RSYNC_STATS_RE = re.compile(r'^Total bytes (?:sent|received): ([\d,]+)')
+WHEELHOUSE = 'wheelhouse'
+FINGERPRINTS_FILE = '.deploy-fingerprints'
+BYTECODE_SCRIPT = '.deploy-bytecode.py'
+DUMPS_DIR = 'dumps'
+# Deterministic compressors, the checksums of the dumps identify their content
+DUMP_COMPRESSORS = [
+    ('zstd', 'zstd -q -T0 -3 -c', '.sql.zst'),
+    ('pigz', 'pigz -n -c', '.sql.gz'),
+    ('gzip', 'gzip -n -c', '.sql.gz'),
+]
+# What push needs to know has changed, and the files it depends on
+FINGERPRINT_PATTERNS = [
+    ('requirements', [REQUIREMENT_FILE]),
+    ('migrations', ['migrations/*', '*/migrations/*']),
+    # fnmatch's * also matches /, so the bare names need their own patterns
+    ('settings', ['settings.py', '*/settings.py', 'settings/*.py', '*/settings/*.py']),
+    ('static', ['static/*', '*/static/*']),
+]
+# The changes after which to migrate and to collect the static files
+MIGRATE_CHANGES = frozenset(['requirements', 'migrations', 'settings'])
+COLLECTSTATIC_CHANGES = frozenset(['requirements', 'settings', 'static'])
+RELEASE_FILE = '.deploy-release'
+# diffsettings prints pathlib paths with their repr
+STATIC_ROOT_PATH_RE = re.compile(r'^(?:Posix|Windows)?Path\((.*)\)$')
+# get_static_root couldn't tell where the static files are collected
+UNKNOWN_STATIC_ROOT = object()
+RESERVE_ATTEMPTS = 5
+
+
+def get_project_path():
+    return os.path.join(PROJECTS_PATH, env.project_name)
 
 
 @contextlib.contextmanager
 def cd_project(directory=None):
-    path = os.path.join(PROJECTS_PATH, env.project_name)
+    path = get_project_path()
     if directory is not None:
         path = os.path.join(path, directory)
     with cd(path):
@@ -52,34 +130,176 @@ def use_tmp_dir():
         shutil.rmtree(directory)
 
 
+def use_virtualenv_snapshots():
+    """
+    Whether each src directory has its own virtualenv snapshot
+    (env.virtualenv_mode = 'snapshot') instead of sharing one virtualenv.
+    """
+    return env.get('virtualenv_mode', DEFAULT_VIRTUALENV_MODE) == 'snapshot'
+
+
 @contextlib.contextmanager
-def use_virtualenv():
-    activate_script = os.path.join(PROJECTS_PATH, env.project_name,
-        'virtualenv', 'bin', 'activate')
-    with prefix('source {}'.format(activate_script)):
+def use_virtualenv(directory=SRC_DIR):
+    """
+    Activate the virtualenv of the src directory directory.
+
+    Without snapshots, and for the src directories deployed before them, this
+    is the shared virtualenv.
+    """
+    shared_script = os.path.join(PROJECTS_PATH, env.project_name,
+        VIRTUALENV, 'bin', 'activate')
+    if use_virtualenv_snapshots():
+        activate_script = os.path.join(PROJECTS_PATH, env.project_name, directory,
+                                       SRC_VIRTUALENV, 'bin', 'activate')
+        command = 'if [ -e {snapshot} ]; then source {snapshot}; else source {shared}; fi'.format(
+            snapshot=activate_script, shared=shared_script)
+    else:
+        command = 'source {}'.format(shared_script)
+    with prefix(command):
         yield
 
 
-@contextlib.contextmanager
-def atomic_src_update():
+class RemoteState(object):
+    """
+    The src directories, deployment lock and last deploy of a host.
+
+    They are read in a single round trip the first time they're needed, then
+    kept up to date by the functions that change them.
+    """
+    def __init__(self):
+        self._values = None
+
+    def load(self):
+        with contextlib.nested(cd_project(), phase('remote_state')):
+            probe = run_batch([
+                ('directories', 'ls -1d {src}.*'.format(src=SRC_DIR)),
+                ('current', 'readlink {src}'.format(src=SRC_DIR)),
+                ('lock', 'readlink {lock}'.format(lock=DEPLOYMENT_LOCK)),
+                ('deploy_log', deploy_log_command(1)),
+                ('vassal_file', find_vassal_command()),
+            ])
+        deploy_log = parse_deploy_log(probe['deploy_log'].stdout)
+        self._values = {
+            'directories': sorted(d for d in probe['directories'].stdout.split()
+                                  if SRC_DIRNAMES_RE.match(d)),
+            'current': os.path.basename(probe['current'].stdout.strip()) or None,
+            'lock': probe['lock'].stdout.strip() or None,
+            'last_deploy': deploy_log[-1] if deploy_log else None,
+            'vassal_file': probe['vassal_file'].stdout.strip(),
+        }
+
+    def _get(self, name):
+        if self._values is None:
+            self.load()
+        return self._values[name]
+
+    def _set(self, **values):
+        # Not read yet, it will be read as it is now
+        if self._values is not None:
+            self._values.update(values)
+
+    @property
+    def directories(self):
+        """
+        The names of the src directories, oldest first
+        """
+        return list(self._get('directories'))
+
+    @property
+    def current(self):
+        """
+        The src directory the src symlink points to, None if there's none
+        """
+        return self._get('current')
+
+    @property
+    def lock(self):
+        """
+        The directory the deployment lock points to, None if it isn't held
+        """
+        return self._get('lock')
+
+    @property
+    def last_deploy(self):
+        return self._get('last_deploy')
+
+    @property
+    def vassal_file(self):
+        return self._get('vassal_file')
+
+    def add_directory(self, directory):
+        if self._values is not None:
+            self._set(directories=sorted(set(self.directories) | set([directory])))
+
+    def remove_directories(self, directories):
+        if self._values is not None:
+            self._set(directories=[d for d in self.directories if d not in directories])
+
+    def locked(self, directory):
+        self._set(lock=directory)
+
+    def switched(self):
+        if self._values is not None:
+            self._set(current=self.lock, lock=None)
+
+    def logged(self, entry):
+        self._set(last_deploy=entry)
+
+
+_remote_states = {}
+
+
+def get_remote_state():
+    """
+    Returns the RemoteState of the current host
+    """
+    key = (env.host_string, get_project_path())
+    if key not in _remote_states:
+        _remote_states[key] = RemoteState()
+    return _remote_states[key]
+
+
+def forget_remote_state():
+    _remote_states.pop((env.host_string, get_project_path()), None)
+
+
+def fresh_remote_state(func):
+    """
+    Read the state of the host again on each call of func, someone else might
+    have deployed since it was read.  The parallel workers also start from
+    the state of their own host.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        forget_remote_state()
+        return func(*args, **kwargs)
+    return wrapper
+
+
+def get_next_src_dir():
     numbers_list = get_src_dir_numbers()
-    directory = '{src}.{number:05d}'.format(
+    return '{src}.{number:05d}'.format(
         src=SRC_DIR, number=max(numbers_list + [0]) + 1)
 
-    if env.force:
-        run('rm -f {lock}'.format(lock=DEPLOYMENT_LOCK))
 
+@timed('lock')
+def acquire_deployment_lock(directory):
+    """
+    Take the deployment lock by pointing it to the directory being deployed
+    """
     with settings(warn_only=True):
-        result = run('ln -ns {directory} {lock}'.format(
+        # -f replaces the lock if we are forcing
+        result = run('ln -ns{force} {directory} {lock}'.format(
+            force='f' if env.force else '',
             directory=directory,
             lock=DEPLOYMENT_LOCK
             ))
 
     if result.failed:
         with hide('running', 'stdout', 'stderr'):
-            current_time = int(run('date +%s'))
-            locked_at = int(run('stat -c "%Y" {lock}'.format(lock=DEPLOYMENT_LOCK)))
-            locked_for = timedelta(seconds=current_time-locked_at)
+            locked_for = timedelta(seconds=int(run(
+                'echo $(( $(date +%s) - $(stat -c "%Y" {lock}) ))'.format(
+                    lock=DEPLOYMENT_LOCK))))
             abort(red(
                 "Someone else is holding the deployment lock (For {locked_for})."
                 " Rerun with force=1 to kick them off (could be dangerous).".format(
@@ -87,14 +307,35 @@ def atomic_src_update():
                 ),
                 bold=True
             ))
+    get_remote_state().locked(directory)
+
+
+def release_deployment_lock():
+    run('unlink {lock}'.format(lock=DEPLOYMENT_LOCK))
+    get_remote_state().locked(None)
+
+
+@timed('switch_src')
+def commit_deployment_lock():
+    """
+    Atomically replace the src symlink with the deployment lock
+    """
+    run('mv -f -T {lock} {src}'.format(lock=DEPLOYMENT_LOCK, src=SRC_DIR))
+    get_remote_state().switched()
+
+
+@contextlib.contextmanager
+def atomic_src_update():
+    directory = reserve_src_dir()
+    acquire_locked_src_dir(directory)
 
     try:
         yield directory
     except:
-        run('unlink {lock}'.format(lock=DEPLOYMENT_LOCK))
+        release_deployment_lock()
         raise
     else:
-        run('mv -f -T {lock} {src}'.format(lock=DEPLOYMENT_LOCK, src=SRC_DIR))
+        commit_deployment_lock()
 
 
 def is_true(b):
@@ -105,29 +346,43 @@ def is_true(b):
 
 
 def get_src_dir_list():
-    with cd_project() as path:
-        sftp = SFTP(env.host_string)
-        # Honor cd()
-        path = os.path.join(env.cwd, path)
-        glob_pattern = os.path.join(path, '{}.*'.format(SRC_DIR))
-        return sftp.glob(glob_pattern)
+    """
+    Returns the names of the src directories, oldest first
+    """
+    return get_remote_state().directories
 
 
 def get_latest_src_dir(position=1):
-    src_directories = sorted(get_src_dir_list())
-    return src_directories[-position]
+    return get_src_dir_list()[-position]
+
+
+def get_current_src_dir():
+    """
+    Returns the src directory the src symlink points to.  Newer ones may be
+    prepared but not activated, or still being built.
+    """
+    current = get_remote_state().current
+    if current is None:
+        abort(red("There's no deployed src directory", bold=True))
+    return current
 
 
 def get_src_dir_numbers():
-    dirname_list = (os.path.basename(d) for d in get_src_dir_list())
-    return [int(SRC_DIRNAMES_RE.match(d).group(1))
-            for d in dirname_list if SRC_DIRNAMES_RE.match(d) is not None]
+    return [int(SRC_DIRNAMES_RE.match(d).group(1)) for d in get_src_dir_list()]
 
 
 def get_git_ref(name):
     return local('git rev-parse {}'.format(name), capture=True)
 
 
+@runs_once
+def fetch_remotes():
+    """
+    Fetch all the git remotes, once for all the hosts of the task
+    """
+    local('git fetch --all')
+
+
 def get_django_version():
     django_version_str = run('django-admin version')
     # Parse django version
@@ -138,70 +393,571 @@ def get_django_version():
     return tuple(int(g) for g in m.groups())
 
 
-def generate_pyc():
+@timed('generate_pyc')
+def generate_pyc(previous_dir=None):
+    """
+    Compile the python files of this directory and the editable packages of
+    the virtualenv, with env.pyc_jobs processes (one per core by default).
+
+    Only the files without up to date bytecode are compiled, the bytecode of
+    the files hard linked from previous_dir is hard linked too.
+    """
+    script = os.path.join(get_project_path(), BYTECODE_SCRIPT)
+    put_string(pkgutil.get_data('fusionbox.fabric', 'bytecode.py'), script)
+    directories = ['.' if previous_dir is None else '.:' + previous_dir, '"$VIRTUAL_ENV/src"']
     # compilation can fail
     with settings(warn_only=True), prefix('umask 027'):
-        run('python -m compileall . > /dev/null')
+        run('python {script} --jobs {jobs:d} {directories}'.format(
+            script=script, jobs=int(env.get('pyc_jobs', 0)), directories=' '.join(directories)))
 
 
-@contextlib.contextmanager
-def cd_git_extract(gitref, tmp_dir=tempfile.mkdtemp()):
+@timed('extract')
+def get_extract_dir(gitref):
+    """
+    Returns a local directory with the files of gitref, from the extraction
+    cache.
+    """
+    return extract_tree(gitref, max_size=int(env.get('extract_cache_size', EXTRACT_CACHE_SIZE)))
+
+
+def get_rsync_source(gitref):
     # last argument adds trailing slash, which is needed by rsync
-    extract_dir = os.path.join(tmp_dir, gitref, '')
+    return os.path.join(get_extract_dir(gitref), '')
+
+
+def put_string(content, remote_path):
+    put(StringIO(content), remote_path)
+    count_bytes(len(content))
+
 
-    if not os.path.exists(extract_dir):
-        os.makedirs(extract_dir)
-        local('git archive {ref} | tar x -C {dir}'.format(ref=gitref, dir=extract_dir))
-        # removes the tmpdir, other registered functions will do nothing
-        atexit.register(shutil.rmtree, tmp_dir, ignore_errors=True)
+def rsync_upload(**kwargs):
+    """
+    rsync_project, counting the bytes it transferred
+    """
+    kwargs['extra_opts'] = kwargs.get('extra_opts', '') + ' --stats'
+    result = rsync_project(capture=True, **kwargs)
+    # Show what rsync did, but not the statistics
+    itemized = result.split('\nNumber of files:')[0].strip()
+    if itemized and output.stdout:
+        print itemized
+    for line in result.splitlines():
+        match = RSYNC_STATS_RE.match(line)
+        if match:
+            count_bytes(int(match.group(1).replace(',', '')))
+
+
+def upload_with_rsync(directory, gitref, previous_dir, entries):
+    """
+    Upload the whole extracted tree, rsync compares the checksum of every file
+    """
+    # Remove global permissions, set group to www-data
+    extra_opts_list = [
+        '-g',
+        '--chown=:www-data',
+        '--chmod=o-rwx',
+    ]
+    if previous_dir:
+        # Hard link from latest src dir if file is unchanged
+        extra_opts_list.append(
+            '--link-dest={}'.format(os.path.join(env.cwd, previous_dir)),
+        )
 
-    with lcd(extract_dir):
-        yield extract_dir
+    rsync_upload(
+        local_dir=get_rsync_source(gitref),
+        remote_dir=os.path.join(env.cwd, directory),
+        delete=True,
+        extra_opts=' '.join(extra_opts_list),
+        # Fabric defaults to -pthrvz
+        # -t preserve the modification time. We want to ignore that.
+        # -v print the file being updated
+        # We replaced these by:
+        # -c will use checksum to compare files
+        # -i will print what kind of transfer has been done (copy/upload/...)
+        default_opts='-pchriz',
+    )
+
+
+def get_unchanged_files(entries, previous_entries):
+    """
+    Returns the regular files of the tree entries that are the same in
+    previous_entries, and the ones that changed.
+    """
+    # rsync without -l skips the symlinks, so do we
+    files = [path for path, (mode, _) in entries.items() if mode in REGULAR_FILE_MODES]
+    unchanged = [path for path in files if previous_entries.get(path) == entries[path]]
+    changed = [path for path in files if previous_entries.get(path) != entries[path]]
+    return unchanged, changed
+
+
+def link_unchanged_files(directory, previous_dir, unchanged):
+    """
+    Hard link the unchanged files from previous_dir into the reserved
+    directory
+    """
+    if unchanged:
+        link_list = os.path.join(directory, '.deploy-unchanged')
+        put_string('\0'.join(unchanged), link_list)
+        with prefix('umask 027'):
+            run('cd {old} && xargs -0 -a ../{list} cp -l --parents -t ../{new} && rm ../{list}'.format(
+                old=previous_dir, new=directory, list=link_list))
+
+
+def upload_with_manifest(directory, gitref, previous_dir, entries):
+    """
+    Compare the tree with the manifest of the previous src dir, hard link the
+    unchanged files from it and only upload the changed ones.
+
+    Falls back to upload_with_rsync when there's no previous manifest.
+    """
+    previous_entries = read_manifest(previous_dir) if previous_dir else None
+    if previous_entries is None:
+        return upload_with_rsync(directory, gitref, previous_dir, entries)
+
+    unchanged, changed = get_unchanged_files(entries, previous_entries)
+    link_unchanged_files(directory, previous_dir, unchanged)
+
+    if changed:
+        with tempfile.NamedTemporaryFile() as files_from:
+            files_from.write('\0'.join(changed))
+            files_from.flush()
+            rsync_upload(
+                local_dir=get_rsync_source(gitref),
+                remote_dir=os.path.join(env.cwd, directory),
+                extra_opts=' '.join([
+                    '-g',
+                    '--chown=:www-data',
+                    '--chmod=o-rwx',
+                    '--from0',
+                    '--files-from={}'.format(files_from.name),
+                ]),
+                # No -c, we already know that these files changed
+                default_opts='-piz',
+            )
+
+
+def get_mirror_url():
+    """
+    Returns the url local git pushes to the mirror of the project with.
+    """
+    return 'ssh://{user}@{host}:{port}{path}'.format(
+        user=env.user, host=env.host, port=env.port,
+        path=os.path.join(get_project_path(), GIT_MIRROR))
+
+
+def get_git_ssh_command():
+    """
+    Returns the ssh command git pushes with, connecting like fabric does
+    with env.key_filename and env.gateway.  It never prompts, a host that
+    needs env.password can't be pushed to.
+    """
+    options = ['-o BatchMode=yes']
+    key_filenames = env.get('key_filename') or []
+    if isinstance(key_filenames, basestring):
+        key_filenames = [key_filenames]
+    options.extend('-i {}'.format(pipes.quote(os.path.expanduser(key)))
+                   for key in key_filenames)
+    if env.get('gateway'):
+        options.append('-o ProxyJump={}'.format(pipes.quote(env.gateway)))
+    return 'ssh {}'.format(' '.join(options))
+
+
+@timed('push_objects')
+def push_to_mirror(gitref):
+    """
+    Push the commit to the bare git mirror of the project, creating it if
+    needed.  git only sends the objects the mirror doesn't have yet, as a
+    thin pack.
+
+    Returns the pushed commit, None if the server doesn't have git or the
+    push failed.
+    """
+    with settings(hide('stdout'), warn_only=True):
+        created = run('command -v git > /dev/null && '
+                      '{{ test -d {mirror} || git init --quiet --bare {mirror}; }}'.format(
+                          mirror=GIT_MIRROR))
+    if created.failed:
+        return None
+    commit = get_git_ref(gitref + '^{commit}')
+    # The ref keeps the objects of the last upload from being pruned, and
+    # tells the next push what the mirror already has.
+    with settings(hide('warnings'), warn_only=True):
+        pushed = local('GIT_SSH_COMMAND={ssh} git push --quiet --force {url} {commit}:{ref}'.format(
+            ssh=pipes.quote(get_git_ssh_command()), url=get_mirror_url(), commit=commit,
+            ref=GIT_MIRROR_REF))
+    return commit if pushed.succeeded else None
+
+
+def upload_with_git(directory, gitref, previous_dir, entries):
+    """
+    Push the missing git objects to a bare mirror on the server, hard link the
+    unchanged files from the previous src dir and check out the changed ones
+    from the mirror.
+
+    Falls back to upload_with_manifest when the server doesn't have git, or
+    git can't push to it.
+    """
+    commit = push_to_mirror(gitref)
+    if commit is None:
+        print red("Couldn't push to the git mirror of {host}, uploading with the manifest"
+                  " instead".format(host=env.host))
+        return upload_with_manifest(directory, gitref, previous_dir, entries)
+
+    previous_entries = read_manifest(previous_dir) if previous_dir else None
+    unchanged, changed = get_unchanged_files(entries, previous_entries or {})
+    link_unchanged_files(directory, previous_dir, unchanged)
+
+    if changed:
+        checkout_list = os.path.join(directory, '.deploy-changed')
+        put_string('\0'.join(changed), checkout_list)
+        git = 'GIT_INDEX_FILE={index} git --git-dir={mirror}'.format(
+            index=os.path.join(env.cwd, directory, '.deploy-index'),
+            mirror=os.path.join(env.cwd, GIT_MIRROR))
+        # Through a throwaway index, the mirror has no work tree.  By commit,
+        # another upload may have moved the ref since.
+        with prefix('umask 027'):
+            run('{git} read-tree {commit} && '
+                '{git} --work-tree={new} checkout-index -f -z --stdin < {list} && '
+                'rm {new}/.deploy-index {list}'.format(
+                    git=git, commit=commit, new=directory, list=checkout_list))
+
+
+def get_upload_function():
+    """
+    Returns the function used to upload the source based on
+    env.upload_method (manifest by default).
+    """
+    upload_method = env.get('upload_method', DEFAULT_UPLOAD_METHOD)
+    try:
+        return globals()['upload_with_{0}'.format(upload_method)]
+    except KeyError:
+        raise NameError('Please set env.upload_method to an accepted value.  Accepted values: {0}'.format([
+            i[len('upload_with_'):]
+            for i in globals().keys()
+            if i.startswith('upload_with_')
+        ]))
 
 
+def read_manifest(directory):
+    """
+    Returns the tree entries deployed in directory, None if it has no manifest
+    """
+    path = os.path.join(directory, MANIFEST_FILE)
+    with settings(hide('running', 'stdout', 'stderr', 'warnings'), warn_only=True):
+        header = run('head -n 1 {}'.format(path))
+    if header.failed or not header.startswith('tree '):
+        return None
+
+    tree = header[len('tree '):]
+    if has_tree(tree):
+        # No need to download what we already know
+        return parse_tree_listing(get_tree_listing(tree))
+
+    manifest = StringIO()
+    with hide('running'):
+        get(path, manifest)
+    count_bytes(len(manifest.getvalue()))
+    return parse_tree_listing(manifest.getvalue().split('\n', 1)[1])
+
+
+@timed('upload_source')
 def upload_source(gitref, directory):
     """
     Push the new code into a new directory
+
+    Returns the fingerprints of the new code.
     """
-    with cd_git_extract(gitref) as extract_dir:
-        # Remove global permissions, set group to www-data
-        extra_opts_list = [
-            '-g',
-            '--chown=:www-data',
-            '--chmod=o-rwx',
-        ]
-        src_directories = sorted(get_src_dir_list())
-        if src_directories:
-            # Hard link from latest src dir if file is unchanged
-            extra_opts_list.append(
-                '--link-dest={}'.format(src_directories[-1]),
-            )
+    listing = get_tree_listing(gitref)
+    entries = parse_tree_listing(listing)
+    # The deployed directory, the others might be reserved or dirty
+    previous_dir = get_remote_state().current
+    get_upload_function()(directory, gitref, previous_dir, entries)
+    get_remote_state().add_directory(directory)
+
+    # Allows the next upload to know what's in this directory
+    put_string('tree {tree}\n{listing}'.format(tree=get_tree_hash(gitref), listing=listing),
+               os.path.join(directory, MANIFEST_FILE))
+    fingerprints = compute_fingerprints(entries)
+    run("printf '%s\\n' {fingerprints} > {new}/{file} && "
+        "cp -l environment {new}/.env && chmod 2750 {new}".format(
+            fingerprints=' '.join(pipes.quote(line) for line in
+                                  format_fingerprints(fingerprints).splitlines()),
+            new=directory,
+            file=FINGERPRINTS_FILE,
+        ))
+    return fingerprints
+
+
+def compute_fingerprints(entries):
+    """
+    Returns a dict mapping the name of every group of FINGERPRINT_PATTERNS to
+    a hash of the files of the tree entries that match it.
+    """
+    fingerprints = {}
+    for name, patterns in FINGERPRINT_PATTERNS:
+        fingerprint = hashlib.sha1()
+        for path in sorted(entries):
+            if any(fnmatch.fnmatch(path, pattern) for pattern in patterns):
+                mode, blob = entries[path]
+                fingerprint.update('{mode} {blob} {path}\0'.format(
+                    mode=mode, blob=blob, path=path))
+        fingerprints[name] = fingerprint.hexdigest()
+    return fingerprints
 
-        rsync_project(
-            local_dir=extract_dir,
-            remote_dir=os.path.join(env.cwd, directory),
-            delete=True,
-            extra_opts=' '.join(extra_opts_list),
-            # Fabric defaults to -pthrvz
-            # -t preserve the modification time. We want to ignore that.
-            # -v print the file being updated
-            # We replaced these by:
-            # -c will use checksum to compare files
-            # -i will print what kind of transfer has been done (copy/upload/...)
-            default_opts='-pchriz',
-        )
 
-    run('cp -l environment {new}/.env'.format(new=directory))
-    run('chmod 2750 {}'.format(directory))
+def format_fingerprints(fingerprints):
+    return ''.join('{} {}\n'.format(name, fingerprint)
+                   for name, fingerprint in sorted(fingerprints.items()))
 
 
-def pip_install():
+def parse_fingerprints(text):
+    return dict(line.split(' ', 1) for line in text.splitlines() if line)
+
+
+def get_changes(fingerprints, previous_fingerprints):
+    """
+    Returns the set of the names of the fingerprints that changed, all of them
+    if the previous ones are unknown.
+    """
+    if previous_fingerprints is None:
+        return set(fingerprints)
+    return set(name for name, fingerprint in fingerprints.items()
+               if previous_fingerprints.get(name) != fingerprint)
+
+
+def get_requirements_hash(requirements):
+    return hashlib.sha1(requirements).hexdigest()
+
+
+def get_requirements(gitref):
+    """
+    Returns the content of the requirements file of gitref, None if it has none
+    """
+    with settings(hide('running', 'stdout', 'stderr', 'warnings'), warn_only=True):
+        requirements = local('git show {ref}:{file}'.format(ref=gitref, file=REQUIREMENT_FILE),
+                             capture=True)
+    return requirements if requirements.succeeded else None
+
+
+@timed('build_wheelhouse')
+def build_wheelhouse(gitref):
+    """
+    Build the wheels of the requirements of gitref into a wheelhouse keyed by
+    the hash of the requirements file.
+
+    This is meant to run before taking the deployment lock, so that
+    pip_install never has to download or compile anything. Returns the path
+    of the wheelhouse, None if it couldn't be built.
+    """
+    requirements = get_requirements(gitref)
+    if requirements is None:
+        return None
+    local_requirements = get_local_requirements(requirements)
+    if local_requirements:
+        # pip wheel only gets a copy of the requirements file, and its hash
+        # wouldn't cover the included files anyway
+        print red("Not building a wheelhouse, the requirements refer to files of the tree "
+                  "({0}). pip install will use the index".format(', '.join(local_requirements)))
+        return None
+    wheelhouse = os.path.join(WHEELHOUSE, get_requirements_hash(requirements))
+
+    with cd_project() as path:
+        with settings(hide('running', 'stdout', 'stderr', 'warnings'), warn_only=True):
+            # Touching it keeps the recently used wheelhouses at the top of ls -t
+            if run('touch -c {dir} && test -e {dir}/.complete'.format(dir=wheelhouse)).succeeded:
+                return os.path.join(path, wheelhouse)
+
+        # Hidden so that it isn't pruned by someone else
+        tmp_dir = os.path.join(WHEELHOUSE, '.{hash}.tmp-{user}'.format(
+            hash=os.path.basename(wheelhouse), user=getpass.getuser()))
+        run('rm -rf {tmp} && mkdir -p {tmp}'.format(tmp=tmp_dir))
+        put_string(requirements, os.path.join(tmp_dir, REQUIREMENT_FILE))
+        with contextlib.nested(use_virtualenv(), settings(warn_only=True)):
+            result = run('pip wheel --wheel-dir={tmp} -r {tmp}/{file}'.format(
+                tmp=tmp_dir, file=REQUIREMENT_FILE))
+        if result.failed:
+            run('rm -rf {tmp}'.format(tmp=tmp_dir))
+            print red("Couldn't build the wheelhouse, pip install will use the index")
+            return None
+
+        run('touch {tmp}/.complete && rm -rf {dir} && mv -T {tmp} {dir}'.format(
+            tmp=tmp_dir, dir=wheelhouse))
+        # Only keep the most recent wheelhouses
+        run('ls -1td {pattern} | tail -n +{keep:d} | xargs -r rm -rf'.format(
+            pattern=os.path.join(WHEELHOUSE, '*/'), keep=DEFAULT_HISTORY_SIZE + 2))
+        return os.path.join(path, wheelhouse)
+
+
+@timed('pip_install')
+def pip_install(wheelhouse=None):
     """
     Install requirements in this directory
+
+    With a wheelhouse, the packages are only installed from it.
+    """
+    if wheelhouse:
+        run('pip install --upgrade --no-index --find-links={wheelhouse} -r {file}'.format(
+            wheelhouse=wheelhouse, file=REQUIREMENT_FILE))
+    else:
+        run('pip install --upgrade -r requirements.txt')
+
+
+def parse_requirements(requirements):
+    """
+    Returns the set of requirement lines, without comments and blank lines
     """
-    run('pip install --upgrade -r requirements.txt')
+    lines = (REQUIREMENT_COMMENT_RE.sub('', line).strip() for line in requirements.splitlines())
+    return set(line for line in lines if line)
 
 
+def get_local_requirements(requirements):
+    """
+    Returns the sorted requirement lines that include other files or install
+    local paths (-r, -c, -e ./pkg), which only make sense inside the tree
+    """
+    return sorted(line for line in parse_requirements(requirements)
+                  if REQUIREMENT_LOCAL_RE.match(line))
+
+
+def parse_snapshot_requirements(output):
+    """
+    Parses the output of grep -H over the requirements of the virtualenv
+    snapshots into a dict of snapshot name to set of requirements
+    """
+    lines = {}
+    for line in output.splitlines():
+        path, _, requirement = line.partition(':')
+        lines.setdefault(os.path.basename(os.path.dirname(path)), []).append(requirement)
+    return dict((name, parse_requirements('\n'.join(requirements)))
+                for name, requirements in lines.items())
+
+
+def get_closest_snapshot(requirements, snapshots):
+    """
+    Returns the name of the snapshot whose requirements differ the least from
+    requirements, None if there's no snapshot
+    """
+    if not snapshots:
+        return None
+    requirements = parse_requirements(requirements)
+    return min(snapshots, key=lambda name: len(snapshots[name] ^ requirements))
+
+
+def get_requirement_names(requirements):
+    """
+    Returns the lowercase project names of a set of requirement lines, from
+    their name or their #egg= fragment
+    """
+    names = set()
+    for requirement in requirements:
+        match = REQUIREMENT_EGG_RE.search(requirement) or REQUIREMENT_NAME_RE.match(requirement)
+        if match:
+            names.add(match.group(1).lower().replace('_', '-'))
+    return names
+
+
+def clone_virtualenv(source, destination):
+    """
+    Copy the virtualenv source to destination with hard links, then point its
+    scripts and .pth files to destination.
+
+    pip replaces the packages it installs instead of writing through the hard
+    links, and sed -i the files it edits.  setuptools edits the .pth files in
+    place though, so they are copied.  The packages that source has and
+    destination doesn't need are left to the caller to uninstall.
+    """
+    run('cp -al {source} {destination} && rm -f {destination}/{marker}'.format(
+        source=source, destination=destination, marker=SNAPSHOT_REQUIREMENTS))
+    run("find {destination}/lib/python*/site-packages -maxdepth 1 -type f"
+        " \\( -name '*.pth' -o -name '*.egg-link' \\) -exec sh -c"
+        " 'for f; do cp -p \"$f\" \"$f.tmp\" && mv -f \"$f.tmp\" \"$f\"; done' sh {{}} +".format(
+            destination=destination))
+    run("find {destination}/bin {destination}/lib/python*/site-packages -maxdepth 1 -type f"
+        " \\( -path '{destination}/bin/*' -o -name '*.pth' -o -name '*.egg-link' \\) -print0"
+        " | xargs -0 -r grep -lIZ ''"
+        " | xargs -0 -r sed -i 's|{source}|{destination}|g'".format(
+            source=source, destination=destination))
+
+
+@timed('virtualenv')
+def link_virtualenv(directory, requirements, wheelhouse=None):
+    """
+    Point the src directory directory to the virtualenv snapshot of its
+    requirements, building the snapshot if there's none yet.
+
+    A new snapshot starts as a hard link copy of the snapshot with the closest
+    requirements (or of the shared virtualenv), so that pip only installs what
+    differs.  Returns whether a snapshot was built.
+    """
+    snapshot = os.path.join(VIRTUALENVS, get_requirements_hash(requirements))
+    with cd_project() as path:
+        probe = run_batch([
+            # Touching it keeps the recently used snapshots at the top of ls -t
+            ('complete', 'touch -c {dir} && test -e {dir}/{marker}'.format(
+                dir=snapshot, marker=SNAPSHOT_REQUIREMENTS)),
+            ('snapshots', 'grep -H "" {pattern}'.format(
+                pattern=os.path.join(VIRTUALENVS, '*', SNAPSHOT_REQUIREMENTS))),
+            ('shared', 'test -d {}'.format(VIRTUALENV)),
+        ])
+        built = probe['complete'].return_code != 0
+        if built:
+            snapshots = parse_snapshot_requirements(probe['snapshots'].stdout)
+            closest = get_closest_snapshot(requirements, snapshots)
+            # Releases are prepared without the deployment lock
+            building = os.path.join(VIRTUALENVS, '.{}.building'.format(os.path.basename(snapshot)))
+            if run('mkdir -p {parent} && mkdir {building}'.format(
+                    parent=VIRTUALENVS, building=building), quiet=True).failed:
+                abort(red("Someone else is building {snapshot} (remove {building} if they"
+                          " aren't).".format(snapshot=snapshot, building=building), bold=True))
+            try:
+                # A snapshot left incomplete by a failed deploy is built again
+                run('rm -rf {}'.format(snapshot))
+                if closest is not None:
+                    clone_virtualenv(os.path.join(path, VIRTUALENVS, closest),
+                                     os.path.join(path, snapshot))
+                elif probe['shared'].return_code == 0:
+                    clone_virtualenv(os.path.join(path, VIRTUALENV), os.path.join(path, snapshot))
+                else:
+                    run('virtualenv {}'.format(snapshot))
+
+                activate_script = os.path.join(path, snapshot, 'bin', 'activate')
+                with contextlib.nested(prefix('source {}'.format(activate_script)),
+                                       cd(directory)):
+                    if closest is not None:
+                        # Otherwise the snapshot would depend on where it was
+                        # cloned from.  pip install puts back what's still a
+                        # dependency.  The clones of the shared virtualenv keep
+                        # all of its packages.
+                        removed = (get_requirement_names(snapshots[closest]) -
+                                   get_requirement_names(parse_requirements(requirements)))
+                        if removed:
+                            run('pip uninstall -y {}'.format(
+                                ' '.join(pipes.quote(name) for name in sorted(removed))),
+                                warn_only=True)
+                    pip_install(wheelhouse)
+                put_string(requirements, os.path.join(snapshot, SNAPSHOT_REQUIREMENTS))
+            finally:
+                run('rmdir {}'.format(building))
+
+        run('ln -sfn {snapshot} {link}'.format(snapshot=os.path.join('..', snapshot),
+                                               link=os.path.join(directory, SRC_VIRTUALENV)))
+    return built
+
+
+def get_unused_virtualenvs():
+    """
+    Returns the complete virtualenv snapshots that no src directory links to
+    """
+    with cd_project():
+        probe = run_batch([
+            ('links', 'readlink {src}.*/{link}'.format(src=SRC_DIR, link=SRC_VIRTUALENV)),
+            ('snapshots', 'ls -1d {}'.format(os.path.join(VIRTUALENVS, '*', SNAPSHOT_REQUIREMENTS))),
+        ])
+        used = set(os.path.basename(link) for link in probe['links'].stdout.split())
+        return [os.path.dirname(marker) for marker in probe['snapshots'].stdout.split()
+                if os.path.basename(os.path.dirname(marker)) not in used]
+
+
+@timed('migrate')
 def migrate(backupdb):
     """
     Migrate the database in this directory:
@@ -219,45 +975,281 @@ def migrate(backupdb):
         run('python manage.py migrate --noinput')
 
 
+@timed('collectstatic')
 def collectstatic():
     run('python manage.py collectstatic --noinput')
 
 
-def reload_uwsgi():
+def parse_static_root(value):
     """
-    Update the project's code symlink to the specified directory
-    And then touches the vassal
+    Returns the path of a STATIC_ROOT as printed by diffsettings, None if it
+    isn't a string or a pathlib path.
     """
-    possibilities_templates = [
-        '/etc/vassals/{name}.ini',
-        '/etc/uwsgi-emperor/vassals/{name}.ini',
-    ]
-    possibilities = [f.format(name=env.vassal_name) for f in possibilities_templates]
+    match = STATIC_ROOT_PATH_RE.match(value)
+    if match:
+        value = match.group(1)
+    try:
+        static_root = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return None
+    return static_root if isinstance(static_root, basestring) else None
+
+
+def get_static_root(directory):
+    """
+    Returns the STATIC_ROOT of the code in this directory relative to it, None
+    if it's somewhere else or not set, UNKNOWN_STATIC_ROOT if it couldn't be
+    found out.
 
-    for fname in possibilities:
-        if exists(fname):
-            sudo('touch {}'.format(fname))
+    Set env.static_root to skip asking Django.
+    """
+    if 'static_root' in env:
+        return env.static_root
+
+    with settings(hide('running', 'stdout', 'warnings'), warn_only=True):
+        output = run('python manage.py diffsettings', pty=False)
+    if output.failed:
+        return UNKNOWN_STATIC_ROOT
+    for line in output.splitlines():
+        if line.startswith('STATIC_ROOT = '):
+            value = line[len('STATIC_ROOT = '):].split('  ###')[0]
             break
     else:
-        raise RuntimeError("Couldn't find the vassal file in %s" % possibilities)
+        return None
+    if value == 'None':
+        return None
+    static_root = parse_static_root(value)
+    if static_root is None:
+        return UNKNOWN_STATIC_ROOT
+
+    for path in (directory, SRC_DIR):
+        prefix = os.path.join(get_project_path(), path, '')
+        if static_root.startswith(prefix):
+            return os.path.relpath(static_root, prefix)
+    return None
+
+
+def link_previous_static(static_root):
+    """
+    Hard link the static files collected in the deployed src directory into
+    this one, collectstatic then only copies the files that changed.
+    """
+    run('if [ -d {old} ]; then mkdir -p {new} && cp -a -l -n {old}/. {new}/; fi'.format(
+        old=os.path.join('..', SRC_DIR, static_root),
+        new=static_root,
+    ))
+
+
+def get_vassal_possibilities():
+    return [f.format(name=env.vassal_name) for f in VASSAL_TEMPLATES]
 
 
-def cleanup_history(size, superclean=False):
+def find_vassal_command():
+    """
+    Shell command printing the first vassal file that exists
+    """
+    return 'for f in {}; do if [ -e "$f" ]; then echo "$f"; break; fi; done'.format(
+        ' '.join(get_vassal_possibilities()))
+
+
+def get_warmup_urls():
+    """
+    Returns env.warmup_urls, given as a list or separated by commas
+    """
+    urls = env.get('warmup_urls') or []
+    if isinstance(urls, basestring):
+        urls = [url.strip() for url in urls.split(',') if url.strip()]
+    return urls
+
+
+def readiness_command(urls, timeout=READY_TIMEOUT, warmup_requests=DEFAULT_WARMUP_REQUESTS,
+                      release=None, header=DEFAULT_RELEASE_HEADER):
+    """
+    Shell command waiting for each of urls to answer without error, for at
+    most timeout seconds each, then sending warmup_requests concurrent
+    requests to each of them.  Prints the first url that wasn't ready.
+
+    With release, the answers must also have the header set to release, the
+    answers of the code that was running before the reload don't count.
+    """
+    urls = ' '.join(pipes.quote(url) for url in urls)
+    curl = 'curl -s -o /dev/null --max-time {timeout:d}'.format(timeout=READY_REQUEST_TIMEOUT)
+    if release is None:
+        probe = '{curl} -f "$0"'.format(curl=curl)
+    else:
+        probe = '{curl} -f -D - "$0" | tr -d "\\r" | grep -qixF "$1"'.format(curl=curl)
+    wait = ('for url in {urls}; do'
+            ' timeout {timeout:d} sh -c \'until {probe}; do sleep {interval}; done\' "$url"{line}'
+            ' || {{ echo "$url"; exit 1; }}; done').format(
+                urls=urls, timeout=int(timeout), probe=probe, interval=READY_INTERVAL,
+                line='' if release is None else ' ' + pipes.quote('{0}: {1}'.format(header, release)))
+    if not warmup_requests:
+        return wait
+    warm = ("for i in $(seq {count:d}); do printf '%s\\n' {urls}; done"
+            " | xargs -n 1 -P {count:d} {curl}").format(
+                count=int(warmup_requests), urls=urls, curl=curl)
+    return '{wait} && {warm}'.format(wait=wait, warm=warm)
+
+
+def wait_until_ready(reloaded_at, urls, release=None):
+    """
+    Wait for the reloaded code of the release src directory to answer urls,
+    and record the time it took since reloaded_at.
+
+    With env.release_header (like 'X-Release'), the urls have to name the src
+    directory of the code that answers in that header, like
+    os.path.basename(os.path.realpath(settings.BASE_DIR)).  Without it, any
+    answer is accepted, even from the code running before the reload.
+    """
+    header = env.get('release_header')
+    if not header:
+        release = None
+    with phase('ready') as record:
+        with settings(hide('running', 'stdout'), warn_only=True):
+            result = run(readiness_command(
+                urls,
+                timeout=int(env.get('ready_timeout', READY_TIMEOUT)),
+                warmup_requests=int(env.get('warmup_requests', DEFAULT_WARMUP_REQUESTS)),
+                release=release,
+                header=header,
+            ), pty=False)
+        time_to_ready = time.time() - reloaded_at
+        if result.failed:
+            abort(red("{url} isn't answering{release} since the reload, you might want to"
+                      " roll back.".format(url=result.strip() or ', '.join(urls),
+                                           release=' with ' + release if release else ''),
+                      bold=True))
+        if record is not None:
+            record['time_to_ready'] = round(time_to_ready, 3)
+    print blue('Ready {:.1f}s after the reload'.format(time_to_ready))
+    return time_to_ready
+
+
+@timed('reload_uwsgi')
+def reload_uwsgi(vassal_file=None):
+    """
+    Reload the project's code, then wait until the new code answers
+    env.warmup_urls (see wait_until_ready).
+
+    By default the vassal is touched and the emperor restarts it.  With
+    env.uwsgi_reload = 'fifo', env.uwsgi_fifo_command ('c', a chain reload,
+    by default) is written to the master FIFO env.uwsgi_fifo instead, so that
+    the workers are replaced one at a time.  Chain reloads need lazy-apps.
+
+    vassal_file can be given when it has already been looked up.
+    """
+    method = env.get('uwsgi_reload', 'touch')
+    reloaded_at = time.time()
+    if method == 'fifo':
+        fifo = env.get('uwsgi_fifo', DEFAULT_UWSGI_FIFO).format(name=env.vassal_name)
+        # Opening a FIFO blocks until the master opens it too
+        with settings(hide('warnings'), warn_only=True):
+            result = sudo('timeout {timeout:d} sh -c {write}'.format(
+                timeout=FIFO_TIMEOUT,
+                write=pipes.quote('echo {command} > {fifo}'.format(
+                    command=pipes.quote(env.get('uwsgi_fifo_command', 'c')), fifo=fifo))))
+        if result.failed:
+            abort(red("Couldn't write to {fifo}, is the uwsgi master running?".format(fifo=fifo),
+                      bold=True))
+    elif method == 'touch':
+        if vassal_file is None:
+            vassal_file = get_remote_state().vassal_file
+        if not vassal_file:
+            raise RuntimeError("Couldn't find the vassal file in %s" % get_vassal_possibilities())
+        sudo('touch {}'.format(vassal_file))
+    else:
+        raise NameError("Please set env.uwsgi_reload to 'touch' or 'fifo'")
+
+    urls = get_warmup_urls()
+    if urls:
+        wait_until_ready(reloaded_at, urls, get_remote_state().current)
+
+
+def get_disk_usage(directories):
+    """
+    Returns the disk usage in bytes of each directory, without the files hard
+    linked from the directories before it
+    """
+    # du counts the files hard linked in several directories once, in the
+    # first one it goes through
+    with hide('running', 'stdout'):
+        output = run('du -s --block-size=1 {}'.format(
+            ' '.join(pipes.quote(d) for d in directories)), pty=False)
+    usage = {}
+    for line in output.splitlines():
+        used, _, path = line.partition('\t')
+        usage[path] = int(used)
+    return [usage.get(directory, 0) for directory in directories]
+
+
+def get_over_budget(current_src, deployed_src, budget):
+    """
+    Returns the deployed src directories, newest first, that don't fit in the
+    disk budget with the current one and the newer ones
+    """
+    if not deployed_src:
+        return []
+    usage = get_disk_usage([current_src] + deployed_src)
+    total = usage[0]
+    for i, used in enumerate(usage[1:]):
+        total += used
+        if total > budget:
+            return deployed_src[i:]
+    return []
+
+
+def move_to_trash(paths):
+    """
+    Move paths out of the way in the trash directory, where empty_trash
+    deletes them
+    """
+    run('mkdir -p {trash} && mv {paths} "$(mktemp -d {trash}/XXXXXX)"'.format(
+        trash=TRASH_DIR, paths=' '.join(pipes.quote(path) for path in paths)))
+
+
+def empty_trash(background=True):
+    """
+    Delete the content of the trash directory, by default in a detached,
+    niced and ioniced process that outlives the connection.
+    """
+    remove = 'rm -rf {trash}/*'.format(trash=TRASH_DIR)
+    if background:
+        run('setsid nohup nice -n 19 $(command -v ionice > /dev/null && echo ionice -c3) '
+            '{remove} > /dev/null 2>&1 < /dev/null &'.format(remove=remove), pty=False)
+    else:
+        run(remove)
+
+
+@timed('cleanup_history')
+def cleanup_history(size, superclean=False, current_src=None, background=True):
+    """
+    Remove the old src directories, keeping size of them besides the current
+    one, and less if they don't fit in env.history_disk_budget bytes.
+
+    The directories are moved to the trash at once, then deleted in the
+    background unless background is False.  current_src can be given when the
+    current src directory is already known.
+    """
     if size < 0:
         raise ValueError("The history size can't be negative")
+    state = get_remote_state()
     with cd_project():
-        current_src = os.path.basename(run('readlink -f {}'.format(SRC_DIR)))
+        if current_src is None:
+            current_src = state.current
 
         assert SRC_DIRNAMES_RE.match(current_src) is not None, "This server has weird src directory names"
         current_number = int(SRC_DIRNAMES_RE.match(current_src).group(1))
 
-        src_directories = [os.path.basename(d) for d in get_src_dir_list()]
+        src_directories = state.directories
         # src directory that have been deployed
         deployed_src = [dirname for dirname in src_directories
                         if int(SRC_DIRNAMES_RE.match(dirname).group(1)) < current_number]
         deployed_src.sort(reverse=True)
 
         to_remove = deployed_src[size:]
+        budget = int(env.get('history_disk_budget', 0))
+        if budget:
+            to_remove = get_over_budget(current_src, deployed_src[:size], budget) + to_remove
 
         if superclean:
             dirty_src = [dirname for dirname in src_directories
@@ -265,22 +1257,17 @@ def cleanup_history(size, superclean=False):
             to_remove += dirty_src
 
         if to_remove:
-            run('rm -rf {}'.format(' '.join(to_remove)))
-
-
-def is_there_a_diff(file1, file2):
-    with settings(hide('stdout', 'warnings'), warn_only=True):
-        return run('diff {a} {b}'.format(a=file1, b=file2)).failed
+            move_to_trash(to_remove)
+            state.remove_directories(to_remove)
 
+        if use_virtualenv_snapshots():
+            unused_virtualenvs = get_unused_virtualenvs()
+            if unused_virtualenvs:
+                move_to_trash(unused_virtualenvs)
+            to_remove += unused_virtualenvs
 
-def count_migrations(directory):
-    with hide('stdout'):
-        migrations_list = run(
-            'if [ -d "./{}" ]; then find "./{}" -path "*/migrations/*.py" -print0; fi'.format(
-                directory, directory
-            )
-        )
-    return len(migrations_list.split('\0'))
+        if to_remove:
+            empty_trash(background)
 
 
 def is_ancestor_of(old, new):
@@ -305,13 +1292,232 @@ def is_ancestor_of(old, new):
 
 LogEntry = namedtuple('LogEntry', ['human_date', 'username', 'dir', 'hash'])
 
-def get_deploy_log():
+Release = namedtuple('Release', ['directory', 'should_pip_install', 'should_migrate',
+                                 'should_collectstatic', 'changes', 'previous_deploy', 'vassal_file',
+                                 'wheelhouse', 'requirements'])
+
+
+def parse_deploy_log(log):
+    return [LogEntry(*i.split('\t')) for i in log.splitlines() if len(i)]
+
+
+def deploy_log_command(count=None, username=None, ref=None, directory=None):
+    """
+    Shell command printing the last count entries of the deploy log matching
+    the filters.
+
+    tail seeks from the end of the file and the filtering happens on the
+    server, so only the entries we asked for are transferred.
+    """
+    variables = []
+    filters = []
+    if username is not None:
+        variables.append(('user', username))
+        filters.append('$2 == user')
+    if directory is not None:
+        variables.append(('dir', directory))
+        filters.append('$3 == dir')
+    if ref is not None:
+        variables.append(('ref', ref))
+        # Allow abbreviated hashes
+        filters.append('index($4, ref) == 1')
+
+    if filters:
+        command = "awk -F '\\t' {variables} '{condition}' {log}".format(
+            variables=' '.join('-v {}={}'.format(name, pipes.quote(value))
+                               for name, value in variables),
+            condition=' && '.join(filters),
+            log=DEPLOY_LOG,
+        )
+        if count is not None:
+            command += ' | tail -n {:d}'.format(count)
+    elif count is not None:
+        command = 'tail -n {count:d} {log}'.format(count=count, log=DEPLOY_LOG)
+    else:
+        command = 'cat {log}'.format(log=DEPLOY_LOG)
+    return command + ' 2>/dev/null'
+
+
+def read_deploy_log(count=None, username=None, ref=None, directory=None):
+    """
+    Returns the LogEntry of the last count deploys (all of them by default),
+    oldest first.
+
+    username, ref (or a prefix of it) and directory restrict the history to
+    the matching deploys.
+    """
     with settings(hide('running', 'stdout', 'stderr', 'warnings'), warn_only=True):
-        log = StringIO()
-        get(DEPLOY_LOG, log)
-        return [LogEntry(*i.split('\t')) for i in log.getvalue().split('\n') if len(i)]
+        return parse_deploy_log(run(
+            deploy_log_command(count, username=username, ref=ref, directory=directory),
+            pty=False,
+        ))
 
 
+def get_deploy_log():
+    return read_deploy_log()
+
+
+def get_last_deploy():
+    """
+    Returns the LogEntry of the last deploy, None if there's none
+    """
+    return get_remote_state().last_deploy
+
+
+def check_fast_forward(gitref, previous_deploy):
+    """
+    Ask for confirmation if gitref isn't a descendant of the deployed commit
+    """
+    if previous_deploy is not None:
+        if not is_ancestor_of(previous_deploy.hash, gitref):
+            message = blue(
+                "Warning: Going to update from {old} (deployed by {user}) to {new},"
+                " which is not a fast-forward. Continue?".format(
+                    old=previous_deploy.hash[:8],
+                    new=gitref[:8],
+                    user=previous_deploy.username,
+                ),
+                bold=True,
+            )
+            if not confirm(message, default=False):
+                abort("Aborted.")
+
+
+def prepare_release(gitref, directory, qad, wheelhouse=None):
+    """
+    Upload the code into directory and find out what needs to be done for it.
+
+    Returns a Release.
+    """
+    fingerprints = upload_source(gitref, directory)
+
+    if qad:
+        with phase('probe'):
+            previous_fingerprints = run('cat {src}/{file}'.format(
+                src=SRC_DIR, file=FINGERPRINTS_FILE), pty=False, quiet=True)
+
+    if not qad:
+        changes = set(fingerprints)
+    elif previous_fingerprints.succeeded:
+        changes = get_changes(fingerprints, parse_fingerprints(previous_fingerprints))
+    else:
+        # Deployed before the fingerprints existed (or first deploy)
+        previous_entries = read_manifest(SRC_DIR)
+        changes = get_changes(
+            fingerprints,
+            compute_fingerprints(previous_entries) if previous_entries is not None else None,
+        )
+
+    should_pip_install = 'requirements' in changes
+    # If we should pip install, new pip packages might introduce migrations.
+    # New settings might install new apps.
+    should_migrate = bool(changes & MIGRATE_CHANGES)
+    # New packages and settings might bring new static files too
+    should_collectstatic = bool(changes & COLLECTSTATIC_CHANGES)
+
+    state = get_remote_state()
+    return Release(
+        directory=directory,
+        should_pip_install=should_pip_install,
+        should_migrate=should_migrate,
+        should_collectstatic=should_collectstatic,
+        changes=changes,
+        previous_deploy=state.last_deploy,
+        vassal_file=state.vassal_file,
+        wheelhouse=wheelhouse,
+        requirements=get_requirements(gitref) if use_virtualenv_snapshots() else None,
+    )
+
+
+def needs_shared_requirements(release):
+    """
+    Whether the release needs requirements that aren't installed in the shared
+    virtualenv yet
+    """
+    return release.should_pip_install and release.requirements is None
+
+
+def install_release(release, backupdb, run_migrations=True, shared=True):
+    """
+    Install the dependencies, migrate and build the static and pyc files of
+    a prepared release.
+
+    Without shared, what the deployed code uses too is left to
+    activate_release: the shared virtualenv and a STATIC_ROOT outside of the
+    src directory or unknown, as well as the static files when they need the
+    new requirements.
+    """
+    if release.requirements is not None:
+        link_virtualenv(release.directory, release.requirements, release.wheelhouse)
+    with contextlib.nested(use_virtualenv(release.directory), cd(release.directory)):
+        if shared and needs_shared_requirements(release):
+            pip_install(release.wheelhouse)
+        if run_migrations and release.should_migrate:
+            migrate(backupdb)
+
+        # Without the new requirements, the static files can't be collected
+        if shared or not needs_shared_requirements(release):
+            # Even when nothing changed, the collected files are linked
+            static_root = get_static_root(release.directory)
+            if static_root is UNKNOWN_STATIC_ROOT:
+                # There may be nothing to link from, collect everything
+                if shared:
+                    collectstatic()
+            else:
+                if static_root:
+                    link_previous_static(static_root)
+                if release.should_collectstatic and (shared or static_root):
+                    collectstatic()
+
+    # "pip install" generates pyc files in site-packages, generate_pyc
+    # compiles the packages installed with "pip install -e"
+    with contextlib.nested(use_virtualenv(release.directory), cd(release.directory)):
+        generate_pyc(previous_dir=os.path.join('..', SRC_DIR))
+
+
+@timed('log_deploy')
+def log_deploy(gitref, directory):
+    # The server time is read by the same command that writes the entry
+    with hide('running', 'stdout'):
+        entry = run("printf '%s:\\t%s\\t%s\\t%s\\n' \"$(TZ={tz} date)\" {user} {dir} {ref}"
+                    " | tee -a {log}".format(
+                        tz=DEPLOY_LOG_TZ,
+                        user=pipes.quote(getpass.getuser()),
+                        dir=pipes.quote(directory),
+                        ref=pipes.quote(gitref),
+                        log=DEPLOY_LOG,
+                    ), pty=False)
+    get_remote_state().logged(parse_deploy_log(entry)[-1])
+
+
+@contextlib.contextmanager
+def record_timings(gitref, **context):
+    """
+    Time the phases of a deploy on this host, then append the report next to
+    the deploy log as JSON lines.
+    """
+    timer = Timer(host=env.host_string, ref=gitref, user=getpass.getuser(),
+                  started_at=int(time.time()), **context)
+    timer.context['status'] = 'failed'
+    try:
+        with timer:
+            yield timer
+        timer.context['status'] = 'ok'
+    finally:
+        try:
+            with contextlib.nested(cd_project(), hide('running', 'stdout')):
+                run('printf %s {report} >> {log}'.format(
+                    report=pipes.quote(timer.to_json_lines()), log=DEPLOY_TIMINGS),
+                    warn_only=True)
+        except (Exception, SystemExit) as e:
+            # Most likely the connection that failed the deploy, don't hide
+            # its error
+            print red("Couldn't write the timings to {log}: {error}".format(
+                log=DEPLOY_TIMINGS, error=e))
+        print blue(timer.summary())
+
+
+@fresh_remote_state
 def push(gitref, qad, backupdb):
     """
     Push the last changes
@@ -320,161 +1526,565 @@ def push(gitref, qad, backupdb):
       * Doesn't pip install if the requirements.txt didn't change
       * Doesn't migrate if the migrations file didn't change
     """
+    with record_timings(gitref, step='push') as timer:
+        wheelhouse = build_wheelhouse(gitref)
+        with cd_project():
+            with atomic_src_update() as directory:
+                timer.context['directory'] = directory
+                release = prepare_release(gitref, directory, qad, wheelhouse)
+                check_fast_forward(gitref, release.previous_deploy)
+                install_release(release, backupdb)
+                log_deploy(gitref, directory)
+
+            reload_uwsgi(release.vassal_file)
+            cleanup_history(DEFAULT_HISTORY_SIZE, current_src=directory)
+
+
+def reserve_src_dir():
+    """
+    Create the next src directory, mkdir fails when someone else created it
+    first.  Pushes reserve it too, since prepare doesn't take the deployment
+    lock.
+    """
+    for _ in range(RESERVE_ATTEMPTS):
+        directory = get_next_src_dir()
+        with cd_project():
+            if run('mkdir {}'.format(directory), quiet=True).succeeded:
+                # The setgid bit makes the subdirectories belong to www-data too
+                run('chgrp www-data {dir} && chmod 2750 {dir}'.format(dir=directory))
+                get_remote_state().add_directory(directory)
+                return directory
+        forget_remote_state()
+    abort(red("Couldn't reserve a src directory", bold=True))
+
+
+def acquire_locked_src_dir(directory):
+    """
+    Take the deployment lock for a reserved src directory, and give the
+    directory back when someone else holds the lock.
+    """
+    try:
+        acquire_deployment_lock(directory)
+    except:
+        run('rmdir {}'.format(directory))
+        get_remote_state().remove_directories([directory])
+        raise
+
+
+def format_release_file(gitref, qad, wheelhouse, static=True):
+    return 'ref {ref}\nqad {qad:d}\nwheelhouse {wheelhouse}\nstatic {static:d}\n'.format(
+        ref=gitref, qad=qad, wheelhouse=wheelhouse or '', static=static)
+
+
+def parse_release_file(text):
+    return dict((line.split(' ', 1) + [''])[:2] for line in text.splitlines() if line)
+
+
+def prepare_release_ahead(gitref, qad):
+    """
+    Build a new src directory without the deployment lock, everything but
+    what activate_release does.  Returns the directory.
+    """
+    wheelhouse = build_wheelhouse(gitref)
     with cd_project():
-        with atomic_src_update() as directory:
-            try:
-                previous_deploy = get_deploy_log()[-1]
-            except IndexError:
-                # first deploy
-                pass
-            else:
-                if not is_ancestor_of(previous_deploy.hash, gitref):
-                    message = blue(
-                        "Warning: Going to update from {old} (deployed by {user}) to {new},"
-                        " which is not a fast-forward. Continue?".format(
-                            old=previous_deploy.hash[:8],
-                            new=gitref[:8],
-                            user=previous_deploy.username,
-                        ),
-                        bold=True,
-                    )
-                    if not confirm(message, default=False):
-                        abort("Aborted.")
-
-            upload_source(gitref, directory)
+        directory = reserve_src_dir()
+        try:
+            release = prepare_release(gitref, directory, qad, wheelhouse)
+            install_release(release, backupdb=False, run_migrations=False, shared=False)
+            put_string(format_release_file(gitref, qad, wheelhouse,
+                                           static=not needs_shared_requirements(release)),
+                       os.path.join(directory, RELEASE_FILE))
+        except:
+            move_to_trash([directory])
+            empty_trash()
+            raise
+    return directory
+
+
+def read_prepared_release(directory):
+    """
+    Returns the release file of a src directory built by prepare_release_ahead
+    as a dict, and what changed since the current src directory.
+    """
+    state = get_remote_state()
+    probe = run_batch([
+        ('release', 'cat {dir}/{file}'.format(dir=directory, file=RELEASE_FILE)),
+        ('fingerprints', 'cat {dir}/{file}'.format(dir=directory, file=FINGERPRINTS_FILE)),
+        ('current_fingerprints', 'cat {src}/{file}'.format(src=SRC_DIR, file=FINGERPRINTS_FILE)),
+    ])
+    if probe['release'].return_code != 0:
+        abort(red("{} wasn't prepared, or is already activated".format(directory), bold=True))
+    if state.current is not None and directory < state.current:
+        abort(red("{directory} was prepared before {current} was deployed, prepare it again".format(
+            directory=directory, current=state.current), bold=True))
+    release = parse_release_file(probe['release'].stdout)
+    check_fast_forward(release['ref'], state.last_deploy)
+
+    # Compared again, someone else might have deployed since it was prepared
+    fingerprints = parse_fingerprints(probe['fingerprints'].stdout)
+    if release['qad'] == '1' and probe['current_fingerprints'].return_code == 0:
+        changes = get_changes(fingerprints,
+                              parse_fingerprints(probe['current_fingerprints'].stdout))
+    else:
+        changes = set(fingerprints)
+    return release, changes
 
-            try:
-                previous_source = os.path.basename(
-                    run('readlink -f {}'.format(SRC_DIR)))
-            except IndexError:
-                should_pip_install = True
-                should_migrate = True
-            else:
-                if qad:
-                    # Try to guess if we should pip install
-                    should_pip_install = is_there_a_diff(
-                        os.path.join(directory, REQUIREMENT_FILE),
-                        os.path.join(previous_source, REQUIREMENT_FILE),
-                    )
-                else:
-                    should_pip_install = True
-
-                if qad:
-                    # Try to guess if there are extra migrations
-                    migrations_now = count_migrations(directory)
-                    migrations_before = count_migrations(previous_source)
-                    # If we should pip install, new pip packages might
-                    # introduce migrations.
-                    should_migrate = should_pip_install or migrations_now != migrations_before
-                else:
-                    should_migrate = True
 
-            with contextlib.nested(use_virtualenv(), cd(directory)):
-                if should_pip_install:
-                    pip_install()
-                if should_migrate:
+def activate_release(directory, backupdb):
+    """
+    Switch to a src directory built by prepare_release_ahead.
+
+    The deployment lock is only held to install the requirements in the
+    shared virtualenv and collect the static files outside of the src
+    directory (or those prepare_release_ahead couldn't collect yet) when they
+    changed, or all of them when STATIC_ROOT is unknown, migrate, and switch
+    the src symlink.
+    """
+    with contextlib.nested(cd_project(), record_timings(None, step='activate',
+                                                        directory=directory)) as (_, timer):
+        acquire_deployment_lock(directory)
+        try:
+            # Read again under the lock, nobody can deploy in between anymore
+            forget_remote_state()
+            release, changes = read_prepared_release(directory)
+            gitref = timer.context['ref'] = release['ref']
+            with contextlib.nested(use_virtualenv(directory), cd(directory)):
+                if 'requirements' in changes and not use_virtualenv_snapshots():
+                    pip_install(release['wheelhouse'] or None)
+                    generate_pyc(previous_dir=os.path.join('..', SRC_DIR))
+                if changes & MIGRATE_CHANGES:
                     migrate(backupdb)
+                static_root = get_static_root(directory)
+                if release.get('static') == '0':
+                    # Postponed until the requirements were installed
+                    if static_root and static_root is not UNKNOWN_STATIC_ROOT:
+                        link_previous_static(static_root)
+                    collectstatic()
+                elif static_root is UNKNOWN_STATIC_ROOT or (
+                        changes & COLLECTSTATIC_CHANGES and static_root is None):
+                    collectstatic()
+            run('rm {dir}/{file}'.format(dir=directory, file=RELEASE_FILE))
+        except:
+            release_deployment_lock()
+            raise
+        log_deploy(gitref, directory)
+        commit_deployment_lock()
+        reload_uwsgi()
+        cleanup_history(DEFAULT_HISTORY_SIZE, current_src=directory)
 
-                collectstatic()
 
-            with contextlib.nested(use_virtualenv(), cd(directory)):
-                generate_pyc()
+def execute_parallel(func, hosts, pool_size, *args):
+    """
+    Run func on every host at once, with at most pool_size hosts at a time.
 
-            if should_pip_install:
-                # "pip install" generates pyc files in site-packages
-                # but "pip install -e" doesn't generate any pyc files
-                virtualenv_src = os.path.join(VIRTUALENV, 'src')
-                with contextlib.nested(use_virtualenv(), cd(directory)):
-                    generate_pyc()
+    Unlike execute(), a failure on one host doesn't abort the whole run.
+    Returns a tuple of ({host: result}, failed_hosts).
+    """
+    @functools.wraps(func)
+    def host_task(*args):
+        # Children inherit our warn_only, don't let it hide failures
+        with settings(warn_only=False):
+            return (func(*args),)
 
-            with hide('running', 'stdout'):
-                server_time = run('TZ=America/Denver date')
-            append(DEPLOY_LOG, '{date}:\t{user}\t{dir}\t{ref}'.format(
-                date=server_time, ref=gitref, dir=directory, user=getpass.getuser(),
-            ))
+    with settings(warn_only=True):
+        results = execute(parallel(pool_size=pool_size)(host_task), *args, hosts=hosts)
+
+    succeeded = dict((host, result[0]) for host, result in results.items()
+                     if isinstance(result, tuple))
+    failed = [host for host in hosts if host not in succeeded]
+    return succeeded, failed
+
+
+@fresh_remote_state
+def check_fast_forward_on_host(gitref):
+    with cd_project():
+        check_fast_forward(gitref, get_last_deploy())
 
-        reload_uwsgi()
-        cleanup_history(DEFAULT_HISTORY_SIZE)
+
+@fresh_remote_state
+def prepare_on_host(gitref, qad, wheelhouses):
+    """
+    Take the lock and build a new src directory, but don't migrate or switch
+    to it yet.
+    """
+    with contextlib.nested(record_timings(gitref, step='prepare'),
+                           cd_project()) as (timer, _):
+        directory = reserve_src_dir()
+        timer.context['directory'] = directory
+        acquire_locked_src_dir(directory)
+        try:
+            release = prepare_release(gitref, directory, qad,
+                                      wheelhouses.get(env.host_string))
+            install_release(release, backupdb=False, run_migrations=False)
+        except:
+            release_deployment_lock()
+            raise
+        return release
+
+
+def migrate_on_host(gitref, releases, backupdb):
+    directory = releases[env.host_string].directory
+    with contextlib.nested(record_timings(gitref, step='migrate', directory=directory),
+                           cd_project(directory),
+                           use_virtualenv(directory)):
+        migrate(backupdb)
+
+
+@fresh_remote_state
+def activate_on_host(gitref, releases):
+    release = releases[env.host_string]
+    with contextlib.nested(record_timings(gitref, step='activate',
+                                          directory=release.directory),
+                           cd_project()):
+        log_deploy(gitref, release.directory)
+        commit_deployment_lock()
+        reload_uwsgi(release.vassal_file)
+
+
+def unlock_on_host():
+    with cd_project():
+        release_deployment_lock()
+
+
+@fresh_remote_state
+def cleanup_on_host(releases):
+    with cd_project():
+        cleanup_history(DEFAULT_HISTORY_SIZE,
+                        current_src=releases[env.host_string].directory)
+
+
+@runs_once
+def push_parallel(gitref, qad, backupdb, pool_size=DEFAULT_POOL_SIZE,
+                  migrate_host=None):
+    """
+    Push the last changes to all the hosts at once
+
+    The new src directories are prepared on every host in parallel, then the
+    migrations are run once on migrate_host (defaults to the first host) and
+    finally every host switches to its new src directory and reloads.
+    """
+    hosts = env.all_hosts
+    migrate_host = migrate_host or hosts[0]
+    if migrate_host not in hosts:
+        abort(red("{host} isn't one of {hosts}".format(
+            host=migrate_host, hosts=', '.join(hosts)), bold=True))
+
+    # Prompts can't be answered from the parallel workers
+    execute(check_fast_forward_on_host, gitref, hosts=hosts)
+    # Extract once, the workers will find it in the cache
+    get_extract_dir(gitref)
+
+    # Before taking the locks. If it fails on a host, pip will use the index.
+    wheelhouses, _ = execute_parallel(build_wheelhouse, hosts, pool_size, gitref)
+
+    releases, failed = execute_parallel(prepare_on_host, hosts, pool_size, gitref, qad,
+                                        wheelhouses)
+    if failed:
+        execute_parallel(unlock_on_host, list(releases), pool_size)
+        abort(red("Couldn't prepare the release on {}".format(', '.join(failed)),
+                  bold=True))
+
+    if any(release.should_migrate for release in releases.values()):
+        try:
+            execute(migrate_on_host, gitref, releases, backupdb, hosts=[migrate_host])
+        except SystemExit:
+            execute_parallel(unlock_on_host, hosts, pool_size)
+            raise
+
+    _, failed = execute_parallel(activate_on_host, hosts, pool_size, gitref, releases)
+    if failed:
+        abort(red("Couldn't switch to the new release on {}".format(', '.join(failed)),
+                  bold=True))
+
+    execute_parallel(cleanup_on_host, hosts, pool_size, releases)
 
 
 @task
+@fresh_remote_state
 def reload_last_push():
     """
     Reload the code (pip install, migrate, and touch the vassal).
     This should be idem-potent.
     """
-    directory = get_latest_src_dir()
-    with contextlib.nested(cd_project(directory), use_virtualenv()):
+    directory = get_current_src_dir()
+    with contextlib.nested(cd_project(directory), use_virtualenv(directory)):
         pip_install()
         migrate()
         collectstatic()
         reload_uwsgi()
 
 
+def unmigrate(targets, backupdb):
+    """
+    Migrate back to the targets, given as app:migration
+    """
+    if backupdb:
+        run('python manage.py backupdb')
+    for target in targets:
+        app, migration = target.split(':')
+        run('python manage.py migrate --noinput {app} {migration}'.format(
+            app=pipes.quote(app), migration=pipes.quote(migration)))
+
+
+def get_rollback_target(entries, current, directories):
+    """
+    Returns the LogEntry of the deploy before the current one whose src
+    directory is one of directories, None if there's none.
+    """
+    current_deploys = [i for i, entry in enumerate(entries) if entry.dir == current]
+    before = entries[:current_deploys[-1]] if current_deploys else entries
+    for entry in reversed(before):
+        if entry.dir != current and entry.dir in directories:
+            return entry
+    return None
+
+
 @task
-def rollback():
+@fresh_remote_state
+def rollback(directory=None, migrations=None, backupdb=True, force=False):
     """
     Rollback the code to the previous deployed version.
+
+    The src symlink is switched to the src directory deployed before the
+    current one according to the deploy log, or to directory (one of those
+    kept by cleanup), and uwsgi is reloaded.  A directory that was never
+    deployed (a failed deploy, or prepared and never activated) is refused
+    unless force=1.  With env.virtualenv_mode = 'snapshot', the virtualenv is
+    switched along with it.  The migrations aren't rolled back unless asked with
+    migrations=app:0004 (several separated by ';'); they are then migrated
+    back with the current code before switching.
     """
-    # TODO:
-    #   * cp -rl previous_dir new_dir.last_number
-    #   * find the ghost migration (how?)
-    #   * run the migrations back
-    print red("** This is not implemented yet **", bold=True)
-    local('false')
+    env.force = is_true(force)
+    state = get_remote_state()
+    with cd_project():
+        current = state.current
+        retained = state.directories
+        # The whole log, the deploy before the current one can be anywhere in it
+        entries = read_deploy_log()
+        if directory is None:
+            entry = get_rollback_target(entries, current, retained)
+            if entry is None:
+                abort(red("There's no previously deployed src directory to roll back to",
+                          bold=True))
+            directory = entry.dir
+        elif directory not in retained:
+            abort(red("{directory} isn't one of the src directories: {retained}".format(
+                directory=directory, retained=', '.join(retained)), bold=True))
+        else:
+            deploys = [e for e in entries if e.dir == directory]
+            entry = deploys[-1] if deploys else None
+            if entry is None and not env.force:
+                abort(red("{} was never deployed. Rerun with force=1 to roll back to it"
+                          " anyway.".format(directory), bold=True))
+        if directory == current:
+            abort(red("{} is already the current src directory".format(directory), bold=True))
+
+        acquire_deployment_lock(directory)
+        try:
+            if migrations:
+                with contextlib.nested(use_virtualenv(current), cd(current)):
+                    unmigrate(migrations.split(';'), is_true(backupdb))
+        except:
+            release_deployment_lock()
+            raise
+        commit_deployment_lock()
+        if entry is not None:
+            log_deploy(entry.hash, directory)
+        reload_uwsgi()
+    print blue('Rolled back from {current} to {directory}'.format(
+        current=current, directory=directory))
 
 
 @task
-def cleanup(size=1, superclean=True):
+@fresh_remote_state
+def cleanup(size=1, superclean=True, background=True):
     """
     Cleanup the previous deployed version. Just keep the current deployed one.
 
+    With background=0, wait until the old versions are deleted.
     You have to specify the role with -R <live,dev>
     """
     size = int(size)
     if size < 1:
         raise ValueError("The history size can't be less than 1")
-    return cleanup_history(size-1, superclean=is_true(superclean))
+    return cleanup_history(size-1, superclean=is_true(superclean),
+                           background=is_true(background))
 
 
 @task
 @roles('live')
-def deploy(branch='origin/live', force=False, backupdb=True):
+def deploy(branch='origin/live', force=False, backupdb=True, parallel_hosts=False,
+           pool_size=DEFAULT_POOL_SIZE, migrate_host=None):
     """
     Deploy the live branch to the live server
+
+    With parallel_hosts=1, all the live hosts are deployed at once (at most
+    pool_size at a time) and the migrations only run on migrate_host.
     """
     env.force = is_true(force)
-    local('git fetch --all')
+    fetch_remotes()
     gitref = get_git_ref(branch)
+    if is_true(parallel_hosts):
+        return push_parallel(gitref, False, is_true(backupdb), int(pool_size),
+                             migrate_host)
     return push(gitref, False, is_true(backupdb))
 
 
 @task
 @roles('dev')
-def stage(branch='HEAD', qad=True, force=False, backupdb=True):
+def stage(branch='HEAD', qad=True, force=False, backupdb=True, parallel_hosts=False,
+          pool_size=DEFAULT_POOL_SIZE, migrate_host=None):
     """
     Deploy the current branch to the dev server
+
+    See deploy for parallel_hosts, pool_size and migrate_host.
     """
     env.force = is_true(force)
     gitref = get_git_ref(branch)
+    if is_true(parallel_hosts):
+        return push_parallel(gitref, is_true(qad), is_true(backupdb), int(pool_size),
+                             migrate_host)
     return push(gitref, is_true(qad), is_true(backupdb))
 
 
 @task
-def fetch_dbdump():
+@fresh_remote_state
+def prepare(branch='HEAD', qad=True):
+    """
+    Prepare a new src directory without taking the deployment lock
+
+    The code is uploaded, the dependencies installed (in a virtualenv
+    snapshot, or later in the shared virtualenv), the static and pyc files
+    built. Run activate to migrate and switch to it.
+    You have to specify the role with -R <live,dev>
+    """
+    gitref = get_git_ref(branch)
+    with record_timings(gitref, step='prepare') as timer:
+        directory = prepare_release_ahead(gitref, is_true(qad))
+        timer.context['directory'] = directory
+    print blue('Prepared {directory}, run activate:directory={directory} to switch to it'.format(
+        directory=directory))
+
+
+@task
+@fresh_remote_state
+def activate(directory=None, backupdb=True, force=False):
+    """
+    Migrate and switch to a src directory built by prepare
+    (activate:directory=src.NNNNN), holding the deployment lock only for that
+    You have to specify the role with -R <live,dev>
+    """
+    env.force = is_true(force)
+    if directory is None:
+        # The latest one might still be being prepared by someone else
+        abort(red("Give the src directory printed by prepare, "
+                  "activate:directory=src.NNNNN", bold=True))
+    activate_release(directory, is_true(backupdb))
+
+
+def get_dump_compressor():
+    """
+    Returns the command compressing the dumps on the server and the extension
+    of its files.
+    """
+    available = run('command -v {0}'.format(' '.join(name for name, _, _ in DUMP_COMPRESSORS)),
+                    quiet=True)
+    programs = set(os.path.basename(path) for path in available.split())
+    for name, command, extension in DUMP_COMPRESSORS:
+        if name in programs:
+            return command, extension
+    return DUMP_COMPRESSORS[-1][1:]
+
+
+def dump_database(db_name, path, compress):
+    """
+    Dumps the database in ``path`` on the server, returns its checksum.
+    """
+    # The plain format is deterministic, the custom one contains the date
+    with hide('stdout'), prefix('umask 077'):
+        run('mkdir -p {dir} && set -o pipefail && '
+            'pg_dump --no-owner --no-privileges {db} | {compress} > {path}'.format(
+                dir=os.path.dirname(path), db=pipes.quote(db_name), compress=compress,
+                path=path))
+        return run('sha256sum {0}'.format(path)).split()[0]
+
+
+@task
+def fetch_dbdump(db_name=None, path=None):
     """
     Fetch a database dump (you have to specify the role with -R <live,dev>)
+
+    The database is env.db_name, or named after the project, unless db_name
+    is given; it isn't checked against the Django settings.  The dump is
+    compressed on the server and kept in a local cache keyed by its checksum,
+    a dump that's already in the cache isn't transferred again.  Its path is
+    printed, or it's hard linked to path.  The cache is evicted according to
+    env.dump_cache_count, env.dump_cache_max_age (in days) and
+    env.dump_cache_size (in bytes).
     """
-    print red("** This is not implemented yet **", bold=True)
-    local('false')
+    db_name = db_name or env.get('db_name') or env.project_name
+    compress, extension = get_dump_compressor()
+    remote_path = os.path.join(DUMPS_DIR, '.fetch-{user}-{time}{ext}'.format(
+        user=getpass.getuser(), time=int(time.time()), ext=extension))
+
+    with cd_project():
+        try:
+            checksum = dump_database(db_name, remote_path, compress)
+            dump_path = dumpcache.lookup(checksum, extension)
+            if dump_path:
+                print blue('The dump is already in the cache')
+            else:
+                # Hidden from the cache until it's complete
+                tmp_path = os.path.join(dumpcache.get_cache_dir(),
+                                        '.{0}{1}'.format(checksum, extension))
+                try:
+                    get(remote_path, tmp_path)
+                    dump_path = dumpcache.store(tmp_path, checksum, extension)
+                finally:
+                    # Eviction doesn't see the hidden files, don't leave them
+                    if os.path.exists(tmp_path):
+                        os.unlink(tmp_path)
+        finally:
+            run('rm -f {0}'.format(remote_path))
+
+    dumpcache.evict(
+        max_count=int(env.get('dump_cache_count', dumpcache.DEFAULT_MAX_COUNT)),
+        max_age=float(env.get('dump_cache_max_age', dumpcache.DEFAULT_MAX_AGE / 86400)) * 86400,
+        max_size=int(env.get('dump_cache_size', dumpcache.DEFAULT_MAX_SIZE)),
+        keep=[dump_path],
+    )
+    if path:
+        if os.path.exists(path):
+            os.unlink(path)
+        os.link(dump_path, path)
+        dump_path = path
+    print dump_path
+    return dump_path
+
+
+@task
+def history(count=10, user=None, ref=None, directory=None):
+    """
+    Show the last deploys, optionally only those of a user, ref or src directory
+    """
+    with cd_project():
+        entries = read_deploy_log(int(count), username=user, ref=ref, directory=directory)
+    for entry in entries:
+        print '{date}  {user:<12} {dir}  {ref}'.format(
+            date=entry.human_date.rstrip(':'),
+            user=entry.username,
+            dir=entry.dir,
+            ref=entry.hash[:8],
+        )
 
 
 @task
+@fresh_remote_state
 def django(command):
     """
     Run a shell on the server
     """
-    src_directory = get_latest_src_dir()
+    src_directory = get_current_src_dir()
     with cd_project(src_directory):
-        with use_virtualenv():
+        with use_virtualenv(src_directory):
             run("python manage.py {}".format(command))
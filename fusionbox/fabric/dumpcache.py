@@ -0,0 +1,98 @@
+"""
+Local cache of database dumps, keyed by the checksum of the compressed dump.
+
+The dumps are compressed deterministically (``gzip -n``, zstd), so fetching a
+database that didn't change gives the same checksum and doesn't need to be
+transferred again.
+"""
+import hashlib
+import os
+import time
+
+from fusionbox.fabric.utils import cache_path
+
+
+DEFAULT_MAX_COUNT = 5
+DEFAULT_MAX_AGE = 30 * 24 * 3600
+DEFAULT_MAX_SIZE = 10 * 1024 ** 3
+CHUNK_SIZE = 1024 ** 2
+
+
+def get_cache_dir(cache_dir=None):
+    cache_dir = cache_dir or cache_path('dumps')
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    return cache_dir
+
+
+def file_checksum(path):
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def list_dumps(cache_dir):
+    """
+    Returns the ``(path, size, mtime)`` of the cached dumps, most recently used
+    first.
+    """
+    dumps = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.startswith('.') or not os.path.isfile(path):
+            continue
+        stat = os.stat(path)
+        dumps.append((path, stat.st_size, stat.st_mtime))
+    dumps.sort(key=lambda dump: dump[2], reverse=True)
+    return dumps
+
+
+def lookup(checksum, extension, cache_dir=None):
+    """
+    Returns the path of the cached dump with this checksum, None if there's
+    none.
+    """
+    path = os.path.join(get_cache_dir(cache_dir), checksum + extension)
+    if not os.path.exists(path):
+        return None
+    # Mark as recently used
+    os.utime(path, None)
+    return path
+
+
+def store(tmp_path, checksum, extension, cache_dir=None):
+    """
+    Moves a downloaded dump into the cache, after checking its checksum.
+    """
+    actual = file_checksum(tmp_path)
+    if actual != checksum:
+        os.unlink(tmp_path)
+        raise ValueError('The checksum of the dump is {0}, expected {1}'.format(actual, checksum))
+    path = os.path.join(get_cache_dir(cache_dir), checksum + extension)
+    os.rename(tmp_path, path)
+    return path
+
+
+def evict(cache_dir=None, max_count=DEFAULT_MAX_COUNT, max_age=DEFAULT_MAX_AGE,
+          max_size=DEFAULT_MAX_SIZE, keep=()):
+    """
+    Removes the least recently used dumps beyond ``max_count`` dumps,
+    ``max_size`` bytes or ``max_age`` seconds.  Returns the removed paths.
+    """
+    now = time.time()
+    removed = []
+    count = size = 0
+    dumps = list_dumps(get_cache_dir(cache_dir))
+    # The dumps to keep take their place first
+    dumps.sort(key=lambda dump: dump[0] not in keep)
+    for path, dump_size, mtime in dumps:
+        count += 1
+        size += dump_size
+        if path not in keep and (count > max_count or size > max_size or now - mtime > max_age):
+            os.unlink(path)
+            removed.append(path)
+            count -= 1
+            size -= dump_size
+    return removed
@@ -0,0 +1,179 @@
+"""
+Persistent cache of ``git archive`` extractions, keyed by tree hash.
+
+A new tree is built from the most recently used extraction by hard linking it
+and only extracting the files that changed between both trees.  Entries share
+their unchanged files, so they must never be modified in place.
+"""
+import errno
+import os
+import pipes
+import shutil
+
+from fabric.api import local, hide
+
+from fusionbox.fabric.git import get_tree_hash, has_tree
+from fusionbox.fabric.utils import cache_path
+
+
+DEFAULT_MAX_SIZE = 2 * 1024 ** 3
+META_SUFFIX = '.meta'
+# Keep the command lines of git archive reasonably short
+ARCHIVE_CHUNK_SIZE = 200
+
+
+def list_entries(cache_dir):
+    """
+    Returns the ``(tree, size)`` of the cached extractions, most recently used
+    first.
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith(META_SUFFIX):
+            continue
+        meta = os.path.join(cache_dir, name)
+        with open(meta) as f:
+            size = int(f.read() or 0)
+        entries.append((os.path.getmtime(meta), name[:-len(META_SUFFIX)], size))
+    entries.sort(reverse=True)
+    return [entry[1:] for entry in entries]
+
+
+def hardlink_tree(src, dst):
+    """
+    Recreates the ``src`` directory tree in ``dst``, hard linking the files.
+    """
+    for dirpath, dirnames, filenames in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(dirpath, src))
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), os.path.join(target, name))
+            elif not os.path.isdir(path):
+                os.link(path, os.path.join(target, name))
+
+
+def tree_size(path):
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            size += os.lstat(os.path.join(dirpath, name)).st_size
+    return size
+
+
+def remove_path(root, path):
+    """
+    Removes ``path`` from ``root`` along with the directories it leaves empty.
+    """
+    try:
+        os.unlink(os.path.join(root, path))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    parent = os.path.dirname(path)
+    while parent:
+        try:
+            os.rmdir(os.path.join(root, parent))
+        except OSError:
+            break
+        parent = os.path.dirname(parent)
+
+
+def diff_trees(old, new):
+    """
+    Returns the lists of paths changed and removed between two trees, leaving
+    out submodules (git archive doesn't include them).
+    """
+    with hide('running'):
+        output = local('git diff-tree -r -z --no-renames {0} {1}'.format(old, new),
+                       capture=True)
+    fields = output.split('\0')
+    changed, removed = [], []
+    for info, path in zip(fields[0::2], fields[1::2]):
+        old_mode, new_mode, _, _, status = info.lstrip(':').split(' ')
+        if status == 'D':
+            if old_mode != '160000':
+                removed.append(path)
+        elif new_mode != '160000':
+            if old_mode == '160000':
+                removed.append(path)
+            changed.append(path)
+    return changed, removed
+
+
+def update_extraction(directory, old, new):
+    """
+    Turns the extraction of the ``old`` tree in ``directory`` into the one of
+    ``new``.
+    """
+    changed, removed = diff_trees(old, new)
+    for path in removed + changed:
+        # Don't write through the hard links shared with the old entry
+        remove_path(directory, path)
+    for i in range(0, len(changed), ARCHIVE_CHUNK_SIZE):
+        local('git archive {tree} -- {paths} | tar x -C {dir}'.format(
+            tree=new,
+            paths=' '.join(pipes.quote(p) for p in changed[i:i + ARCHIVE_CHUNK_SIZE]),
+            dir=pipes.quote(directory),
+        ))
+
+
+def evict(cache_dir, max_size, keep=()):
+    """
+    Removes the least recently used extractions until the cache fits in
+    ``max_size`` bytes.
+    """
+    entries = list_entries(cache_dir)
+    total = sum(size for _, size in entries)
+    for tree, size in reversed(entries):
+        if total <= max_size:
+            break
+        if tree in keep:
+            continue
+        # Remove the meta first so that nobody picks it up as a base
+        os.unlink(os.path.join(cache_dir, tree + META_SUFFIX))
+        shutil.rmtree(os.path.join(cache_dir, tree), ignore_errors=True)
+        total -= size
+
+
+def extract_tree(ref, cache_dir=None, max_size=DEFAULT_MAX_SIZE):
+    """
+    Returns a directory containing the files of ``ref``, extracting them if
+    they aren't in the cache yet.
+    """
+    cache_dir = cache_dir or cache_path('extract')
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    tree = get_tree_hash(ref)
+    directory = os.path.join(cache_dir, tree)
+    meta = os.path.join(cache_dir, tree + META_SUFFIX)
+
+    if os.path.exists(meta):
+        # Mark as recently used
+        os.utime(meta, None)
+        return directory
+
+    tmp_dir = '{0}.tmp-{1}'.format(directory, os.getpid())
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    for base, _ in list_entries(cache_dir):
+        if has_tree(base):
+            hardlink_tree(os.path.join(cache_dir, base), tmp_dir)
+            update_extraction(tmp_dir, base, tree)
+            break
+    else:
+        os.makedirs(tmp_dir)
+        local('git archive {tree} | tar x -C {dir}'.format(tree=tree, dir=pipes.quote(tmp_dir)))
+
+    try:
+        os.rename(tmp_dir, directory)
+    except OSError:
+        # Another process extracted the same tree in the meantime
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    with open(meta, 'w') as f:
+        f.write(str(tree_size(directory)))
+
+    evict(cache_dir, max_size, keep=[tree])
+    return directory
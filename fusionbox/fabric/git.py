@@ -1,4 +1,4 @@
-from fabric.api import local, run, settings
+from fabric.api import local, run, settings, hide
 
 
 def get_git_branch():
@@ -32,3 +32,42 @@ def is_repo_clean():
     """
     with settings(warn_only=True):
         return run("git status 2>&1|grep 'nothing to commit' > /dev/null").succeeded
+
+
+def get_tree_hash(ref):
+    """
+    Returns the hash of the tree of ``ref`` in the local git repository.
+    """
+    return local('git rev-parse {0}^{{tree}}'.format(ref), capture=True)
+
+
+def has_tree(tree):
+    """
+    Checks if ``tree`` is available in the local git repository.
+    """
+    with settings(hide('running', 'stdout', 'stderr', 'warnings'), warn_only=True):
+        return local('git cat-file -e {0}'.format(tree), capture=True).succeeded
+
+
+def get_tree_listing(ref):
+    """
+    Returns the raw (NUL separated) recursive listing of the files in ``ref``.
+    """
+    with hide('running'):
+        return local('git ls-tree -r -z {0}'.format(ref), capture=True)
+
+
+def parse_tree_listing(listing):
+    """
+    Parses the output of ``get_tree_listing`` into a dict mapping the path of
+    every blob to its ``(mode, hash)``.
+    """
+    entries = {}
+    for line in listing.split('\0'):
+        if not line:
+            continue
+        info, path = line.split('\t', 1)
+        mode, object_type, object_hash = info.split(' ')
+        if object_type == 'blob':
+            entries[path] = (mode, object_hash)
+    return entries
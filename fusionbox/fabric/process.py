@@ -0,0 +1,361 @@
+"""
+Local subprocesses for the development stack.
+"""
+import errno
+import httplib
+import os
+import select
+import socket
+import subprocess
+import time
+import urllib2
+from contextlib import contextmanager
+from urlparse import urlparse
+
+
+CHUNK_SIZE = 64 * 1024
+# Capacity of a pipe on Linux
+PIPE_SIZE = 64 * 1024
+HEALTH_CHECK_TIMEOUT = 0.2
+BACKOFF_BASE = 1
+BACKOFF_MAX = 30
+# A process that ran that long is restarted without waiting
+BACKOFF_RESET = 30
+STATS_INTERVAL = 60
+
+
+def start_subprocess(dir, cmd, cwd=None):
+    # Python children would otherwise buffer the output going to the pipes
+    environ = dict(os.environ, PYTHONUNBUFFERED='1')
+    return subprocess.Popen(cmd, shell=True,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            cwd=os.path.join(cwd or os.getcwd(), dir),
+                            env=environ)
+
+
+def terminate_subprocesses(processes):
+    # We clean up any subprocesses that haven't finished with a SIGTERM
+    procs_to_term = [p for p in processes if p.poll() is None]
+    try:
+        [p.terminate() for p in procs_to_term]
+        [p.wait() for p in procs_to_term]
+    except KeyboardInterrupt:
+        # User issued an interrupt, send SIGKILL to end immediately
+        [p.kill() for p in procs_to_term if p.poll() is None]
+        [p.wait() for p in procs_to_term]
+
+
+@contextmanager
+def run_subprocesses(cmds):
+    """
+    Returns a list of tuples of command, Popen object.  During __close__, the
+    list of processes is polled for unfinished processes and attempts to close
+    them.
+    """
+    processes = []
+    cwd = os.getcwd()
+    try:
+        for dir, cmd in cmds:
+            processes.append((cmd, start_subprocess(dir, cmd, cwd)))
+        yield processes
+    finally:
+        terminate_subprocesses([p for _, p in processes])
+
+
+class LineReader(object):
+    """
+    Reads the output of processes line by line, as soon as it is written.
+    """
+    def __init__(self, chunk_size=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        # fd: [name, stream, incomplete line]
+        self.readers = {}
+
+    def add(self, name, process):
+        for stream, pipe in (('stdout', process.stdout), ('stderr', process.stderr)):
+            if pipe is not None:
+                self.readers[pipe.fileno()] = [name, stream, '']
+
+    def remove(self, process):
+        """
+        Stops reading the output of ``process`` and closes its pipes, even if
+        a child it left behind still holds them.  Returns the lines of what
+        was left in the pipes.
+        """
+        lines = []
+        for pipe in (process.stdout, process.stderr):
+            if pipe is None or pipe.closed:
+                continue
+            fd = pipe.fileno()
+            if fd in self.readers:
+                # Without waiting, at most what the pipe can hold
+                for _ in range(max(1, PIPE_SIZE // self.chunk_size)):
+                    if not select.select([fd], [], [], 0)[0]:
+                        break
+                    data = os.read(fd, self.chunk_size)
+                    if not data:
+                        break
+                    lines.extend(self._feed(fd, data))
+                reader = self.readers.pop(fd)
+                if reader[2]:
+                    lines.append(tuple(reader))
+            pipe.close()
+        return lines
+
+    def _feed(self, fd, data):
+        reader = self.readers[fd]
+        chunks = (reader[2] + data).split('\n')
+        reader[2] = chunks.pop()
+        return [(reader[0], reader[1], line) for line in chunks]
+
+    def __nonzero__(self):
+        return bool(self.readers)
+
+    def read(self, timeout=None):
+        """
+        Waits up to ``timeout`` seconds for output, then returns the list of
+        ``(name, stream, line)`` that were written.  ``stream`` is ``'stdout'``
+        or ``'stderr'``.
+        """
+        try:
+            ready, _, _ = select.select(list(self.readers), [], [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        lines = []
+        for fd in ready:
+            data = os.read(fd, self.chunk_size)
+            if not data:
+                reader = self.readers.pop(fd)
+                if reader[2]:
+                    lines.append(tuple(reader))
+                continue
+            lines.extend(self._feed(fd, data))
+        return lines
+
+
+def multiplex_output(processes, chunk_size=CHUNK_SIZE):
+    """
+    Yields ``(command, stream, line)`` for every line written by the processes
+    returned by ``run_subprocesses``, as soon as it is written.  ``stream`` is
+    ``'stdout'`` or ``'stderr'``.  Stops when all the processes closed their
+    output.
+    """
+    reader = LineReader(chunk_size)
+    for cmd, p in processes:
+        reader.add(cmd, p)
+    while reader:
+        for line in reader.read():
+            yield line
+
+
+def check_health(url, timeout=HEALTH_CHECK_TIMEOUT):
+    """
+    Returns whether something answers at ``url``: ``tcp://host:port`` accepts
+    connections, or ``http://...`` answers without a server error.
+    """
+    parsed = urlparse(url)
+    try:
+        if parsed.scheme == 'tcp':
+            socket.create_connection((parsed.hostname, parsed.port), timeout).close()
+        else:
+            urllib2.urlopen(url, timeout=timeout).close()
+    except urllib2.HTTPError as e:
+        return e.code < 500
+    except (socket.error, urllib2.URLError, httplib.HTTPException):
+        return False
+    return True
+
+
+def read_process_stats(pid):
+    """
+    Returns the CPU time in seconds and the resident memory in bytes of a
+    process, from /proc.  Returns None where there's no /proc.
+    """
+    try:
+        with open('/proc/{0}/stat'.format(pid)) as f:
+            # The command name can contain spaces, the fields start after it
+            fields = f.read().rsplit(')', 1)[1].split()
+    except IOError:
+        return None
+    cpu_ticks = int(fields[11]) + int(fields[12])
+    rss_pages = int(fields[21])
+    return (float(cpu_ticks) / os.sysconf('SC_CLK_TCK'),
+            rss_pages * os.sysconf('SC_PAGE_SIZE'))
+
+
+class Program(object):
+    """
+    A command run by the ``Supervisor``.
+
+    The program starts once all the programs it comes ``after`` are healthy.
+    It is healthy once ``health_check`` (see ``check_health``) passes, or right
+    away without one.  It is restarted with an exponential backoff when it
+    exits, unless ``restart`` is False.
+    """
+    def __init__(self, name, cmd, dir='.', after=(), health_check=None, restart=True):
+        self.name = name
+        self.cmd = cmd
+        self.dir = dir
+        self.after = list(after)
+        self.health_check = health_check
+        self.restart = restart
+
+        self.state = 'waiting'
+        self.process = None
+        self.started_at = None
+        self.restart_at = None
+        self.failures = 0
+        self.restarts = 0
+        self.cpu_percent = None
+        self.rss = None
+        self._cpu_sample = None
+
+
+class Supervisor(object):
+    """
+    Runs programs, restarts them when they exit and shows their output.
+
+    ``write(name, stream, line)`` shows a line of output, ``stream`` is
+    ``'stdout'``, ``'stderr'`` or ``'supervisor'`` for the messages of the
+    supervisor.  ``clock`` returns the current time, ``time.time`` by default.
+    """
+    def __init__(self, programs, write, tick=0.5, stats_interval=STATS_INTERVAL,
+                 clock=time.time):
+        self.programs = order_programs(programs)
+        self.write = write
+        self.tick = tick
+        self.stats_interval = stats_interval
+        self.clock = clock
+        self.reader = LineReader()
+        self._stats_at = None
+
+    def log(self, message):
+        self.write('supervisor', 'supervisor', message)
+
+    def run(self, duration=None):
+        """
+        Supervises the programs until interrupted, or for ``duration`` seconds.
+        """
+        started_at = self.clock()
+        self._stats_at = started_at + self.stats_interval
+        try:
+            while duration is None or self.clock() - started_at < duration:
+                self.step()
+                for name, stream, line in self.reader.read(self.tick):
+                    self.write(name, stream, line)
+        finally:
+            terminate_subprocesses([p.process for p in self.programs if p.process])
+            # Show what they wrote while terminating
+            for name, stream, line in self.reader.read(0):
+                self.write(name, stream, line)
+
+    def step(self):
+        if self._stats_at is None:
+            self._stats_at = self.clock() + self.stats_interval
+        now = self.clock()
+        states = dict((p.name, p.state) for p in self.programs)
+        for program in self.programs:
+            if program.state == 'waiting':
+                if all(states[name] == 'healthy' for name in program.after):
+                    self.start(program, now)
+            elif program.state == 'backoff':
+                if now >= program.restart_at:
+                    self.start(program, now)
+            elif program.state in ('starting', 'healthy'):
+                if program.process.poll() is not None:
+                    self.exited(program, now)
+                elif program.state == 'starting' and check_health(program.health_check):
+                    program.state = 'healthy'
+                    self.log('{0} is up after {1:.1f}s'.format(program.name, now - program.started_at))
+            states[program.name] = program.state
+
+        if self.stats_interval and now >= self._stats_at:
+            self._stats_at = now + self.stats_interval
+            self.update_stats(now)
+            for line in self.stats():
+                self.log(line)
+
+    def start(self, program, now):
+        if program.state == 'backoff':
+            program.restarts += 1
+        program.process = start_subprocess(program.dir, program.cmd)
+        program.started_at = now
+        program._cpu_sample = (now, 0.0)
+        program.state = 'starting' if program.health_check else 'healthy'
+        self.reader.add(program.name, program.process)
+
+    def exited(self, program, now):
+        returncode = program.process.returncode
+        # The restarted process gets new pipes, maybe with the same fds
+        for name, stream, line in self.reader.remove(program.process):
+            self.write(name, stream, line)
+        if now - program.started_at > BACKOFF_RESET:
+            program.failures = 0
+        if not program.restart:
+            program.state = 'exited'
+            self.log('{0} exited with {1}'.format(program.name, returncode))
+            return
+        program.failures += 1
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (program.failures - 1))
+        program.restart_at = now + delay
+        program.state = 'backoff'
+        self.log('{0} exited with {1}, restarting in {2}s'.format(program.name, returncode, delay))
+
+    def update_stats(self, now):
+        for program in self.programs:
+            if program.state not in ('starting', 'healthy'):
+                program.cpu_percent = program.rss = None
+                continue
+            stats = read_process_stats(program.process.pid)
+            if stats is None:
+                continue
+            cpu, program.rss = stats
+            if program._cpu_sample:
+                sampled_at, sampled_cpu = program._cpu_sample
+                program.cpu_percent = 100 * (cpu - sampled_cpu) / max(now - sampled_at, 1e-6)
+            program._cpu_sample = (now, cpu)
+
+    def stats(self):
+        """
+        Returns a line of statistics per program.
+        """
+        lines = []
+        for program in self.programs:
+            line = '{0:<16} {1:<9} {2:>3} restarts'.format(
+                program.name, program.state, program.restarts)
+            if program.cpu_percent is not None:
+                line += ' {0:>5.1f}% cpu'.format(program.cpu_percent)
+            if program.rss is not None:
+                line += ' {0:>7.1f}M rss'.format(program.rss / 1024.0 ** 2)
+            lines.append(line)
+        return lines
+
+
+def order_programs(programs):
+    """
+    Returns the programs sorted so that each one comes after the programs it
+    depends on.  Raises ValueError for unknown or circular dependencies.
+    """
+    by_name = dict((p.name, p) for p in programs)
+    ordered, visiting, done = [], set(), set()
+
+    def visit(program):
+        if program.name in done:
+            return
+        if program.name in visiting:
+            raise ValueError('{0} depends on itself'.format(program.name))
+        visiting.add(program.name)
+        for name in program.after:
+            if name not in by_name:
+                raise ValueError('{0} comes after unknown program {1}'.format(program.name, name))
+            visit(by_name[name])
+        visiting.discard(program.name)
+        done.add(program.name)
+        ordered.append(program)
+
+    for program in programs:
+        visit(program)
+    return ordered
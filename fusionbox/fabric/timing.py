@@ -0,0 +1,166 @@
+"""
+Timing instrumentation for deploys.
+
+A ``Timer`` records the wall time, the number of remote commands and the
+number of bytes transferred of each phase of a deploy::
+
+    with Timer(host=env.host_string) as timer:
+        with phase('upload'):
+            ...
+    print timer.to_json_lines()
+
+While a timer is active, the commands run with the ``run`` and ``sudo`` of
+this module are counted in its current phase.  Code that transfers data
+reports it with ``count_bytes``.
+"""
+import functools
+import json
+import time
+from contextlib import contextmanager
+
+import fabric.operations
+
+
+_timers = []
+
+
+class Timer(object):
+    """
+    Records the phases of a deploy.  ``context`` is added to every line of the
+    report.
+    """
+    def __init__(self, **context):
+        self.context = context
+        self.phases = []
+        self.totals = {'commands': 0, 'bytes': 0}
+        self._stack = []
+        self._started_at = None
+        self._seconds = None
+
+    def __enter__(self):
+        _timers.append(self)
+        self._started_at = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._seconds = time.time() - self._started_at
+        _timers.remove(self)
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Times a phase.  Commands and bytes are counted in the innermost phase.
+        """
+        record = {'phase': name, 'commands': 0, 'bytes': 0}
+        self._stack.append(record)
+        started_at = time.time()
+        try:
+            yield record
+        finally:
+            record['seconds'] = round(time.time() - started_at, 3)
+            self._stack.pop()
+            self.phases.append(record)
+
+    def _count(self, key, n):
+        self.totals[key] += n
+        if self._stack:
+            self._stack[-1][key] += n
+
+    def count_command(self, n=1):
+        self._count('commands', n)
+
+    def count_bytes(self, n):
+        self._count('bytes', n)
+
+    def report(self):
+        """
+        Returns a list of dicts, one per phase in the order they finished, and a
+        last one with the totals.
+        """
+        total = {'phase': 'total', 'seconds': round(self.seconds, 3)}
+        total.update(self.totals)
+        lines = []
+        for record in self.phases + [total]:
+            line = dict(self.context)
+            line.update(record)
+            lines.append(line)
+        return lines
+
+    @property
+    def seconds(self):
+        if self._seconds is None:
+            return time.time() - self._started_at
+        return self._seconds
+
+    def to_json_lines(self):
+        return ''.join(json.dumps(line, sort_keys=True) + '\n' for line in self.report())
+
+    def summary(self):
+        """
+        Returns a human readable table of the phases.
+        """
+        return '\n'.join(
+            '{phase:<20} {seconds:>8.2f}s {commands:>4} commands {bytes:>10} bytes'.format(**line)
+            for line in self.report()
+        )
+
+
+def current_timer():
+    """
+    Returns the innermost active timer, None if there's none.
+    """
+    return _timers[-1] if _timers else None
+
+
+@contextmanager
+def phase(name):
+    """
+    Times a phase with the current timer, if any.
+    """
+    timer = current_timer()
+    if timer is None:
+        yield None
+    else:
+        with timer.phase(name) as record:
+            yield record
+
+
+def timed(name):
+    """
+    Decorator timing every call of the decorated function as a phase.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count_command(n=1):
+    timer = current_timer()
+    if timer is not None:
+        timer.count_command(n)
+
+
+def count_bytes(n):
+    timer = current_timer()
+    if timer is not None:
+        timer.count_bytes(n)
+
+
+def run(*args, **kwargs):
+    """
+    fabric's ``run``, counted by the current timer
+    """
+    count_command()
+    return fabric.operations.run(*args, **kwargs)
+
+
+def sudo(*args, **kwargs):
+    """
+    fabric's ``sudo``, counted by the current timer
+    """
+    count_command()
+    return fabric.operations.sudo(*args, **kwargs)
@@ -1,6 +1,12 @@
+import os as _os
+import re as _re
+from collections import namedtuple as _namedtuple
 from contextlib import contextmanager as _contextmanager
 
-from fabric.api import prefix, local, sudo
+from fabric.api import prefix, local
+from fabric.network import normalize as _normalize
+
+from fusionbox.fabric.timing import run, sudo
 
 
 @_contextmanager
@@ -23,8 +29,72 @@ def files_changed(version, files):
     return "diff" in local("git diff {0} HEAD -- {1}".format(version, files), capture=True)
 
 
+def cache_path(*parts):
+    """
+    Returns a path inside the local cache directory of the fabric helpers.
+    """
+    cache_home = _os.environ.get('XDG_CACHE_HOME') or _os.path.expanduser('~/.cache')
+    return _os.path.join(cache_home, 'fusionbox-fabric', *parts)
+
+
+def split_host_string(host_string):
+    """
+    Splits a fabric host string (``user@host:port``) into the ``user@host``
+    destination and the port that ssh and rsync expect, with fabric's
+    defaults for the missing parts.
+    """
+    user, host, port = _normalize(host_string)
+    return '{0}@{1}'.format(user, host), port
+
+
 def supervisor_command(action, name):
     """
     Performs a command on a supervisor process.
     """
     sudo('supervisorctl {0} {1}'.format(action, name))
+
+
+BATCH_MARKER = '__fusionbox_batch__'
+# run strips the leading newline of the first marker and the trailing one of
+# the last
+_BATCH_MARKER_RE = _re.compile(r'(?:^|\n){0} (\S+) (\d+)(?:\n|$)'.format(BATCH_MARKER))
+
+BatchResult = _namedtuple('BatchResult', ['stdout', 'return_code'])
+
+
+def run_batch(commands):
+    """
+    Runs several read-only ``commands`` in a single remote shell invocation
+    instead of one round trip each.
+
+    ``commands`` is a list of ``(key, command)`` tuples.  Returns a dict
+    mapping each key to a ``BatchResult`` holding the stdout and the return
+    code of its command.
+    """
+    script = ' ; '.join(
+        "( {command} ) ; printf '\\n{marker} {key} %d\\n' $?".format(
+            command=command,
+            marker=BATCH_MARKER,
+            key=key,
+        )
+        for key, command in commands
+    )
+    output = run(script, pty=False, quiet=True)
+    return parse_batch_output(output)
+
+
+def parse_batch_output(output):
+    """
+    Splits the output of ``run_batch``'s script into ``BatchResult``s.
+
+    The script prints a newline before each marker line, in case the output of
+    the command doesn't end with one.  Like the output of ``run``, the stdout
+    of each command is returned without its trailing newlines.
+    """
+    results = {}
+    start = 0
+    for match in _BATCH_MARKER_RE.finditer(output):
+        key, return_code = match.groups()
+        results[key] = BatchResult(output[start:match.start()].rstrip('\n'), int(return_code))
+        start = match.end()
+    return results
@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from fusionbox.fabric import bytecode
+
+
+class BytecodeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.previous = os.path.join(self.root, 'src.00001')
+        self.directory = os.path.join(self.root, 'src.00002')
+        os.makedirs(os.path.join(self.previous, 'app'))
+        os.makedirs(os.path.join(self.directory, 'app'))
+        for name in ('app/models.py', 'app/views.py'):
+            with open(os.path.join(self.previous, name), 'w') as f:
+                f.write('x = 1\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def bytecode(self, directory, name):
+        return bytecode.cache_from_source(os.path.join(directory, name))
+
+    def test_unchanged_files_reuse_the_previous_bytecode(self):
+        self.assertEqual(bytecode.main([self.previous]), 0)
+        # Like the upload, hard link the unchanged file and write the changed one
+        os.link(os.path.join(self.previous, 'app/models.py'),
+                os.path.join(self.directory, 'app/models.py'))
+        with open(os.path.join(self.directory, 'app/views.py'), 'w') as f:
+            f.write('x = 2\n')
+
+        to_compile, up_to_date, linked = bytecode.plan([(self.directory, self.previous)])
+        self.assertEqual(to_compile, [os.path.join(self.directory, 'app/views.py')])
+        self.assertEqual((up_to_date, linked), (0, 1))
+        self.assertTrue(os.path.samefile(self.bytecode(self.previous, 'app/models.py'),
+                                         self.bytecode(self.directory, 'app/models.py')))
+
+    def test_compiled_files_are_up_to_date(self):
+        sources = [os.path.join(self.previous, 'app/models.py'),
+                   os.path.join(self.previous, 'app/views.py')]
+        self.assertEqual(bytecode.compile_parallel(sources, jobs=2), [])
+        self.assertEqual(bytecode.plan([(self.previous, None)]), ([], 2, 0))
+
+    def test_recompiling_doesnt_write_through_a_hard_link(self):
+        bytecode.main([self.previous])
+        shutil.copy(os.path.join(self.previous, 'app/models.py'),
+                    os.path.join(self.directory, 'app/models.py'))
+        os.link(self.bytecode(self.previous, 'app/models.py'),
+                self.bytecode(self.directory, 'app/models.py'))
+        with open(self.bytecode(self.previous, 'app/models.py'), 'rb') as f:
+            previous_bytecode = f.read()
+
+        bytecode.compile_files([os.path.join(self.directory, 'app/models.py')])
+        with open(self.bytecode(self.previous, 'app/models.py'), 'rb') as f:
+            self.assertEqual(f.read(), previous_bytecode)
+        self.assertFalse(os.path.samefile(self.bytecode(self.previous, 'app/models.py'),
+                                          self.bytecode(self.directory, 'app/models.py')))
+
+    def test_syntax_errors_are_reported(self):
+        with open(os.path.join(self.directory, 'broken.py'), 'w') as f:
+            f.write('def (\n')
+        errors = bytecode.compile_files([os.path.join(self.directory, 'broken.py')])
+        self.assertEqual(len(errors), 1)
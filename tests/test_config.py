@@ -1,7 +1,9 @@
 from copy import copy
+import pickle
+from mock import patch
 import unittest
 
-from fusionbox.fabric.config import Env
+from fusionbox.fabric.config import Env, CircularReferenceError
 
 
 class EnvTestCase(unittest.TestCase):
@@ -22,6 +24,7 @@ class EnvTestCase(unittest.TestCase):
 
             'virtualenv': 'sammich',
             'vassal': 'sammich',
+            'db_name': 'sammich',
 
             'dev_project_name': 'sammich',
             'dev_tld': '.com',
@@ -37,6 +40,7 @@ class EnvTestCase(unittest.TestCase):
             'dev_backups_dir': 'backups',
             'dev_media_dir': 'media',
             'dev_media_path': '/var/www/sammich.com/media',
+            'dev_db_name': 'sammich',
 
             'live_project_name': 'sammich',
             'live_tld': '.com',
@@ -52,9 +56,11 @@ class EnvTestCase(unittest.TestCase):
             'live_backups_dir': 'backups',
             'live_media_dir': 'media',
             'live_media_path': '/var/www/sammich.com/media',
+            'live_db_name': 'sammich',
 
             'local_backups_dir': 'backups',
             'local_media_dir': 'media',
+            'local_db_name': 'sammich',
         }
 
     def test_env_has_default_values(self):
@@ -100,7 +106,7 @@ class EnvTestCase(unittest.TestCase):
         for k, v in self.defaults.iteritems():
             self.assertEqual(getattr(self.env, k), v)
 
-    def test_default_values_that_reference_each_other_cause_stack_overflow(self):
+    def test_default_values_that_reference_each_other_raise_a_circular_reference_error(self):
         class CircularEnv(Env):
             DEFAULTS = copy(Env.DEFAULTS)
             DEFAULTS['ouroboros_head'] = '{ouroboros_tail}'
@@ -108,7 +114,38 @@ class EnvTestCase(unittest.TestCase):
 
         ouroboros = CircularEnv()
 
-        self.assertRaises(RuntimeError, lambda: ouroboros.ouroboros_head)
+        with self.assertRaises(CircularReferenceError) as cm:
+            ouroboros.ouroboros_head
+        self.assertEqual(cm.exception.names,
+                         ['ouroboros_head', 'ouroboros_tail', 'ouroboros_head'])
+        self.assertIsInstance(cm.exception, RuntimeError)
+
+        # Setting one of them breaks the cycle
+        ouroboros.ouroboros_tail = 'tail'
+        self.assertEqual(ouroboros.ouroboros_head, 'tail')
+
+    def test_setting_a_value_updates_the_values_built_from_it(self):
+        self.assertEqual(self.env.live_media_path, '/var/www/sammich.com/media')
+        self.assertEqual(self.env.dev_project_path, '/var/www/sammich.com')
+
+        self.env.project_name = 'wrap'
+        self.assertEqual(self.env.live_media_path, '/var/www/wrap.com/media')
+
+        self.env.live_tld = '.net'
+        self.assertEqual(self.env.live_media_path, '/var/www/wrap.net/media')
+        self.assertEqual(self.env.dev_project_path, '/var/www/wrap.com')
+
+        del self.env.live_tld
+        self.assertEqual(self.env.live_media_path, '/var/www/wrap.com/media')
+
+    def test_built_values_are_cached(self):
+        with patch.object(Env, '_format', wraps=self.env._format) as mock_format:
+            self.env.live_project_path
+            count = mock_format.call_count
+            self.env.live_project_path
+            self.env.live_project_dir
+
+        self.assertEqual(mock_format.call_count, count)
 
     def test_role_looks_up_attributes_with_a_certain_prefix(self):
         self.env.dev_vassal = 'sandwich'
@@ -117,3 +154,59 @@ class EnvTestCase(unittest.TestCase):
         self.assertEqual(self.env.role('dev', 'vassal'), 'sandwich')
         self.assertEqual(self.env.role('live', 'tld'), '.net')
         self.assertEqual(self.env.role('local', 'backups_dir'), 'backups')
+
+
+class SnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.env = Env()
+        self.env.project_name = 'sammich'
+        self.env.live_tld = '.net'
+
+    def test_snapshot_has_all_the_values(self):
+        snapshot = self.env.snapshot()
+
+        for name in Env.DEFAULTS:
+            self.assertEqual(getattr(snapshot, name), getattr(self.env, name))
+        self.assertEqual(snapshot.project_name, 'sammich')
+        self.assertEqual(snapshot.role('live', 'project_path'), '/var/www/sammich.net')
+
+    def test_role_snapshot_has_the_values_without_prefix(self):
+        snapshot = self.env.snapshot('live')
+
+        self.assertEqual(snapshot.project_path, '/var/www/sammich.net')
+        self.assertEqual(snapshot.media_path, '/var/www/sammich.net/media')
+        self.assertEqual(self.env.snapshot().role('dev'), self.env.snapshot('dev'))
+
+    def test_snapshot_does_not_change_with_the_env(self):
+        snapshot = self.env.snapshot('live')
+        self.env.live_tld = '.org'
+
+        self.assertEqual(snapshot.project_path, '/var/www/sammich.net')
+        self.assertRaises(AttributeError, setattr, snapshot, 'tld', '.org')
+
+    def test_snapshot_leaves_out_values_that_cannot_be_built(self):
+        snapshot = Env().snapshot()
+
+        self.assertEqual(snapshot.backups_dir, 'backups')
+        self.assertFalse('dev_project_path' in snapshot)
+        self.assertRaises(AttributeError, lambda: snapshot.dev_project_path)
+
+    def test_values_that_cannot_be_built_raise_with_their_name(self):
+        snapshot = Env().snapshot()
+
+        for get in (lambda: snapshot.dev_project_path,
+                    lambda: snapshot.role('dev').project_path,
+                    lambda: pickle.loads(pickle.dumps(snapshot)).dev_project_path):
+            with self.assertRaises(AttributeError) as cm:
+                get()
+            self.assertIn("'dev_project_path' couldn't be built", str(cm.exception))
+            self.assertIn("'project_name'", str(cm.exception))
+        with self.assertRaises(AttributeError) as cm:
+            snapshot.role('dev').nonexistent
+        self.assertNotIn("couldn't be built", str(cm.exception))
+
+    def test_snapshot_can_be_pickled(self):
+        snapshot = self.env.snapshot()
+
+        self.assertEqual(pickle.loads(pickle.dumps(snapshot, 2)), snapshot)
+        self.assertEqual(pickle.loads(pickle.dumps(snapshot)), snapshot)
@@ -0,0 +1,36 @@
+import os
+import unittest
+from StringIO import StringIO
+
+from fusionbox.fabric.django.dbsync import spool_until
+
+
+class SpoolUntilTestCase(unittest.TestCase):
+    def setUp(self):
+        read_fd, write_fd = os.pipe()
+        self.source = read_fd
+        self.addCleanup(os.close, read_fd)
+        with os.fdopen(write_fd, 'w') as f:
+            f.write('a' * 10 + 'b' * 10 + 'c' * 5)
+        self.sink = StringIO()
+
+    def test_spool_until_keeps_the_data_until_the_sink_is_ready(self):
+        reads = []
+
+        def is_ready():
+            reads.append(None)
+            return len(reads) > 1
+
+        def open_sink():
+            self.assertEqual(len(reads), 2)
+            return self.sink
+
+        sink = spool_until(self.source, is_ready, open_sink, chunk_size=10)
+
+        self.assertIs(sink, self.sink)
+        self.assertEqual(sink.getvalue(), 'a' * 10 + 'b' * 10 + 'c' * 5)
+
+    def test_spool_until_opens_the_sink_at_the_end_of_the_source(self):
+        sink = spool_until(self.source, lambda: False, lambda: self.sink, chunk_size=10)
+
+        self.assertEqual(sink.getvalue(), 'a' * 10 + 'b' * 10 + 'c' * 5)
@@ -0,0 +1,53 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from fusionbox.fabric import dumpcache
+
+
+class DumpCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+
+    def add_dump(self, content, age=0):
+        checksum = hashlib.sha256(content).hexdigest()
+        tmp_path = os.path.join(self.cache_dir, '.' + checksum)
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        path = dumpcache.store(tmp_path, checksum, '.sql.gz', self.cache_dir)
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_store_checks_the_checksum(self):
+        tmp_path = os.path.join(self.cache_dir, '.tmp')
+        with open(tmp_path, 'w') as f:
+            f.write('dump')
+
+        self.assertRaises(ValueError, dumpcache.store, tmp_path, 'bad', '.sql.gz', self.cache_dir)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    def test_lookup_finds_dumps_by_checksum(self):
+        path = self.add_dump('dump', age=100)
+        checksum = hashlib.sha256('dump').hexdigest()
+
+        self.assertEqual(dumpcache.lookup(checksum, '.sql.gz', self.cache_dir), path)
+        self.assertTrue(time.time() - os.path.getmtime(path) < 10)
+        self.assertIsNone(dumpcache.lookup(checksum, '.sql.zst', self.cache_dir))
+
+    def test_evict_removes_the_least_recently_used_dumps(self):
+        old = self.add_dump('old', age=300)
+        older = self.add_dump('older', age=400)
+        new = self.add_dump('new', age=100)
+
+        removed = dumpcache.evict(self.cache_dir, max_count=2, keep=[older])
+        self.assertEqual(removed, [old])
+
+        expired = self.add_dump('expired', age=1000)
+        removed = dumpcache.evict(self.cache_dir, max_age=500, max_size=len('new'))
+        self.assertEqual(removed, [older, expired])
+        self.assertTrue(os.path.exists(new))
@@ -0,0 +1,102 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from fabric.api import lcd, hide
+
+from fusionbox.fabric.extract import extract_tree, list_entries
+
+
+class ExtractTreeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.repo = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.git('init', '-q')
+        self.git('config', 'user.email', 'test@example.com')
+        self.git('config', 'user.name', 'Test')
+
+        self.write('README', 'Read me\n')
+        self.write('manage.py', 'print "manage"\n')
+        self.write('app/models.py', 'x = 1\n')
+        self.write('app/migrations/0001_initial.py', '# initial\n')
+        self.first = self.commit()
+
+    def tearDown(self):
+        shutil.rmtree(self.repo)
+        shutil.rmtree(self.cache_dir)
+
+    def git(self, *args):
+        return subprocess.check_output(('git',) + args, cwd=self.repo).strip()
+
+    def write(self, path, content):
+        path = os.path.join(self.repo, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def commit(self):
+        self.git('add', '-A')
+        self.git('commit', '-q', '-m', 'commit')
+        return self.git('rev-parse', 'HEAD')
+
+    def extract(self, ref, **kwargs):
+        with lcd(self.repo), hide('everything'):
+            return extract_tree(ref, cache_dir=self.cache_dir, **kwargs)
+
+    def read(self, directory, path):
+        with open(os.path.join(directory, path)) as f:
+            return f.read()
+
+    def test_extract_tree_extracts_the_files_of_the_ref(self):
+        directory = self.extract(self.first)
+
+        self.assertEqual(self.read(directory, 'app/models.py'), 'x = 1\n')
+        self.assertEqual(self.read(directory, 'manage.py'), 'print "manage"\n')
+
+    def test_extract_tree_reuses_the_extraction_of_the_same_tree(self):
+        directory = self.extract(self.first)
+        # Same tree, different commit
+        self.git('commit', '-q', '--allow-empty', '-m', 'empty')
+
+        self.assertEqual(self.extract('HEAD'), directory)
+        self.assertEqual(len(list_entries(self.cache_dir)), 1)
+
+    def test_extract_tree_updates_a_previous_extraction_incrementally(self):
+        old_directory = self.extract(self.first)
+        self.write('app/models.py', 'x = 2\n')
+        self.write('app/migrations/0002_more.py', '# more\n')
+        os.unlink(os.path.join(self.repo, 'app/migrations/0001_initial.py'))
+        os.unlink(os.path.join(self.repo, 'manage.py'))
+        self.write('app/views.py', 'y = 1\n')
+        second = self.commit()
+
+        directory = self.extract(second)
+
+        self.assertNotEqual(directory, old_directory)
+        self.assertEqual(self.read(directory, 'app/models.py'), 'x = 2\n')
+        self.assertEqual(self.read(directory, 'app/views.py'), 'y = 1\n')
+        self.assertEqual(os.listdir(os.path.join(directory, 'app/migrations')),
+                         ['0002_more.py'])
+        self.assertFalse(os.path.exists(os.path.join(directory, 'manage.py')))
+        # Unchanged files are shared
+        self.assertEqual(
+            os.stat(os.path.join(directory, 'README')).st_ino,
+            os.stat(os.path.join(old_directory, 'README')).st_ino,
+        )
+        # The previous extraction is left untouched
+        self.assertEqual(self.read(old_directory, 'app/models.py'), 'x = 1\n')
+        self.assertEqual(self.read(old_directory, 'manage.py'), 'print "manage"\n')
+
+    def test_extract_tree_evicts_the_least_recently_used_extractions(self):
+        old_directory = self.extract(self.first)
+        self.write('app/models.py', 'x = 2\n')
+        second = self.commit()
+
+        directory = self.extract(second, max_size=1)
+
+        self.assertTrue(os.path.isdir(directory))
+        self.assertFalse(os.path.exists(old_directory))
+        self.assertEqual(len(list_entries(self.cache_dir)), 1)
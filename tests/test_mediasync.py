@@ -0,0 +1,86 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+
+from mock import patch
+
+from fusionbox.fabric.django.mediasync import (
+    list_remote, list_remote_command, parse_listing, select_files, shard, read_manifest, write_manifest)
+
+
+class ListRemoteTestCase(unittest.TestCase):
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media)
+        os.makedirs(os.path.join(self.media, 'uploads'))
+        for name, content in (('a.jpg', 'aaa'), ('uploads/b c.png', 'bb')):
+            with open(os.path.join(self.media, name), 'w') as f:
+                f.write(content)
+
+    def list(self, since=None):
+        return parse_listing(subprocess.check_output(
+            ['bash', '-c', list_remote_command(self.media, since)]))
+
+    def test_listing_has_the_size_and_mtime_of_all_the_files(self):
+        listed_at, files = self.list()
+
+        self.assertTrue(abs(listed_at - time.time()) < 10)
+        self.assertEqual(sorted(files), ['a.jpg', 'uploads/b c.png'])
+        self.assertEqual(files['a.jpg'][0], 3)
+        self.assertEqual(files['a.jpg'][1], int(os.path.getmtime(os.path.join(self.media, 'a.jpg'))))
+
+    def test_listing_since_a_time_only_has_the_files_changed_after(self):
+        self.assertEqual(self.list(since=time.time() + 10), (self.list()[0], {}))
+
+    def test_list_remote_connects_to_the_port_of_the_host_string(self):
+        with patch('subprocess.check_output', return_value='1\0') as check_output:
+            self.assertEqual(list_remote('deploy@example.com:2222', self.media), (1, {}))
+
+        self.assertEqual(check_output.call_args[0][0][:4],
+                         ['ssh', '-p', '2222', 'deploy@example.com'])
+
+
+class SelectFilesTestCase(unittest.TestCase):
+    files = {
+        'a.jpg': (100, 1),
+        'b.jpg': (5000, 1),
+        'docs/c.pdf': (100, 2),
+        'd.jpg': (100, 3),
+    }
+
+    def test_select_files_skips_the_synced_files(self):
+        synced = {'a.jpg': (100, 1), 'd.jpg': (100, 2)}
+
+        self.assertEqual(sorted(select_files(self.files, synced)), ['b.jpg', 'd.jpg', 'docs/c.pdf'])
+
+    def test_select_files_filters_by_size_and_globs(self):
+        self.assertEqual(sorted(select_files(self.files, {}, max_size=1000, include=['*.jpg'])),
+                         ['a.jpg', 'd.jpg'])
+        self.assertEqual(sorted(select_files(self.files, {}, exclude=['docs/*', 'a.*'])),
+                         ['b.jpg', 'd.jpg'])
+
+    def test_sample_is_stable(self):
+        files = dict(('{0}.jpg'.format(i), (1, 1)) for i in range(1000))
+        sample = select_files(files, {}, sample=0.1)
+
+        self.assertTrue(50 < len(sample) < 150)
+        self.assertEqual(select_files(files, {}, sample=0.1), sample)
+
+    def test_shard_balances_the_sizes(self):
+        shards = shard(list(self.files), self.files, 2)
+
+        self.assertEqual(shards[0], ['b.jpg'])
+        self.assertEqual(sorted(shards[1]), ['a.jpg', 'd.jpg', 'docs/c.pdf'])
+        self.assertEqual(len(shard(['a.jpg'], self.files, 4)), 1)
+
+    def test_manifest_round_trip(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'media', 'manifest.json')
+
+        self.assertEqual(read_manifest(path), (None, {}))
+        write_manifest(path, 123, self.files)
+        self.assertEqual(read_manifest(path), (123, self.files))
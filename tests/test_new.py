@@ -0,0 +1,685 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+from fabric.api import env, settings, execute, local, hide
+from fabric.operations import _AttributeString
+from mock import patch, MagicMock
+
+from fusionbox.fabric.utils import BatchResult
+from fusionbox.fabric.django.new import (
+    RemoteState, readiness_command,
+    deploy_log_command, parse_deploy_log, LogEntry, DEPLOY_LOG,
+    compute_fingerprints, format_fingerprints, parse_fingerprints, get_changes,
+    parse_requirements, parse_snapshot_requirements, get_closest_snapshot, get_requirement_names,
+    get_local_requirements,
+    get_unchanged_files, get_git_ssh_command, get_rollback_target, rollback, get_static_root,
+    format_release_file, parse_release_file, activate_release,
+    install_release, Release, UNKNOWN_STATIC_ROOT, wait_until_ready, reserve_src_dir, atomic_src_update,
+    get_disk_usage, get_over_budget, deploy, fetch_remotes, activate, django, fetch_dbdump,
+)
+
+
+class DeployLogTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(self.directory, DEPLOY_LOG), 'w') as f:
+            f.write(
+                'Mon Jun  1 10:00:00 MDT 2015:\talice\tsrc.00001\t1111aaaa\n'
+                'Tue Jun  2 10:00:00 MDT 2015:\tbob\tsrc.00002\t2222bbbb\n'
+                'Wed Jun  3 10:00:00 MDT 2015:\talice\tsrc.00003\t3333cccc\n'
+            )
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self, *args, **kwargs):
+        process = subprocess.Popen(
+            deploy_log_command(*args, **kwargs), shell=True, cwd=self.directory,
+            stdout=subprocess.PIPE)
+        return parse_deploy_log(process.communicate()[0])
+
+    def test_parse_deploy_log_returns_log_entries(self):
+        self.assertEqual(
+            parse_deploy_log('Mon Jun  1 10:00:00 MDT 2015:\talice\tsrc.00001\t1111aaaa\n'),
+            [LogEntry('Mon Jun  1 10:00:00 MDT 2015:', 'alice', 'src.00001', '1111aaaa')],
+        )
+
+    def test_deploy_log_command_reads_the_whole_log(self):
+        self.assertEqual([e.dir for e in self.read()],
+                         ['src.00001', 'src.00002', 'src.00003'])
+
+    def test_deploy_log_command_reads_the_last_entries(self):
+        self.assertEqual([e.dir for e in self.read(2)], ['src.00002', 'src.00003'])
+
+    def test_deploy_log_command_filters_by_user(self):
+        self.assertEqual([e.dir for e in self.read(username='alice')],
+                         ['src.00001', 'src.00003'])
+        self.assertEqual([e.dir for e in self.read(1, username='alice')], ['src.00003'])
+
+    def test_deploy_log_command_filters_by_ref_prefix_and_directory(self):
+        self.assertEqual([e.dir for e in self.read(ref='2222')], ['src.00002'])
+        self.assertEqual([e.hash for e in self.read(directory='src.00001')], ['1111aaaa'])
+        self.assertEqual(self.read(username='bob', directory='src.00001'), [])
+
+    def test_deploy_log_command_ignores_a_missing_log(self):
+        os.unlink(os.path.join(self.directory, DEPLOY_LOG))
+        self.assertEqual(self.read(1), [])
+
+
+class FingerprintsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.entries = {
+            'requirements.txt': ('100644', 'a' * 40),
+            'manage.py': ('100755', 'b' * 40),
+            'app/models.py': ('100644', 'c' * 40),
+            'app/migrations/0001_initial.py': ('100644', 'd' * 40),
+            'sammich/settings.py': ('100644', 'e' * 40),
+        }
+        self.fingerprints = compute_fingerprints(self.entries)
+
+    def changes(self, **entries):
+        new_entries = dict(self.entries, **entries)
+        return get_changes(compute_fingerprints(new_entries), self.fingerprints)
+
+    def test_fingerprints_round_trip_through_their_file_format(self):
+        self.assertEqual(parse_fingerprints(format_fingerprints(self.fingerprints)),
+                         self.fingerprints)
+
+    def test_nothing_changed_when_only_unrelated_files_change(self):
+        self.assertEqual(self.changes(**{'app/models.py': ('100644', 'f' * 40)}), set())
+
+    def test_added_and_edited_migrations_are_detected(self):
+        self.assertEqual(
+            self.changes(**{'app/migrations/0002_more.py': ('100644', 'f' * 40)}),
+            set(['migrations']),
+        )
+        self.assertEqual(
+            self.changes(**{'app/migrations/0001_initial.py': ('100644', 'f' * 40)}),
+            set(['migrations']),
+        )
+
+    def test_requirements_and_settings_changes_are_detected(self):
+        self.assertEqual(
+            self.changes(**{
+                'requirements.txt': ('100644', 'f' * 40),
+                'sammich/settings.py': ('100644', 'f' * 40),
+            }),
+            set(['requirements', 'settings']),
+        )
+
+    def test_top_level_migrations_and_settings_packages_are_detected(self):
+        self.assertEqual(self.changes(**{'migrations/0001_initial.py': ('100644', 'f' * 40)}),
+                         set(['migrations']))
+        self.assertEqual(self.changes(**{'settings/base.py': ('100644', 'f' * 40)}),
+                         set(['settings']))
+        self.assertEqual(self.changes(**{'sammich/settings/live.py': ('100644', 'f' * 40)}),
+                         set(['settings']))
+
+    def test_files_named_like_settings_are_not_settings(self):
+        self.assertEqual(
+            self.changes(**{'app/tests/test_settings_helpers.py': ('100644', 'f' * 40),
+                            'app/settings_form.py': ('100644', 'f' * 40)}),
+            set(),
+        )
+
+    def test_everything_changed_when_the_previous_fingerprints_are_unknown(self):
+        self.assertEqual(get_changes(self.fingerprints, None), set(self.fingerprints))
+
+
+class UploadTestCase(unittest.TestCase):
+    def test_only_the_changed_regular_files_are_uploaded(self):
+        previous_entries = {
+            'manage.py': ('100755', 'a' * 40),
+            'app/models.py': ('100644', 'b' * 40),
+            'app/views.py': ('100644', 'c' * 40),
+        }
+        entries = dict(previous_entries, **{
+            'app/models.py': ('100644', 'd' * 40),
+            'app/forms.py': ('100644', 'e' * 40),
+            'static': ('120000', 'f' * 40),
+        })
+        unchanged, changed = get_unchanged_files(entries, previous_entries)
+        self.assertEqual(sorted(unchanged), ['app/views.py', 'manage.py'])
+        self.assertEqual(sorted(changed), ['app/forms.py', 'app/models.py'])
+
+    def test_everything_is_uploaded_without_previous_entries(self):
+        entries = {'manage.py': ('100755', 'a' * 40)}
+        self.assertEqual(get_unchanged_files(entries, {}), ([], ['manage.py']))
+
+    def test_git_connects_like_fabric(self):
+        with settings(key_filename='/keys/deploy', gateway=None):
+            self.assertEqual(get_git_ssh_command(), 'ssh -o BatchMode=yes -i /keys/deploy')
+        with settings(key_filename=['/keys/a', '/keys/b'], gateway='me@bastion:2222'):
+            self.assertEqual(get_git_ssh_command(),
+                             'ssh -o BatchMode=yes -i /keys/a -i /keys/b'
+                             ' -o ProxyJump=me@bastion:2222')
+
+
+class VirtualenvSnapshotTestCase(unittest.TestCase):
+    def test_comments_and_blank_lines_are_ignored(self):
+        self.assertEqual(
+            parse_requirements('# Web\nDjango==1.8  # LTS\n\n'
+                               'git+https://example.com/app.git#egg=app\n'),
+            set(['Django==1.8', 'git+https://example.com/app.git#egg=app']),
+        )
+
+    def test_requirement_names(self):
+        self.assertEqual(
+            get_requirement_names(parse_requirements(
+                'Django==1.8\ndjango_extensions>=1.0\n-e git+https://example.com/app.git#egg=App\n'
+                '--index-url https://example.com/simple\n')),
+            set(['django', 'django-extensions', 'app']),
+        )
+
+    def test_local_requirements(self):
+        self.assertEqual(
+            get_local_requirements(
+                'Django==1.8\n-r base.txt\n--constraint=constraints.txt\n-e ./pkg\n'
+                '-e git+https://example.com/app.git#egg=app\n./vendor/lib.tar.gz\n'
+                'requests>=2.0  # -r in a comment\n'),
+            ['--constraint=constraints.txt', '-e ./pkg', '-r base.txt', './vendor/lib.tar.gz'],
+        )
+        self.assertEqual(get_local_requirements('Django==1.8\n-rbase.txt\n'), ['-rbase.txt'])
+
+    def test_snapshot_requirements_are_grouped_by_snapshot(self):
+        output = ('virtualenvs/aaaa/.requirements:Django==1.8\n'
+                  'virtualenvs/aaaa/.requirements:six==1.10\n'
+                  'virtualenvs/bbbb/.requirements:Django==1.9\n')
+        self.assertEqual(parse_snapshot_requirements(output), {
+            'aaaa': set(['Django==1.8', 'six==1.10']),
+            'bbbb': set(['Django==1.9']),
+        })
+
+    def test_the_closest_snapshot_has_the_fewest_different_requirements(self):
+        snapshots = {
+            'aaaa': set(['Django==1.8', 'six==1.10']),
+            'bbbb': set(['Django==1.9', 'six==1.10', 'requests==2.0']),
+        }
+        self.assertEqual(get_closest_snapshot('Django==1.9\nsix==1.10\n', snapshots), 'bbbb')
+        self.assertEqual(get_closest_snapshot('Django==1.8\n', snapshots), 'aaaa')
+        self.assertIsNone(get_closest_snapshot('Django==1.8\n', {}))
+
+
+class DiskBudgetTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_here(self, command, **kwargs):
+        process = subprocess.Popen(command, shell=True, cwd=self.directory,
+                                   stdout=subprocess.PIPE)
+        return process.communicate()[0]
+
+    def over_budget(self, usage, budget):
+        output = ''.join('{0}\t{1}\n'.format(used, directory) for directory, used in usage)
+        with patch('fusionbox.fabric.django.new.run', return_value=output):
+            return get_over_budget(usage[0][0], [directory for directory, _ in usage[1:]],
+                                   budget)
+
+    def test_hard_linked_files_are_counted_once(self):
+        for name in ('src.00001', 'src.00002'):
+            os.mkdir(os.path.join(self.directory, name))
+        with open(os.path.join(self.directory, 'src.00002', 'big'), 'w') as f:
+            f.write('x' * 1024 ** 2)
+        os.link(os.path.join(self.directory, 'src.00002', 'big'),
+                os.path.join(self.directory, 'src.00001', 'big'))
+
+        with patch('fusionbox.fabric.django.new.run', self.run_here):
+            current, previous = get_disk_usage(['src.00002', 'src.00001'])
+        self.assertTrue(current >= 1024 ** 2)
+        self.assertTrue(previous < 1024 ** 2)
+
+    def test_the_older_directories_over_budget_are_removed(self):
+        usage = [('src.00004', 100), ('src.00003', 10), ('src.00002', 10), ('src.00001', 10)]
+        self.assertEqual(self.over_budget(usage, 105), ['src.00003', 'src.00002', 'src.00001'])
+        self.assertEqual(self.over_budget(usage, 115), ['src.00002', 'src.00001'])
+        self.assertEqual(self.over_budget(usage, 130), [])
+
+    def test_nothing_is_removed_without_history(self):
+        with patch('fusionbox.fabric.django.new.run') as run:
+            self.assertEqual(get_over_budget('src.00001', [], 10), [])
+        self.assertFalse(run.called)
+
+
+class RemoteStateTestCase(unittest.TestCase):
+    def setUp(self):
+        self.probe = {
+            'directories': BatchResult('src.00001\nsrc.00002\nsrc.00003\nsrc.old', 0),
+            'current': BatchResult('src.00002', 0),
+            'lock': BatchResult('', 1),
+            'deploy_log': BatchResult(
+                'Tue Jun  2 10:00:00 MDT 2015:\tbob\tsrc.00002\t2222bbbb\n', 0),
+            'vassal_file': BatchResult('/etc/vassals/sammich.ini', 0),
+        }
+        self.settings = settings(project_name='sammich', vassal_name='sammich',
+                                 host_string='sammich.com')
+        self.settings.__enter__()
+        self.run_batch = patch('fusionbox.fabric.django.new.run_batch',
+                               return_value=self.probe).start()
+
+    def tearDown(self):
+        patch.stopall()
+        self.settings.__exit__(None, None, None)
+
+    def test_the_state_is_read_once_when_needed(self):
+        state = RemoteState()
+        self.assertFalse(self.run_batch.called)
+        self.assertEqual(state.directories, ['src.00001', 'src.00002', 'src.00003'])
+        self.assertEqual(state.current, 'src.00002')
+        self.assertIsNone(state.lock)
+        self.assertEqual(state.last_deploy.hash, '2222bbbb')
+        self.assertEqual(state.vassal_file, '/etc/vassals/sammich.ini')
+        self.assertEqual(self.run_batch.call_count, 1)
+
+    def test_changes_are_kept_up_to_date(self):
+        state = RemoteState()
+        state.load()
+        state.locked('src.00004')
+        state.add_directory('src.00004')
+        self.assertEqual(state.lock, 'src.00004')
+        self.assertEqual(state.directories[-1], 'src.00004')
+
+        state.switched()
+        state.remove_directories(['src.00001'])
+        self.assertEqual(state.current, 'src.00004')
+        self.assertIsNone(state.lock)
+        self.assertEqual(state.directories, ['src.00002', 'src.00003', 'src.00004'])
+        self.assertEqual(self.run_batch.call_count, 1)
+
+
+class StaticRootTestCase(unittest.TestCase):
+    def setUp(self):
+        self.settings = settings(project_name='sammich')
+        self.settings.__enter__()
+
+    def tearDown(self):
+        patch.stopall()
+        self.settings.__exit__(None, None, None)
+
+    def static_root(self, output, failed=False):
+        result = _AttributeString(output)
+        result.failed = failed
+        with patch('fusionbox.fabric.django.new.run', return_value=result):
+            return get_static_root('src.00002')
+
+    def test_static_root_relative_to_the_src_directory(self):
+        self.assertEqual(
+            self.static_root("DEBUG = False\nSTATIC_ROOT = '/var/www/sammich/src/static'  ###\n"),
+            'static')
+        self.assertEqual(self.static_root("STATIC_ROOT = '/var/www/sammich/src.00002/static'\n"),
+                         'static')
+        self.assertIsNone(self.static_root("STATIC_ROOT = '/srv/static'\n"))
+
+    def test_pathlib_static_root(self):
+        self.assertEqual(
+            self.static_root("STATIC_ROOT = PosixPath('/var/www/sammich/src/static')\n"),
+            'static')
+
+    def test_unset_static_root(self):
+        self.assertIsNone(self.static_root("STATIC_ROOT = None\n"))
+        self.assertIsNone(self.static_root("DEBUG = False\n"))
+
+    def test_unknown_static_root(self):
+        self.assertIs(self.static_root("STATIC_ROOT = <LazyPath object at 0x7f00>\n"),
+                      UNKNOWN_STATIC_ROOT)
+        self.assertIs(self.static_root('ImportError: No module named foo', failed=True),
+                      UNKNOWN_STATIC_ROOT)
+
+
+class InstallReleaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.settings = settings(project_name='sammich')
+        self.settings.__enter__()
+        self.calls = MagicMock()
+        for name in ('run', 'pip_install', 'migrate', 'collectstatic', 'generate_pyc',
+                     'link_previous_static'):
+            patch('fusionbox.fabric.django.new.' + name, getattr(self.calls, name)).start()
+        self.release = Release(
+            directory='src.00003', should_pip_install=False, should_migrate=False,
+            should_collectstatic=False, changes=set(), previous_deploy=None,
+            vassal_file='/etc/vassals/sammich.ini', wheelhouse=None, requirements=None)
+
+    def tearDown(self):
+        patch.stopall()
+        self.settings.__exit__(None, None, None)
+
+    def install(self, static_root, **kwargs):
+        with patch('fusionbox.fabric.django.new.get_static_root', return_value=static_root):
+            install_release(self.release, backupdb=False, **kwargs)
+        return [name for name, _, _ in self.calls.mock_calls
+                if '.' not in name and name != 'run']
+
+    def test_unchanged_static_files_are_linked(self):
+        self.assertEqual(self.install('static'), ['link_previous_static', 'generate_pyc'])
+
+    def test_all_the_static_files_are_collected_when_static_root_is_unknown(self):
+        self.assertEqual(self.install(UNKNOWN_STATIC_ROOT), ['collectstatic', 'generate_pyc'])
+
+    def test_an_unknown_static_root_is_left_to_activate_without_the_lock(self):
+        self.assertEqual(self.install(UNKNOWN_STATIC_ROOT, shared=False), ['generate_pyc'])
+
+
+class ReserveSrcDirTestCase(unittest.TestCase):
+    def setUp(self):
+        self.settings = settings(project_name='sammich', force=False)
+        self.settings.__enter__()
+        self.run = patch('fusionbox.fabric.django.new.run').start()
+        self.run.side_effect = lambda command, **kwargs: MagicMock(
+            succeeded=command != 'mkdir src.00003')
+        patch('fusionbox.fabric.django.new.get_next_src_dir',
+              side_effect=['src.00003', 'src.00004']).start()
+        patch('fusionbox.fabric.django.new.get_remote_state').start()
+        patch('fusionbox.fabric.django.new.forget_remote_state').start()
+
+    def tearDown(self):
+        patch.stopall()
+        self.settings.__exit__(None, None, None)
+
+    def test_a_directory_created_by_someone_else_is_skipped(self):
+        self.assertEqual(reserve_src_dir(), 'src.00004')
+
+    def test_push_gives_the_directory_back_when_it_cannot_lock(self):
+        patch('fusionbox.fabric.django.new.acquire_deployment_lock',
+              side_effect=SystemExit(1)).start()
+        with self.assertRaises(SystemExit):
+            with atomic_src_update():
+                self.fail('The deployment lock was taken')
+        self.run.assert_called_with('rmdir src.00004')
+
+
+class DeployTestCase(unittest.TestCase):
+    def setUp(self):
+        self.settings = settings(force=False)
+        self.settings.__enter__()
+        self.addCleanup(self.settings.__exit__, None, None, None)
+        # Forget that runs_once already ran it
+        self.addCleanup(lambda: fetch_remotes.__dict__.pop('return_value', None))
+
+    @patch('fusionbox.fabric.django.new.push_parallel')
+    @patch('fusionbox.fabric.django.new.push')
+    @patch('fusionbox.fabric.django.new.get_git_ref', return_value='1111aaaa')
+    @patch('fusionbox.fabric.django.new.local')
+    def test_deploy_fetches_once_for_all_the_hosts(self, local, get_git_ref, push, push_parallel):
+        execute(deploy, hosts=['web1.sammich.com', 'web2.sammich.com'])
+
+        local.assert_called_once_with('git fetch --all')
+        self.assertEqual(push.call_count, 2)
+        self.assertFalse(push_parallel.called)
+
+        execute(deploy, hosts=['web1.sammich.com', 'web2.sammich.com'], parallel_hosts='1',
+                pool_size='3')
+        push_parallel.assert_called_with('1111aaaa', False, True, 3, None)
+
+
+class PreparedSrcDirTestCase(unittest.TestCase):
+    def setUp(self):
+        self.settings = settings(project_name='sammich', force=False)
+        self.settings.__enter__()
+        # src.00003 is prepared but not activated
+        patch('fusionbox.fabric.django.new.get_remote_state', return_value=MagicMock(
+            current='src.00002', directories=['src.00001', 'src.00002', 'src.00003'])).start()
+
+    def tearDown(self):
+        patch.stopall()
+        self.settings.__exit__(None, None, None)
+
+    @patch('fusionbox.fabric.django.new.cd_project')
+    @patch('fusionbox.fabric.django.new.run')
+    def test_django_runs_the_deployed_code(self, run, cd_project):
+        django('check')
+
+        cd_project.assert_called_with('src.00002')
+        run.assert_called_with('python manage.py check')
+
+    @patch('fusionbox.fabric.django.new.activate_release')
+    def test_activate_needs_the_prepared_directory(self, activate_release):
+        with self.assertRaises(SystemExit):
+            activate()
+        self.assertFalse(activate_release.called)
+
+        activate(directory='src.00003')
+        activate_release.assert_called_with('src.00003', True)
+
+
+class FetchDbdumpTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache_home = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_home)
+        patch.dict(os.environ, {'XDG_CACHE_HOME': self.cache_home}).start()
+        self.settings = settings(project_name='sammich')
+        self.settings.__enter__()
+        self.run = patch('fusionbox.fabric.django.new.run').start()
+        patch('fusionbox.fabric.django.new.get_dump_compressor',
+              return_value=('gzip -n -c', '.sql.gz')).start()
+        patch('fusionbox.fabric.django.new.dump_database', return_value='a' * 64).start()
+
+    def tearDown(self):
+        patch.stopall()
+        self.settings.__exit__(None, None, None)
+
+    def test_a_failed_download_leaves_nothing_in_the_cache(self):
+        def get(remote_path, local_path):
+            with open(local_path, 'w') as f:
+                f.write('partial')
+            raise SystemExit(1)
+
+        with patch('fusionbox.fabric.django.new.get', side_effect=get):
+            with self.assertRaises(SystemExit):
+                fetch_dbdump()
+
+        self.assertEqual(os.listdir(os.path.join(self.cache_home, 'fusionbox-fabric', 'dumps')), [])
+        self.assertIn('rm -f', self.run.call_args[0][0])
+
+
+class RollbackTestCase(unittest.TestCase):
+    def setUp(self):
+        self.entries = parse_deploy_log(
+            'Mon Jun  1 10:00:00 MDT 2015:\talice\tsrc.00001\t1111aaaa\n'
+            'Tue Jun  2 10:00:00 MDT 2015:\tbob\tsrc.00002\t2222bbbb\n'
+            'Wed Jun  3 10:00:00 MDT 2015:\talice\tsrc.00004\t4444dddd\n'
+        )
+        probe = {
+            'directories': BatchResult('src.00001\nsrc.00002\nsrc.00003\nsrc.00004', 0),
+            'current': BatchResult('src.00004', 0),
+            'lock': BatchResult('', 1),
+            'deploy_log': BatchResult('', 0),
+            'vassal_file': BatchResult('/etc/vassals/sammich.ini', 0),
+        }
+        self.settings = settings(project_name='sammich', vassal_name='sammich',
+                                 host_string='sammich.com')
+        self.settings.__enter__()
+        # Only the tasks that take a force argument set it
+        self.force = env.pop('force', None)
+        patch('fusionbox.fabric.django.new.run_batch', return_value=probe).start()
+        patch('fusionbox.fabric.django.new.read_deploy_log', return_value=self.entries).start()
+        self.run = patch('fusionbox.fabric.django.new.run',
+                         return_value=MagicMock(failed=False)).start()
+        self.log_deploy = patch('fusionbox.fabric.django.new.log_deploy').start()
+        patch('fusionbox.fabric.django.new.reload_uwsgi').start()
+
+    def tearDown(self):
+        patch.stopall()
+        if self.force is not None:
+            env.force = self.force
+        self.settings.__exit__(None, None, None)
+
+    def commands(self):
+        return [call[0][0] for call in self.run.call_args_list]
+
+    def test_the_target_is_the_deploy_before_the_current_one(self):
+        directories = ['src.00001', 'src.00002', 'src.00003', 'src.00004']
+        self.assertEqual(get_rollback_target(self.entries, 'src.00004', directories).dir,
+                         'src.00002')
+        # Rolled back from src.00004 to src.00002, rolling back again goes to src.00004
+        entries = self.entries + parse_deploy_log(
+            'Thu Jun  4 10:00:00 MDT 2015:\tbob\tsrc.00002\t2222bbbb\n')
+        self.assertEqual(get_rollback_target(entries, 'src.00002', directories).dir,
+                         'src.00004')
+        self.assertEqual(get_rollback_target(self.entries, 'src.00004', ['src.00001']).dir,
+                         'src.00001')
+        self.assertIsNone(get_rollback_target(self.entries, 'src.00004', ['src.00003']))
+
+    def test_rollback_skips_the_directories_that_were_never_deployed(self):
+        rollback()
+        self.assertIn('ln -ns src.00002 deployment.lock', self.commands())
+        self.assertIn('mv -f -T deployment.lock src', self.commands())
+        self.log_deploy.assert_called_once_with('2222bbbb', 'src.00002')
+
+    def test_rolling_back_to_a_directory_that_was_never_deployed_needs_force(self):
+        with self.assertRaises(SystemExit):
+            rollback('src.00003')
+        self.assertEqual(self.commands(), [])
+
+        rollback('src.00003', force=True)
+        self.assertIn('ln -nsf src.00003 deployment.lock', self.commands())
+        self.assertFalse(self.log_deploy.called)
+
+
+class ActivateTestCase(unittest.TestCase):
+    def setUp(self):
+        self.state_probe = {
+            'directories': BatchResult('src.00001\nsrc.00002\nsrc.00003', 0),
+            'current': BatchResult('src.00002', 0),
+            'lock': BatchResult('src.00003', 0),
+            'deploy_log': BatchResult(
+                'Tue Jun  2 10:00:00 MDT 2015:\tbob\tsrc.00002\t2222bbbb\n', 0),
+            'vassal_file': BatchResult('/etc/vassals/sammich.ini', 0),
+        }
+        fingerprints = compute_fingerprints({'requirements.txt': ('100644', 'a' * 40)})
+        self.release_probe = {
+            'release': BatchResult(format_release_file('3333cccc', True, None), 0),
+            'fingerprints': BatchResult(format_fingerprints(fingerprints), 0),
+            'current_fingerprints': BatchResult(format_fingerprints(fingerprints), 0),
+        }
+        self.settings = settings(project_name='sammich', vassal_name='sammich',
+                                 host_string='sammich.com', force=False)
+        self.settings.__enter__()
+
+        self.calls = MagicMock()
+        self.calls.run.return_value = MagicMock(failed=False)
+        self.calls.run_batch.side_effect = lambda commands: (
+            self.release_probe if commands[0][0] == 'release' else self.state_probe)
+        for name in ('run', 'run_batch', 'pip_install', 'migrate', 'collectstatic',
+                     'generate_pyc', 'log_deploy', 'reload_uwsgi', 'cleanup_history',
+                     'check_fast_forward', 'link_previous_static'):
+            patch('fusionbox.fabric.django.new.' + name, getattr(self.calls, name)).start()
+        patch('fusionbox.fabric.django.new.get_static_root', return_value='static').start()
+
+    def tearDown(self):
+        patch.stopall()
+        self.settings.__exit__(None, None, None)
+
+    def called(self):
+        return [name for name, args, kwargs in self.calls.mock_calls
+                if '.' not in name and name != 'run']
+
+    def test_release_file_round_trip(self):
+        self.assertEqual(parse_release_file(format_release_file('3333cccc', True, '/w/aaaa')),
+                         {'ref': '3333cccc', 'qad': '1', 'wheelhouse': '/w/aaaa', 'static': '1'})
+        self.assertEqual(parse_release_file(format_release_file('3333cccc', False, None,
+                                                                static=False)),
+                         {'ref': '3333cccc', 'qad': '0', 'wheelhouse': '', 'static': '0'})
+
+    def test_the_release_is_read_under_the_lock(self):
+        activate_release('src.00003', backupdb=False)
+        self.assertEqual(self.calls.mock_calls[0][1][0], 'ln -ns src.00003 deployment.lock')
+        self.assertEqual(self.called(), ['run_batch', 'run_batch', 'check_fast_forward',
+                                         'log_deploy', 'reload_uwsgi', 'cleanup_history'])
+
+    def test_the_static_files_postponed_by_prepare_are_collected_after_pip_install(self):
+        self.release_probe['release'] = BatchResult(
+            format_release_file('3333cccc', False, None, static=False), 0)
+        activate_release('src.00003', backupdb=False)
+        self.assertEqual(self.called(), [
+            'run_batch', 'run_batch', 'check_fast_forward', 'pip_install', 'generate_pyc', 'migrate',
+            'link_previous_static', 'collectstatic', 'log_deploy', 'reload_uwsgi',
+            'cleanup_history',
+        ])
+
+    def test_all_the_static_files_are_collected_when_static_root_is_unknown(self):
+        with patch('fusionbox.fabric.django.new.get_static_root',
+                   return_value=UNKNOWN_STATIC_ROOT):
+            activate_release('src.00003', backupdb=False)
+        self.assertEqual(self.called(), ['run_batch', 'run_batch', 'check_fast_forward',
+                                         'collectstatic', 'log_deploy', 'reload_uwsgi',
+                                         'cleanup_history'])
+
+    def test_a_release_prepared_before_the_current_one_is_refused(self):
+        self.state_probe['current'] = BatchResult('src.00004', 0)
+        with self.assertRaises(SystemExit):
+            activate_release('src.00003', backupdb=False)
+        self.calls.run.assert_any_call('unlink deployment.lock')
+        self.assertFalse(self.calls.log_deploy.called)
+
+
+class ReadinessTestCase(unittest.TestCase):
+    def setUp(self):
+        self.requests = []
+        test = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                test.requests.append(self.path)
+                # Not ready for the first request, then the old code answers
+                self.send_response(200 if len(test.requests) > 1 else 503)
+                self.send_header('X-Release', 'src.00002' if len(test.requests) > 2 else 'src.00001')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{0}/ready'.format(self.server.server_port)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def run_command(self, command):
+        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
+        return process.communicate()[0], process.returncode
+
+    def test_waits_until_ready_then_warms_up(self):
+        output, returncode = self.run_command(
+            readiness_command([self.url], timeout=5, warmup_requests=3))
+        self.assertEqual(returncode, 0)
+        # One failed and one successful probe, then the warm up requests
+        self.assertEqual(len(self.requests), 5)
+
+    def test_waits_until_the_new_release_answers(self):
+        output, returncode = self.run_command(
+            readiness_command([self.url], timeout=5, warmup_requests=0, release='src.00002'))
+        self.assertEqual(returncode, 0)
+        self.assertEqual(len(self.requests), 3)
+
+    def wait_until_ready(self, **kwargs):
+        with settings(hide('everything'), warmup_requests=0, **kwargs):
+            with patch('fusionbox.fabric.django.new.run',
+                       side_effect=lambda command, **kwargs: local(command, capture=True)):
+                wait_until_ready(time.time(), [self.url], 'src.00002')
+
+    def test_any_answer_is_ready_without_release_header(self):
+        self.wait_until_ready()
+        self.assertEqual(len(self.requests), 2)
+
+    def test_the_release_header_is_checked_when_set(self):
+        self.wait_until_ready(release_header='X-Release')
+        self.assertEqual(len(self.requests), 3)
+
+    def test_prints_the_url_that_isnt_ready(self):
+        self.server.server_close()
+        output, returncode = self.run_command(
+            readiness_command([self.url], timeout=1, warmup_requests=0))
+        self.assertEqual(returncode, 1)
+        self.assertEqual(output.strip(), self.url)
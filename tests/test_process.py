@@ -0,0 +1,142 @@
+import os
+import socket
+import unittest
+from unittest import SkipTest
+
+from fusionbox.fabric.process import (run_subprocesses, multiplex_output, check_health,
+                                      read_process_stats, Program, Supervisor)
+
+
+class MultiplexOutputTestCase(unittest.TestCase):
+    def test_multiplex_output_yields_the_lines_of_every_process(self):
+        commands = [
+            ('.', 'echo one; echo two >&2; printf "no newline"'),
+            ('.', 'echo three; sleep 0.1; echo four'),
+        ]
+        with run_subprocesses(commands) as processes:
+            lines = list(multiplex_output(processes, chunk_size=4))
+
+        self.assertEqual(sorted(lines), sorted([
+            (commands[0][1], 'stdout', 'one'),
+            (commands[0][1], 'stderr', 'two'),
+            (commands[0][1], 'stdout', 'no newline'),
+            (commands[1][1], 'stdout', 'three'),
+            (commands[1][1], 'stdout', 'four'),
+        ]))
+
+    def test_multiplex_output_does_not_wait_for_a_process_to_exit(self):
+        commands = [
+            ('.', 'sleep 5'),
+            ('.', 'echo ready'),
+        ]
+        with run_subprocesses(commands) as processes:
+            for cmd, stream, line in multiplex_output(processes):
+                break
+
+        self.assertEqual((cmd, stream, line), ('echo ready', 'stdout', 'ready'))
+
+
+class CheckHealthTestCase(unittest.TestCase):
+    def test_tcp_health_check_connects_to_the_port(self):
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        url = 'tcp://127.0.0.1:{0}'.format(server.getsockname()[1])
+
+        self.assertTrue(check_health(url))
+        server.close()
+        self.assertFalse(check_health(url))
+
+
+class SupervisorTestCase(unittest.TestCase):
+    def run_supervisor(self, programs, duration):
+        lines = []
+        supervisor = Supervisor(programs, lambda *line: lines.append(line),
+                                tick=0.05, stats_interval=0)
+        supervisor.run(duration)
+        return lines
+
+    def step_until_exited(self, supervisor, program):
+        program.process.wait()
+        supervisor.step()
+
+    def test_programs_are_restarted_with_backoff(self):
+        now = [100.0]
+        lines = []
+        program = Program('crash', 'echo started; exit 3')
+        supervisor = Supervisor([program], lambda *line: lines.append(line),
+                                stats_interval=0, clock=lambda: now[0])
+        supervisor.step()
+        self.step_until_exited(supervisor, program)
+        self.assertEqual(program.state, 'backoff')
+
+        now[0] = 100.9
+        supervisor.step()
+        self.assertEqual((program.state, program.restarts), ('backoff', 0))
+        now[0] = 101.0
+        supervisor.step()
+        self.assertEqual(program.restarts, 1)
+
+        self.step_until_exited(supervisor, program)
+        # Restarted after 1s then 2s
+        now[0] = 102.9
+        supervisor.step()
+        self.assertEqual(program.restarts, 1)
+        now[0] = 103.0
+        supervisor.step()
+        self.assertEqual(program.restarts, 2)
+        self.assertEqual(lines.count(('crash', 'stdout', 'started')), 2)
+        self.assertIn(('supervisor', 'supervisor', 'crash exited with 3, restarting in 2s'),
+                      lines)
+
+    def test_the_pipes_of_an_exited_program_are_closed(self):
+        lines = []
+        # The background sleep keeps the pipes open after the program exits
+        program = Program('crash', 'sleep 1 & echo started; exit 3')
+        supervisor = Supervisor([program], lambda *line: lines.append(line), stats_interval=0)
+        supervisor.step()
+        process = program.process
+        self.step_until_exited(supervisor, program)
+
+        self.assertTrue(process.stdout.closed)
+        self.assertTrue(process.stderr.closed)
+        self.assertFalse(supervisor.reader)
+        self.assertEqual(lines[0], ('crash', 'stdout', 'started'))
+
+    def test_programs_start_after_their_dependencies_are_healthy(self):
+        port = get_free_port()
+        server = Program(
+            'server',
+            'sleep 0.2; exec python -c "import socket; s = socket.socket(); '
+            's.bind((\'127.0.0.1\', {0})); s.listen(1); print(\'listening\'); '
+            'import time; time.sleep(5)"'.format(port),
+            health_check='tcp://127.0.0.1:{0}'.format(port),
+        )
+        client = Program('client', 'echo starting', after=['server'], restart=False)
+        lines = self.run_supervisor([client, server], 1.5)
+
+        up = [i for i, line in enumerate(lines) if line[2].startswith('server is up')]
+        self.assertEqual(len(up), 1)
+        self.assertTrue(up[0] < lines.index(('client', 'stdout', 'starting')))
+        self.assertEqual(client.state, 'exited')
+
+    def test_circular_dependencies_are_rejected(self):
+        programs = [Program('a', 'true', after=['b']), Program('b', 'true', after=['a'])]
+
+        self.assertRaises(ValueError, Supervisor, programs, None)
+
+    def test_stats_reads_cpu_and_memory_from_proc(self):
+        if not os.path.exists('/proc/self/stat'):
+            raise SkipTest('No /proc')
+        cpu, rss = read_process_stats(os.getpid())
+
+        self.assertTrue(cpu > 0)
+        self.assertTrue(rss > 0)
+
+
+def get_free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
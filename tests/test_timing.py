@@ -0,0 +1,48 @@
+import json
+import unittest
+
+from mock import patch
+
+from fusionbox.fabric.timing import Timer, phase, count_bytes, count_command, run, sudo
+
+
+class TimerTestCase(unittest.TestCase):
+    def test_counts_go_to_the_innermost_phase_and_the_totals(self):
+        with Timer(host='web1') as timer:
+            with phase('upload'):
+                count_bytes(10)
+                with phase('manifest'):
+                    count_bytes(5)
+                    count_command()
+            count_command()
+
+        report = timer.report()
+        self.assertEqual([line['phase'] for line in report], ['manifest', 'upload', 'total'])
+        self.assertEqual(report[0]['bytes'], 5)
+        self.assertEqual(report[1]['bytes'], 10)
+        self.assertEqual(report[1]['commands'], 0)
+        self.assertEqual(report[2]['bytes'], 15)
+        self.assertEqual(report[2]['commands'], 2)
+        self.assertTrue(all(line['host'] == 'web1' for line in report))
+
+    def test_to_json_lines_writes_one_object_per_line(self):
+        with Timer() as timer:
+            with phase('migrate'):
+                pass
+        lines = timer.to_json_lines().splitlines()
+        self.assertEqual([json.loads(line)['phase'] for line in lines], ['migrate', 'total'])
+
+    def test_run_and_sudo_are_counted(self):
+        with patch('fabric.operations.run') as fabric_run, patch('fabric.operations.sudo'):
+            with Timer() as timer:
+                with phase('reload'):
+                    run('true')
+                    sudo('true')
+            run('true')
+        self.assertEqual(timer.report()[0]['commands'], 2)
+        self.assertEqual(fabric_run.call_count, 2)
+
+    def test_phase_does_nothing_without_a_timer(self):
+        with phase('upload') as record:
+            count_bytes(10)
+        self.assertIsNone(record)
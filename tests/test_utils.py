@@ -1,7 +1,10 @@
 from mock import patch
 import unittest
 
-from fusionbox.fabric.utils import virtualenv, supervisor_command
+from fabric.api import settings, hide, local
+
+from fusionbox.fabric.utils import (virtualenv, supervisor_command, run_batch, BatchResult,
+                                    split_host_string)
 
 
 class VirtualenvTestCase(unittest.TestCase):
@@ -19,3 +22,55 @@ class SupervisorCommandTestCase(unittest.TestCase):
             supervisor_command('stop', 'texting_and_driving')
 
         mock_sudo.assert_called_with('supervisorctl stop texting_and_driving')
+
+
+class SplitHostStringTestCase(unittest.TestCase):
+    def test_split_host_string_separates_the_port(self):
+        self.assertEqual(split_host_string('deploy@example.com:2222'),
+                         ('deploy@example.com', '2222'))
+
+    def test_split_host_string_uses_the_fabric_defaults(self):
+        with settings(user='deploy', port='22'):
+            self.assertEqual(split_host_string('example.com'), ('deploy@example.com', '22'))
+
+
+class RunBatchTestCase(unittest.TestCase):
+    def run_batch_locally(self, commands):
+        """
+        Runs the script of ``run_batch`` with a local shell, which strips the
+        output like ``run``.
+        """
+        with settings(hide('everything')):
+            with patch('fusionbox.fabric.utils.run',
+                       side_effect=lambda script, **kwargs: local(script, capture=True)) as mock_run:
+                results = run_batch(commands)
+        self.assertEqual(mock_run.call_count, 1)
+        return results
+
+    def test_run_batch_runs_all_the_commands_in_one_remote_call(self):
+        results = self.run_batch_locally([
+            ('current', 'echo /var/www/sammich/src.00002'),
+            ('diff', 'test -s /dev/null'),
+            ('lines', 'echo two; echo lines'),
+        ])
+
+        self.assertEqual(results, {
+            'current': BatchResult('/var/www/sammich/src.00002', 0),
+            'diff': BatchResult('', 1),
+            'lines': BatchResult('two\nlines', 0),
+        })
+
+    def test_run_batch_keeps_output_without_trailing_newline(self):
+        results = self.run_batch_locally([
+            ('empty', 'true'),
+            ('partial', "printf 'no newline'"),
+            ('blank_lines', "printf 'a\\n\\nb\\n\\n'"),
+            ('last', 'exit 3'),
+        ])
+
+        self.assertEqual(results, {
+            'empty': BatchResult('', 0),
+            'partial': BatchResult('no newline', 0),
+            'blank_lines': BatchResult('a\n\nb', 0),
+            'last': BatchResult('', 3),
+        })